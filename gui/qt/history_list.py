@@ -71,8 +71,9 @@ class HistoryList(MyTreeWidget):
         self.update_headers(headers)
 
     def get_domain(self):
-        '''Replaced in address_dialog.py'''
-        return self.wallet.get_addresses()
+        '''Replaced in address_dialog.py.  None means the whole wallet, which
+        lets get_history() answer from the wallet's ordered ledger.'''
+        return None
 
     @rate_limited(1.0, classlevel=True, ts_after=True) # We rate limit the history list refresh no more than once every second, app-wide
     def update(self):
@@ -28,6 +28,7 @@ import base64
 import hmac
 import os
 import json
+import struct
 
 import ecdsa
 import pyaes
@@ -36,7 +37,7 @@ from . import networks
 from .util import (bfh, bh2u, to_string, print_error, InvalidPassword,
                    assert_bytes, to_bytes, inv_dict)
 from . import version
-from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
+from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1, pubkey_tweak_adds
 
 do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
 
@@ -162,6 +163,8 @@ def rev_hex(s):
 
 def int_to_hex(i, length=1):
     assert isinstance(i, int)
+    if 0 <= i < 1 << (8 * length):
+        return i.to_bytes(length, 'little').hex()
     s = hex(i)[2:].rstrip('L')
     s = "0"*(2*length - len(s)) + s
     return rev_hex(s)
@@ -179,6 +182,18 @@ def var_int(i):
         return "ff"+int_to_hex(i,8)
 
 
+def var_int_bytes(i):
+    '''var_int() as bytes.'''
+    if i<0xfd:
+        return bytes((i,))
+    elif i<=0xffff:
+        return b'\xfd' + struct.pack('<H', i)
+    elif i<=0xffffffff:
+        return b'\xfe' + struct.pack('<I', i)
+    else:
+        return b'\xff' + struct.pack('<Q', i)
+
+
 def op_push(i):
     if i<0x4c:
         return int_to_hex(i)
@@ -777,6 +792,21 @@ def _CKD_pub(cK, c, s):
     cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
+# The child public keys of cK, c at each of indices, as CKD_pub() derives them
+# one at a time, without their chain codes.  The parent key is only parsed
+# once, and libsecp256k1 adds the tweaks when it is available.
+def CKD_pubs(cK, c, indices):
+    tweaks = []
+    for n in indices:
+        if n & BIP32_PRIME: raise
+        tweaks.append(hmac.new(c, cK + n.to_bytes(4, 'big'), hashlib.sha512).digest()[0:32])
+    children = pubkey_tweak_adds(cK, tweaks)
+    if children is None:
+        point = ser_to_point(cK)
+        children = [point_to_ser(string_to_number(tweak)*SECP256k1.generator + point)
+                    for tweak in tweaks]
+    return children
+
 
 def xprv_header(xtype, *, net=None):
     if net is None: net = networks.net
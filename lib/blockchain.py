@@ -21,6 +21,9 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from collections import OrderedDict
+import functools
+import mmap
 import os
 import sys
 import threading
@@ -78,6 +81,8 @@ MAX_BITS = 0x1d00ffff
 MAX_TARGET = bits_to_target(MAX_BITS)
 # indicates no header in data file
 _NULL_HEADER = bytes([0]) * HEADER_SIZE
+# number of decoded headers (and their hashes) each Blockchain keeps
+HEADER_CACHE_SIZE = 2016
 
 def serialize_header(res):
     s = int_to_hex(res.get('version'), 4) \
@@ -108,7 +113,19 @@ def hash_header(header):
 
 
 blockchains = {}
-
+# Guards the headers files and the blockchains map across threads: headers
+# are saved by the network thread and chunks connected by its connector
+# thread.  Taken before any Blockchain.lock.
+chains_lock = threading.RLock()
+
+def with_chains_lock(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with chains_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+@with_chains_lock
 def read_blockchains(config):
     blockchains[0] = Blockchain(config, 0, None)
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
@@ -123,6 +140,7 @@ def read_blockchains(config):
         blockchains[b.base_height] = b
     return blockchains
 
+@with_chains_lock
 def check_header(header):
     if type(header) is not dict:
         return False
@@ -131,6 +149,7 @@ def check_header(header):
             return b
     return False
 
+@with_chains_lock
 def can_connect(header):
     for b in blockchains.values():
         if b.can_connect(header):
@@ -189,6 +208,84 @@ class HeaderChunk:
     def get_header_at_index(self, index):
         return self.headers[index]
 
+# Number of headers before a height that its DAA difficulty depends on.
+DAA_WINDOW = 147
+
+class HeaderWindow:
+    '''Timestamps, bits and cumulative work of a run of consecutive headers.
+
+    get_bits() needs the median time past and the chain work of the ~147
+    headers before the one it computes bits for.  Verifying headers in
+    order, the window is carried forward by appending each header, so
+    every header is read and bits_to_work() computed once instead of for
+    each of the ~147 headers that follow it.'''
+
+    def __init__(self, base_height):
+        self.base_height = base_height
+        self.timestamps = []
+        self.bits = []
+        # chainwork[i] is the work of the headers base_height ... base_height + i
+        self.chainwork = []
+
+    def __repr__(self):
+        return "HeaderWindow(base_height={}, top_height={})".format(self.base_height, self.top_height())
+
+    def top_height(self):
+        return self.base_height + len(self.timestamps) - 1
+
+    def contains(self, low, high):
+        return self.base_height <= low and high <= self.top_height()
+
+    def append(self, header):
+        assert header['block_height'] == self.top_height() + 1
+        work = bits_to_work(header['bits'])
+        self.chainwork.append(self.chainwork[-1] + work if self.chainwork else work)
+        self.timestamps.append(header['timestamp'])
+        self.bits.append(header['bits'])
+        excess = len(self.timestamps) - 4 * DAA_WINDOW
+        if excess > 0:
+            excess += DAA_WINDOW
+            del self.timestamps[:excess], self.bits[:excess], self.chainwork[:excess]
+            self.base_height += excess
+
+    def _index(self, height):
+        if not self.base_height <= height <= self.top_height():
+            raise Exception("get_bits missing header {} in {!r}".format(height, self))
+        return height - self.base_height
+
+    def get_timestamp(self, height):
+        return self.timestamps[self._index(height)]
+
+    def get_bits(self, height):
+        return self.bits[self._index(height)]
+
+    def get_work_between(self, start_height, end_height):
+        '''The work of the headers after start_height up to end_height.'''
+        return (self.chainwork[self._index(end_height)]
+                - self.chainwork[self._index(start_height)])
+
+    def get_median_time_past(self, height):
+        if height < 0:
+            return 0
+        low = max(0, height - 10)
+        times = sorted(self.timestamps[self._index(low):self._index(height) + 1])
+        return times[len(times) // 2]
+
+    def get_suitable_block_height(self, suitableheight):
+        # Same selection as Blockchain.get_suitable_block_height()
+        blocks2 = (self.get_timestamp(suitableheight), suitableheight)
+        blocks1 = (self.get_timestamp(suitableheight - 1), suitableheight - 1)
+        blocks = (self.get_timestamp(suitableheight - 2), suitableheight - 2)
+
+        if (blocks[0] > blocks2[0] ):
+            blocks,blocks2 = blocks2,blocks
+        if (blocks[0] > blocks1[0] ):
+            blocks,blocks1 = blocks1,blocks
+        if (blocks1[0] > blocks2[0] ):
+            blocks1,blocks2 = blocks2,blocks1
+
+        return blocks1[1]
+
 class Blockchain(util.PrintError):
     """
     Manages blockchain headers and their verification
@@ -201,6 +298,12 @@ class Blockchain(util.PrintError):
         self.parent_base_height = parent_base_height
 
         self.lock = threading.Lock()
+        # Read-only mapping of the headers file, made on first read and
+        # dropped whenever the file is written, resized or renamed.
+        self._headers_map = None
+        # height -> (header dict, header hash) of recently read headers,
+        # least recently used first.  Guarded by self.lock.
+        self._header_cache = OrderedDict()
         with self.lock:
             self.update_size()
 
@@ -213,6 +316,7 @@ class Blockchain(util.PrintError):
     def parent(self):
         return blockchains[self.parent_base_height]
 
+    @with_chains_lock
     def get_max_child(self):
         children = list(filter(lambda y: y.parent_base_height==self.base_height, blockchains.values()))
         return max([x.base_height for x in children]) if children else None
@@ -232,6 +336,7 @@ class Blockchain(util.PrintError):
         height = header.get('block_height')
         return header_hash == self.get_hash(height)
 
+    @with_chains_lock
     def fork(parent, header):
         base_height = header.get('block_height')
         self = Blockchain(parent.config, base_height, parent.base_height)
@@ -247,9 +352,70 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
+        # caller holds self.lock
+        self._unmap_headers()
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
 
+    def close_headers_map(self):
+        '''Unmap the headers file and forget the cached headers; both are
+        rebuilt by later reads.  The caller holds self.lock, and must do
+        this before modifying or renaming the file (Windows refuses to while
+        it is mapped).'''
+        self._unmap_headers()
+        self._header_cache.clear()
+
+    def _unmap_headers(self):
+        # caller holds self.lock
+        if self._headers_map is not None:
+            self._headers_map.close()
+            self._headers_map = None
+
+    def _forget_headers_from(self, height):
+        '''Drop cached headers at and above height.  Caller holds self.lock.'''
+        cache = self._header_cache
+        for h in [h for h in cache if h >= height]:
+            del cache[h]
+
+    def _read_raw_header(self, height):
+        # caller holds self.lock; height is in this chain's file
+        offset = (height - self.base_height) * HEADER_SIZE
+        m = self._headers_map
+        if m is None:
+            name = self.path()
+            if not os.path.exists(name) or os.path.getsize(name) < offset + HEADER_SIZE:
+                return
+            with open(name, 'rb') as f:
+                m = self._headers_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m[offset:offset + HEADER_SIZE]
+
+    @with_chains_lock
+    def _read_cached_header(self, height):
+        '''(header, hash) of the stored header at height, from this chain or
+        its parents, or None.  The header dict is shared with the cache and
+        must not be modified.'''
+        assert self.parent_base_height != self.base_height
+        if height < 0:
+            return
+        if height < self.base_height:
+            return self.parent()._read_cached_header(height)
+        if height > self.height():
+            return
+        with self.lock:
+            cache = self._header_cache
+            entry = cache.get(height)
+            if entry is not None:
+                cache.move_to_end(height)
+                return entry
+            h = self._read_raw_header(height)
+            # Is it a pre-checkpoint header that has never been requested?
+            if h is None or h == _NULL_HEADER:
+                return
+            entry = cache[height] = deserialize_header(h, height), hash_encode(Hash(h))
+            if len(cache) > HEADER_CACHE_SIZE:
+                cache.popitem(last=False)
+            return entry
+
     def verify_header(self, header, prev_header, bits=None):
         prev_header_hash = hash_header(prev_header)
         this_header_hash = hash_header(header)
@@ -274,20 +440,39 @@ class Blockchain(util.PrintError):
         prev_header = None
         if chunk_base_height != 0:
             prev_header = self.read_header(chunk_base_height - 1)
+        window = self.read_window(chunk_base_height - DAA_WINDOW, chunk_base_height - 1)
 
         header_count = len(chunk_data) // HEADER_SIZE
         for i in range(header_count):
             header = chunk.get_header_at_index(i)
             # Check the chain of hashes and the difficulty.
-            bits = self.get_bits(header, chunk)
+            bits = self.get_bits(header, chunk, window)
             self.verify_header(header, prev_header, bits)
+            window.append(header)
             prev_header = header
 
+    def read_window(self, low_height, high_height, chunk=None):
+        '''A HeaderWindow of the stored (or chunk) headers up to
+        high_height, starting at low_height or after the last missing
+        header before it.'''
+        low_height = max(0, low_height)
+        headers = []
+        for height in range(high_height, low_height - 1, -1):
+            header = self.read_header(height, chunk)
+            if header is None:
+                break
+            headers.append(header)
+        window = HeaderWindow(high_height - len(headers) + 1)
+        for header in reversed(headers):
+            window.append(header)
+        return window
+
     def path(self):
         d = util.get_headers_dir(self.config)
         filename = 'blockchain_headers' if self.parent_base_height is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_base_height, self.base_height))
         return os.path.join(d, filename)
 
+    @with_chains_lock
     def save_chunk(self, base_height, chunk_data):
         chunk_offset = (base_height - self.base_height) * HEADER_SIZE
         if chunk_offset < 0:
@@ -300,6 +485,7 @@ class Blockchain(util.PrintError):
         self.write(chunk_data, chunk_offset, truncate)
         self.swap_with_parent()
 
+    @with_chains_lock
     def swap_with_parent(self):
         if self.parent_base_height is None:
             return
@@ -325,6 +511,9 @@ class Blockchain(util.PrintError):
         self.base_height = parent.base_height; parent.base_height = base_height
         self._size = parent._size; parent._size = parent_branch_size
         # move files
+        for b in blockchains.values():
+            with b.lock:
+                b.close_headers_map()
         for b in blockchains.values():
             if b in [self, parent]: continue
             if b.old_path != b.path():
@@ -334,9 +523,12 @@ class Blockchain(util.PrintError):
         blockchains[self.base_height] = self
         blockchains[parent.base_height] = parent
 
+    @with_chains_lock
     def write(self, data, offset, truncate=True):
         filename = self.path()
         with self.lock:
+            self._unmap_headers()
+            self._forget_headers_from(self.base_height + offset // HEADER_SIZE)
             with open(filename, 'rb+') as f:
                 if truncate and offset != self._size*HEADER_SIZE:
                     f.seek(offset)
@@ -347,6 +539,7 @@ class Blockchain(util.PrintError):
                 os.fsync(f.fileno())
             self.update_size()
 
+    @with_chains_lock
     def save_header(self, header):
         delta = header.get('block_height') - self.base_height
         data = bfh(serialize_header(header))
@@ -360,30 +553,20 @@ class Blockchain(util.PrintError):
         if chunk is not None and chunk.contains_height(height):
             return chunk.get_header_at_height(height)
 
-        assert self.parent_base_height != self.base_height
-        if height < 0:
-            return
-        if height < self.base_height:
-            return self.parent().read_header(height)
-        if height > self.height():
-            return
-        delta = height - self.base_height
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * HEADER_SIZE)
-                h = f.read(HEADER_SIZE)
-            # Is it a pre-checkpoint header that has never been requested?
-            if h == _NULL_HEADER:
-                return None
-            return deserialize_header(h, height)
+        entry = self._read_cached_header(height)
+        if entry is None:
+            return None
+        return dict(entry[0])
 
     def get_hash(self, height):
         if height == -1:
             return '0000000000000000000000000000000000000000000000000000000000000000'
         elif height == 0:
             return networks.net.GENESIS
-        return hash_header(self.read_header(height))
+        entry = self._read_cached_header(height)
+        if entry is None:
+            return hash_header(None)
+        return entry[1]
 
     # Not used.
     def BIP9(self, height, flag):
@@ -416,47 +599,45 @@ class Blockchain(util.PrintError):
 
         return blocks1['block_height']
 
-    def get_bits(self, header, chunk=None):
-        '''Return bits for the given height.'''
+    def get_bits(self, header, chunk=None, window=None):
+        '''Return bits for the given height.  window, if given, is a
+        HeaderWindow that is used if it covers the headers needed.'''
         # Difficulty adjustment interval?
         height = header['block_height']
         # Genesis
         if height == 0:
             return MAX_BITS
 
-        prior = self.read_header(height - 1, chunk)
-        if prior is None:
+        if window is None or not window.contains(max(0, height - DAA_WINDOW), height - 1):
+            window = self.read_window(height - DAA_WINDOW, height - 1, chunk)
+        if not window.contains(height - 1, height - 1):
             raise Exception("get_bits missing header {} with chunk {!r}".format(height - 1, chunk))
-        bits = prior['bits']
+        bits = window.get_bits(height - 1)
+        prior_timestamp = window.get_timestamp(height - 1)
 
         #NOV 13 HF DAA
 
         prevheight = height -1
-        daa_mtp = self.get_median_time_past(prevheight, chunk)
+        daa_mtp = window.get_median_time_past(prevheight)
 
         #if (daa_mtp >= 1509559291):  #leave this here for testing
         if (daa_mtp >= 1510600000):
 
             if networks.net.TESTNET:
                 # testnet 20 minute rule
-                if header['timestamp'] - prior['timestamp'] > 20*60:
+                if header['timestamp'] - prior_timestamp > 20*60:
                     return MAX_BITS
 
             # determine block range
-            daa_starting_height = self.get_suitable_block_height(prevheight-144, chunk)
-            daa_ending_height = self.get_suitable_block_height(prevheight, chunk)
+            daa_starting_height = window.get_suitable_block_height(prevheight-144)
+            daa_ending_height = window.get_suitable_block_height(prevheight)
 
             # calculate cumulative work (EXcluding work from block daa_starting_height, INcluding work from block daa_ending_height)
-            daa_cumulative_work = 0
-            for daa_i in range (daa_starting_height+1, daa_ending_height+1):
-                daa_prior = self.read_header(daa_i, chunk)
-                daa_bits_for_a_block = daa_prior['bits']
-                daa_work_for_a_block = bits_to_work(daa_bits_for_a_block)
-                daa_cumulative_work += daa_work_for_a_block
+            daa_cumulative_work = window.get_work_between(daa_starting_height, daa_ending_height)
 
             # calculate and sanitize elapsed time
-            daa_starting_timestamp = self.read_header(daa_starting_height, chunk)['timestamp']
-            daa_ending_timestamp = self.read_header(daa_ending_height, chunk)['timestamp']
+            daa_starting_timestamp = window.get_timestamp(daa_starting_height)
+            daa_ending_timestamp = window.get_timestamp(daa_ending_height)
             daa_elapsed_time = daa_ending_timestamp - daa_starting_timestamp
             if (daa_elapsed_time>172800):
                 daa_elapsed_time=172800
@@ -477,7 +658,7 @@ class Blockchain(util.PrintError):
 
         if networks.net.TESTNET:
             # testnet 20 minute rule
-            if header['timestamp'] - prior['timestamp'] > 20*60:
+            if header['timestamp'] - prior_timestamp > 20*60:
                 return MAX_BITS
             return self.read_header(height // 2016 * 2016, chunk)['bits']
 
@@ -485,7 +666,7 @@ class Blockchain(util.PrintError):
         # Can't go below minimum, so early bail
         if bits == MAX_BITS:
             return bits
-        mtp_6blocks = self.get_median_time_past(height - 1, chunk) - self.get_median_time_past(height - 7, chunk)
+        mtp_6blocks = window.get_median_time_past(height - 1) - window.get_median_time_past(height - 7)
         if mtp_6blocks < 12 * 3600:
             return bits
 
@@ -520,7 +701,7 @@ class Blockchain(util.PrintError):
         previous_header = self.read_header(height -1)
         if not previous_header:
             return False
-        prev_hash = hash_header(previous_header)
+        prev_hash = self.get_hash(height - 1)
         if prev_hash != header.get('prev_block_hash'):
             return False
         bits = self.get_bits(header)
@@ -537,6 +718,31 @@ class Blockchain(util.PrintError):
 
         header_count = len(hexdata) // HEADER_SIZE
         top_height = base_height + header_count - 1
+        connect_state = self._chunk_position(chunk, top_height, proof_was_provided)
+        if connect_state is not None:
+            return connect_state
+
+        # Verified without chains_lock: it only reads the headers below the
+        # chunk, which the hash of the header below it pins down.
+        if not proof_was_provided:
+            try:
+                self.verify_chunk(base_height, hexdata)
+            except VerifyError as e:
+                self.print_error('verify_chunk failed: {}'.format(e))
+                return CHUNK_BAD
+
+        with chains_lock:
+            # Headers may have been saved to this chain in the meantime.
+            connect_state = self._chunk_position(chunk, top_height, proof_was_provided)
+            if connect_state is not None:
+                return connect_state
+            self.save_chunk(base_height, hexdata)
+        return CHUNK_ACCEPTED
+
+    def _chunk_position(self, chunk, top_height, proof_was_provided):
+        '''The connect state of a chunk for where it lies on this chain, or
+        None if it is to be verified and saved.'''
+        base_height = chunk.base_height
         # We know that chunks before the checkpoint height, end at the checkpoint height, and
         # will be guaranteed to be covered by the checkpointing. If no proof is provided then
         # this is wrong.
@@ -558,8 +764,7 @@ class Blockchain(util.PrintError):
             # there is, indicate the need for the server to fork.
             intersection_height = min(top_height, self.height())
             chunk_header = chunk.get_header_at_height(intersection_height)
-            our_header = self.read_header(intersection_height)
-            if hash_header(chunk_header) != hash_header(our_header):
+            if hash_header(chunk_header) != self.get_hash(intersection_height):
                 return CHUNK_FORKS
             if intersection_height <= self.height():
                 return CHUNK_ACCEPTED
@@ -567,16 +772,7 @@ class Blockchain(util.PrintError):
             # This base of this chunk joins to the top of the blockchain in theory.
             # We need to rule out the case where the chunk is actually a fork at the
             # connecting height.
-            our_header = self.read_header(self.height())
             chunk_header = chunk.get_header_at_height(base_height)
-            if hash_header(our_header) != chunk_header['prev_block_hash']:
+            if self.get_hash(self.height()) != chunk_header['prev_block_hash']:
                 return CHUNK_FORKS
 
-        try:
-            if not proof_was_provided:
-                self.verify_chunk(base_height, hexdata)
-            self.save_chunk(base_height, hexdata)
-            return CHUNK_ACCEPTED
-        except VerifyError as e:
-            self.print_error('verify_chunk failed: {}'.format(e))
-            return CHUNK_BAD
@@ -197,9 +197,10 @@ class CoinChooserBase(PrintError):
         tx.add_inputs([coin for b in buckets for coin in b.coins])
         tx_size = base_size + sum(bucket.size for bucket in buckets)
 
-        # This takes a count of change outputs and returns a tx fee;
-        # each pay-to-bitcoin-address output serializes as 34 bytes
-        fee = lambda count: fee_estimator(tx_size + count * 34)
+        # This takes a count of change outputs and returns a tx fee
+        change_sizes = [Transaction.estimated_output_size((TYPE_ADDRESS, addr, 0))
+                        for addr in change_addrs]
+        fee = lambda count: fee_estimator(tx_size + sum(change_sizes[:count]))
         change, dust = self.change_outputs(tx, change_addrs, fee, dust_threshold)
         tx.add_outputs(change)
         tx.ephemeral['dust_to_fee'] = dust
@@ -177,6 +177,14 @@ class Commands:
         self.wallet.storage.write()
         return {'password':self.wallet.has_password()}
 
+    @command('w')
+    def setstorageformat(self, storage_format):
+        """Convert the wallet file to another storage format. 'json' rewrites
+        the whole file on every save, 'sqlite' only writes what changed. """
+        self.wallet.storage.set_storage_format(storage_format)
+        self.wallet.storage.write()
+        return {'storage_format': self.wallet.storage.storage_format}
+
     @command('w')
     def get(self, key):
         """Return item from wallet storage"""
@@ -496,9 +504,9 @@ class Commands:
         return tx.as_dict()
 
     @command('w')
-    def history(self, year=None, show_addresses=False, show_fiat=False):
+    def history(self, year=None, show_addresses=False, show_fiat=False, limit=None, offset=0):
         """Wallet history. Returns the transaction history of your wallet."""
-        kwargs = {'show_addresses': show_addresses}
+        kwargs = {'show_addresses': show_addresses, 'limit': limit, 'offset': offset}
         if year:
             import time
             start_date = datetime.datetime(year, 1, 1)
@@ -725,6 +733,7 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in BCH).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'storage_format': 'Wallet file format: json or sqlite',
 }
 
 command_options = {
@@ -759,6 +768,8 @@ command_options = {
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
     'year':        (None, "Show history for a given year"),
+    'limit':       (None, "Show at most this many of the most recent transactions"),
+    'offset':      (None, "Skip this many of the most recent transactions"),
 }
 
 
@@ -770,6 +781,8 @@ arg_types = {
     'nbits': int,
     'imax': int,
     'year': int,
+    'limit': int,
+    'offset': int,
     'entropy': int,
     'tx': tx_from_str,
     'pubkeys': json_loads,
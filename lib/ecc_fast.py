@@ -78,9 +78,15 @@ def load_library():
         secp256k1.secp256k1_ecdsa_signature_serialize_compact.argtypes = [c_void_p, c_char_p, c_char_p]
         secp256k1.secp256k1_ecdsa_signature_serialize_compact.restype = c_int
 
+        secp256k1.secp256k1_ecdsa_signature_serialize_der.argtypes = [c_void_p, c_char_p, c_void_p, c_char_p]
+        secp256k1.secp256k1_ecdsa_signature_serialize_der.restype = c_int
+
         secp256k1.secp256k1_ec_pubkey_tweak_mul.argtypes = [c_void_p, c_char_p, c_char_p]
         secp256k1.secp256k1_ec_pubkey_tweak_mul.restype = c_int
 
+        secp256k1.secp256k1_ec_pubkey_tweak_add.argtypes = [c_void_p, c_char_p, c_char_p]
+        secp256k1.secp256k1_ec_pubkey_tweak_add.restype = c_int
+
         secp256k1.ctx = secp256k1.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
         r = secp256k1.secp256k1_context_randomize(secp256k1.ctx, os.urandom(32))
         if r:
@@ -215,6 +221,59 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+def sign_digests(privkey, digests):
+    '''DER signatures of digests (32 bytes each) with privkey (32 bytes),
+    each checked against the public key before it is returned.  Goes to
+    libsecp256k1 directly rather than through python-ecdsa, and works out
+    the public key once for all of them.  Signatures are low S, with RFC6979
+    nonces, as python-ecdsa makes them.  None when libsecp256k1 is not in
+    use.'''
+    if not is_using_fast_ecc():
+        return None
+    ctx = _libsecp256k1.ctx
+    pubkey = create_string_buffer(64)
+    if not _libsecp256k1.secp256k1_ec_pubkey_create(ctx, pubkey, privkey):
+        raise Exception('invalid private key')
+    sig = create_string_buffer(64)
+    der = create_string_buffer(72)
+    der_size = c_size_t()
+    result = []
+    for digest in digests:
+        if not _libsecp256k1.secp256k1_ecdsa_sign(ctx, sig, digest, privkey, None, None):
+            raise Exception('signing failed')
+        if not _libsecp256k1.secp256k1_ecdsa_verify(ctx, sig, digest, pubkey):
+            raise Exception('signature does not verify')
+        der_size.value = len(der)
+        _libsecp256k1.secp256k1_ecdsa_signature_serialize_der(ctx, der, byref(der_size), sig)
+        result.append(der.raw[:der_size.value])
+    return result
+
+
+def pubkey_tweak_adds(pubkey, tweaks):
+    '''pubkey (serialized) plus tweak*G for each of tweaks (32 bytes each),
+    compressed.  The public key is parsed once for all of them.  None when
+    libsecp256k1 is not in use.'''
+    if not is_using_fast_ecc():
+        return None
+    ctx = _libsecp256k1.ctx
+    parent = create_string_buffer(64)
+    if not _libsecp256k1.secp256k1_ec_pubkey_parse(ctx, parent, pubkey, len(pubkey)):
+        raise Exception('invalid public key')
+    child = create_string_buffer(64)
+    child_serialized = create_string_buffer(33)
+    child_size = c_size_t()
+    result = []
+    for tweak in tweaks:
+        ctypes.memmove(child, parent, 64)
+        if not _libsecp256k1.secp256k1_ec_pubkey_tweak_add(ctx, child, tweak):
+            raise Exception('invalid tweak')
+        child_size.value = 33
+        _libsecp256k1.secp256k1_ec_pubkey_serialize(
+            ctx, child_serialized, byref(child_size), child, SECP256K1_EC_COMPRESSED)
+        result.append(child_serialized.raw)
+    return result
+
+
 try:
     _libsecp256k1 = load_library()
 except:
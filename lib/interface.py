@@ -25,6 +25,7 @@
 import os
 import re
 import socket
+from collections import OrderedDict, deque
 import ssl
 import sys
 import threading
@@ -60,6 +61,14 @@ def Connection(server, queue, config_path):
 
 class TcpConnection(threading.Thread, util.PrintError):
 
+    # Verifying SSL contexts, by (ca_certs, mtime of ca_certs), so that a CA
+    # file is loaded once rather than for every connection; and the last
+    # TLS session of each server, with the context it belongs to, so that
+    # reconnecting resumes it rather than doing a full handshake.
+    ssl_contexts = {}
+    ssl_sessions = {}
+    ssl_lock = threading.Lock()
+
     def __init__(self, server, queue, config_path):
         threading.Thread.__init__(self)
         self.config_path = config_path
@@ -138,6 +147,40 @@ class TcpConnection(threading.Thread, util.PrintError):
 
         return context
 
+    @classmethod
+    def get_verifying_context(cls, ca_certs):
+        key = (ca_certs, os.stat(ca_certs).st_mtime)
+        with cls.ssl_lock:
+            context = cls.ssl_contexts.get(key)
+            if context is None:
+                context = cls.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_certs)
+                for k in [k for k in cls.ssl_contexts if k[0] == ca_certs]:
+                    del cls.ssl_contexts[k]  # An older version of the file
+                cls.ssl_contexts[key] = context
+            return context
+
+    def wrap_resumable(self, context, s):
+        '''Wraps s, resuming our last session with the server if it is
+        from context.'''
+        session = None
+        with self.ssl_lock:
+            last = self.ssl_sessions.get(self.server)
+        if last and last[0] is context:
+            session = last[1]
+        s = context.wrap_socket(s, do_handshake_on_connect=True, session=session)
+        self.save_session(self.server, s)
+        return s
+
+    @classmethod
+    def save_session(cls, server, s):
+        '''Remembers the session of s, a socket connected to server.  Called
+        again when the connection is closed, as TLS 1.3 servers hand out
+        sessions only after the handshake.'''
+        session = getattr(s, 'session', None)
+        if session is not None:
+            with cls.ssl_lock:
+                cls.ssl_sessions[server] = (s.context, session)
+
     def get_socket(self):
         if self.use_ssl:
             cert_path = os.path.join(self.config_path, 'certs', self.host)
@@ -148,8 +191,7 @@ class TcpConnection(threading.Thread, util.PrintError):
                     return
                 # try with CA first
                 try:
-                    context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_path)
-                    s = context.wrap_socket(s, do_handshake_on_connect=True)
+                    s = self.wrap_resumable(self.get_verifying_context(ca_path), s)
                 except ssl.SSLError as e:
                     self.print_error(e)
                     s = None
@@ -193,9 +235,11 @@ class TcpConnection(threading.Thread, util.PrintError):
 
         if self.use_ssl:
             try:
-                context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED,
-                                               ca_certs=(temporary_path if is_new else cert_path))
-                s = context.wrap_socket(s, do_handshake_on_connect=True)
+                if is_new:
+                    context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=temporary_path)
+                    s = context.wrap_socket(s, do_handshake_on_connect=True)
+                else:
+                    s = self.wrap_resumable(self.get_verifying_context(cert_path), s)
             except socket.timeout:
                 self.print_error('timeout')
                 return
@@ -255,6 +299,18 @@ class Interface(util.PrintError):
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
       ping_required(), queue_request(), send_requests()
     - Member variable server.
+
+    Queued requests are sent most urgent first (see METHOD_PRIORITIES), and
+    within a priority round robin between the owners they were queued for,
+    so that one wallet's initial sync does not hold up another's.  At most
+    self.window requests are in flight; the window grows while round trip
+    times stay near the fastest seen and shrinks when replies start to queue
+    up at the server.
+
+    Requests queued with batch=True are sent together as JSON-RPC 2.0 batches
+    (arrays of up to MAX_BATCH requests) and the array replies are split back
+    into the usual (request, response) pairs.  If the server rejects a batch,
+    batching is turned off and the batched requests are sent again one by one.
     """
 
     MODE_DEFAULT = 'default'
@@ -263,6 +319,30 @@ class Interface(util.PrintError):
     MODE_CATCH_UP = 'catch_up'
     MODE_VERIFICATION = 'verification'
 
+    PRIORITY_HEADERS = 0
+    PRIORITY_SUBSCRIPTIONS = 1
+    PRIORITY_HISTORY = 2
+    PRIORITY_TX = 3
+    PRIORITY_MERKLE = 4
+    # Methods not listed go with the subscriptions
+    METHOD_PRIORITIES = {
+        'server.version': PRIORITY_HEADERS,
+        'server.ping': PRIORITY_HEADERS,
+        'blockchain.headers.subscribe': PRIORITY_HEADERS,
+        'blockchain.block.header': PRIORITY_HEADERS,
+        'blockchain.block.headers': PRIORITY_HEADERS,
+        'blockchain.scripthash.get_history': PRIORITY_HISTORY,
+        'blockchain.transaction.get': PRIORITY_TX,
+        'blockchain.transaction.get_merkle': PRIORITY_MERKLE,
+    }
+
+    # Bounds and starting point of the number of requests in flight
+    MIN_WINDOW = 10
+    MAX_WINDOW = 500
+    INITIAL_WINDOW = 100
+    # Most requests sent in one JSON-RPC batch
+    MAX_BATCH = 100
+
     def __init__(self, server, socket):
         self.server = server
         self.host, self.port, _ = server.rsplit(':', 2)
@@ -272,9 +352,23 @@ class Interface(util.PrintError):
         self.pipe.set_timeout(0.0)  # Don't wait for data
         # Dump network messages.  Set at runtime from the console.
         self.debug = False
-        self.unsent_requests = []
+        # For each priority, owner -> deque of requests, in round robin order
+        self.unsent_requests = [OrderedDict() for p in range(self.PRIORITY_MERKLE + 1)]
+        self.num_unsent = 0
         self.unanswered_requests = {}
+        self.send_times = {}
+        self.window = self.INITIAL_WINDOW
+        self.min_rtt = None
+        self.srtt = None
+        self.window_shrink_time = 0
+        self.batching = True
+        # Ids of queued requests to send in batches
+        self.batchable = set()
+        # The batches in flight, oldest first, each as id -> owner of its
+        # requests.  One goes when its reply (or refusal) arrives.
+        self.batches = deque()
         self.last_send = time.time()
+        self.request_time = self.last_send
         self.closed_remotely = False
         
         self.mode = None
@@ -297,6 +391,8 @@ class Interface(util.PrintError):
         return self.socket.fileno()
 
     def close(self):
+        if isinstance(self.socket, ssl.SSLSocket):
+            TcpConnection.save_session(self.server, self.socket)
         if not self.closed_remotely:
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
@@ -304,36 +400,139 @@ class Interface(util.PrintError):
                 pass
         self.socket.close()
 
-    def queue_request(self, *args):  # method, params, _id
+    def queue_request(self, *args, owner=None, batch=False):  # method, params, _id
         '''Queue a request, later to be send with send_requests when the
-        socket is available for writing.
+        socket is available for writing.  owner is any hashable naming who
+        the request is for, and is used to share the link fairly.  batch
+        allows the request to go out in a JSON-RPC batch.
         '''
         self.request_time = time.time()
-        self.unsent_requests.append(args)
+        if batch and self.batching:
+            self.batchable.add(args[2])
+        priority = self.METHOD_PRIORITIES.get(args[0], self.PRIORITY_SUBSCRIPTIONS)
+        queues = self.unsent_requests[priority]
+        q = queues.get(owner)
+        if q is None:
+            q = queues[owner] = deque()
+        q.append(args)
+        self.num_unsent += 1
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Number of queued requests that fit in the window now.'''
+        n = self.window - len(self.unanswered_requests)
+        return max(0, min(n, self.num_unsent))
+
+    def _pop_requests(self, n):
+        requests = []
+        for queues in self.unsent_requests:
+            while queues and len(requests) < n:
+                owner, q = next(iter(queues.items()))
+                requests.append((owner, q.popleft()))
+                if q:
+                    queues.move_to_end(owner)
+                else:
+                    del queues[owner]
+        self.num_unsent -= len(requests)
+        return requests
+
+    def _unpop_requests(self, requests):
+        for owner, request in reversed(requests):
+            priority = self.METHOD_PRIORITIES.get(request[0], self.PRIORITY_SUBSCRIPTIONS)
+            queues = self.unsent_requests[priority]
+            q = queues.get(owner)
+            if q is None:
+                q = queues[owner] = deque()
+                queues.move_to_end(owner, last=False)
+            q.appendleft(request)
+        self.num_unsent += len(requests)
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
         self.last_send = time.time()
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
-        n = self.num_requests()
-        wire_requests = self.unsent_requests[0:n]
+        requests = self._pop_requests(self.num_requests())
+        wire_requests = [r for owner, r in requests]
+        messages = []
+        batches = []
+        batch = []
+        for owner, r in requests:
+            if r[2] in self.batchable:
+                batch.append(dict(make_dict(*r), jsonrpc='2.0'))
+                if len(batch) == self.MAX_BATCH:
+                    messages.append(batch)
+                    batches.append(batch)
+                    batch = []
+            else:
+                messages.append(make_dict(*r))
+        if len(batch) > 1:
+            messages.append(batch)
+            batches.append(batch)
+        elif batch:
+            messages.append(batch[0])
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_all(messages)
         except (OSError, ssl.SSLError) as e:
             self.print_error("send_requests: {}: {}".format(type(e).__name__, e))
+            self._unpop_requests(requests)
             return False
-        self.unsent_requests = self.unsent_requests[n:]
-        for request in wire_requests:
+        if wire_requests:
+            self.request_time = self.last_send
+        for owner, request in requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = self.last_send
+        owners = dict((r[2], owner) for owner, r in requests)
+        for batch in batches:
+            self.batches.append({r['id']: owners[r['id']] for r in batch})
+        self.batchable.difference_update(owners)
         return True
 
+    def _batch_answered(self, response):
+        ids = set(r.get('id') for r in response if type(r) is dict)
+        for n, batch in enumerate(self.batches):
+            if not ids.isdisjoint(batch):
+                del self.batches[n]
+                break
+
+    def _batch_rejected(self):
+        '''The server refused the oldest batch in flight.  The first time,
+        send everything singly from now on, starting with the requests of
+        all the batches still awaiting a reply: the refusals of the others
+        are expected next, and only need to be recognised.'''
+        rejected = self.batches.popleft()
+        if not self.batching:
+            return
+        self.print_error("server does not support batch requests")
+        self.batching = False
+        self.batchable.clear()
+        requests = []
+        for batch in [rejected] + list(self.batches):
+            for wire_id, owner in batch.items():
+                request = self.unanswered_requests.pop(wire_id, None)
+                self.send_times.pop(wire_id, None)
+                if request:
+                    requests.append((owner, request))
+        self._unpop_requests(requests)
+
+    def update_window(self, rtt):
+        '''Adjust the window after a reply that took rtt seconds.  While
+        round trips stay close to the fastest seen the server is keeping up,
+        so a full window grows by one per reply.  Once replies wait well
+        beyond that, the window shrinks by a quarter, at most once per round
+        trip.'''
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        now = time.time()
+        if self.srtt > 4 * self.min_rtt + 0.2:
+            if now - self.window_shrink_time > self.srtt:
+                self.window = max(self.MIN_WINDOW, self.window * 3 // 4)
+                self.window_shrink_time = now
+        elif (self.srtt < 2 * self.min_rtt + 0.02
+              and len(self.unanswered_requests) + 1 >= self.window):
+            self.window = min(self.MAX_WINDOW, self.window + 1)
+
     def ping_required(self):
         '''Returns True if a ping should be sent.'''
         return time.time() - self.last_send > 300
@@ -362,28 +561,51 @@ class Interface(util.PrintError):
                 response = self.pipe.get()
             except util.timeout:
                 break
-            if not type(response) is dict:
+            if type(response) is list and response:
+                # Reply to a batch
+                if self.debug:
+                    self.print_error("<--", response)
+                self._batch_answered(response)
+                if not all(self._add_response(responses, r) for r in response):
+                    break
+            elif not type(response) is dict:
                 responses.append((None, None))
                 if response is None:
                     self.closed_remotely = True
                     self.print_error("connection closed remotely")
                 break
-            if self.debug:
-                self.print_error("<--", response)
-            wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
-                responses.append((None, response))
             else:
-                request = self.unanswered_requests.pop(wire_id, None)
-                if request:
-                    responses.append((request, response))
-                else:
-                    self.print_error("unknown wire ID", wire_id)
-                    responses.append((None, None)) # Signal
+                if self.debug:
+                    self.print_error("<--", response)
+                if (response.get('id') is None and 'error' in response
+                        and 'method' not in response and self.batches):
+                    # Not a notification, but an error about a request the
+                    # server could not even read: a batch.
+                    self._batch_rejected()
+                elif not self._add_response(responses, response):
                     break
 
         return responses
 
+    def _add_response(self, responses, response):
+        '''Append the (request, response) pair for one reply to responses.
+        Returns False if the server is misbehaving.'''
+        if not type(response) is dict:
+            responses.append((None, None))
+            return False
+        wire_id = response.get('id', None)
+        if wire_id is None:  # Notification
+            responses.append((None, response))
+            return True
+        request = self.unanswered_requests.pop(wire_id, None)
+        if not request:
+            self.print_error("unknown wire ID", wire_id)
+            responses.append((None, None)) # Signal
+            return False
+        self.update_window(time.time() - self.send_times.pop(wire_id))
+        responses.append((request, response))
+        return True
+
 
 def check_cert(host, cert):
     try:
@@ -257,19 +257,30 @@ class Xpub:
         self.xpub = None
         self.xpub_receive = None
         self.xpub_change = None
+        self.branch_keys = {}
 
     def get_master_public_key(self):
         return self.xpub
 
     def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        return self.derive_pubkeys(for_change, (n,))[0]
+
+    def derive_pubkeys(self, for_change, indices):
+        '''The public keys at each of indices on the receiving or change
+        branch.  The branch key is only parsed once, so this is much faster
+        than derive_pubkey() one index at a time.'''
+        branch = self.branch_keys.get(bool(for_change))
+        if branch is None:
+            xpub = self.xpub_change if for_change else self.xpub_receive
+            if xpub is None:
+                xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
+                if for_change:
+                    self.xpub_change = xpub
+                else:
+                    self.xpub_receive = xpub
+            _, _, _, _, c, cK = deserialize_xpub(xpub)
+            branch = self.branch_keys[bool(for_change)] = (cK, c)
+        return [bh2u(cK) for cK in CKD_pubs(*branch, indices)]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -459,6 +470,9 @@ class Old_KeyStore(Deterministic_KeyStore):
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, indices):
+        return [self.derive_pubkey(for_change, n) for n in indices]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
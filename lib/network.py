@@ -33,6 +33,8 @@ from collections import defaultdict
 import threading
 import socket
 import json
+import sys
+import traceback
 
 import socks
 from . import util
@@ -48,6 +50,21 @@ from . import version
 DEFAULT_AUTO_CONNECT = True
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+SERVER_STATS_SAVE_INTERVAL = 60
+# Longest the network loop sleeps when there is nothing to do.  Anything that
+# gives it work (sockets, connection attempts, sends from other threads) wakes
+# it up earlier; this only bounds how late pings and timeouts are noticed.
+LOOP_IDLE_TIMEOUT = 1.0
+# Header chunk requests kept in flight, or received and waiting to be
+# connected, per interface catching up.
+CATCH_UP_CHUNKS = 8
+# When picking a server to connect to, how often one of the fastest servers
+# seen before is picked rather than any, and how many of them there are to
+# choose from.  Servers we failed to connect to this many times in a row are
+# only picked when there is nothing else.
+FAST_SERVER_PREFERENCE = 0.75
+FAST_SERVER_CHOICES = 5
+MAX_SERVER_FAILURES = 3
 
 
 def parse_servers(result):
@@ -101,8 +118,19 @@ def get_eligible_servers(hostmap=None, protocol="s", exclude_set=set()):
         hostmap = networks.net.DEFAULT_SERVERS
     return list(set(filter_protocol(hostmap, protocol)) - exclude_set)
 
-def pick_random_server(hostmap = None, protocol = 's', exclude_set = set()):
+def pick_random_server(hostmap = None, protocol = 's', exclude_set = set(), server_stats = None):
+    '''server_stats, if given, is what we know of the servers from earlier
+    connections (see Network.server_stats), and makes the pick favour
+    servers that were fast and reachable.'''
     eligible = get_eligible_servers(hostmap, protocol, exclude_set)
+    if server_stats and eligible:
+        stats = lambda server: server_stats.get(server, {})
+        eligible = [server for server in eligible
+                    if stats(server).get('failures', 0) < MAX_SERVER_FAILURES] or eligible
+        timed = sorted((server for server in eligible if stats(server).get('rtt') is not None),
+                       key=lambda server: stats(server)['rtt'])
+        if timed and random.random() < FAST_SERVER_PREFERENCE:
+            eligible = timed[:FAST_SERVER_CHOICES]
     return random.choice(eligible) if eligible else None
 
 def servers_to_hostmap(servers):
@@ -179,6 +207,109 @@ def serialize_server(host, port, protocol):
     return str(':'.join([host, port, protocol]))
 
 
+class _WakeupQueue(queue.Queue):
+    '''Queue of results from other threads (Connection() sockets, connected
+    header chunks) that wakes the network loop when one is put on it.'''
+
+    def __init__(self, wakeup):
+        super().__init__()
+        self._wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self._wakeup()
+
+
+class _ScripthashRoute:
+    '''Where the status of a scripthash goes: the callbacks subscribed to
+    it, and its address if known, which is added to the responses.'''
+
+    __slots__ = ('address', 'callbacks')
+
+    def __init__(self):
+        self.address = None
+        self.callbacks = []
+
+
+class _ShardedFetch:
+    '''A request for data we can check ourselves (a raw transaction or a
+    merkle proof), which may therefore be sent to any connected server.
+    Calling it hands the response to everyone waiting for the same request.'''
+
+    def __init__(self, key, callback, owner):
+        self.key = key          # (method, params tuple)
+        self.callbacks = [callback]
+        self.owner = owner
+        self.server = None      # where it was last sent
+        self.message_id = None
+        self.tried = set()      # servers that failed to answer it
+
+    def __call__(self, response):
+        for callback in self.callbacks:
+            callback(response)
+
+
+class _HeaderPipeline:
+    '''The catch-up state of an interface: the chunks of headers requested
+    and those received ahead of the one being connected.  Chunks are
+    requested CATCH_UP_CHUNKS at a time, and connected in order by the
+    _ChunkConnector thread.'''
+
+    def __init__(self):
+        self.active = False
+        self.next_request = None    # base height of the next chunk to request
+        self.next_connect = None    # base height of the next chunk to connect
+        self.connecting = None      # base height of the chunk being connected
+        self.requested = set()      # base heights of the chunks in flight
+        self.stale = set()          # ... of those requested before a restart
+        self.chunks = {}            # base height -> chunk data
+
+    def start(self, height):
+        self.stop()
+        self.active = True
+        self.next_request = self.next_connect = height
+
+    def stop(self):
+        self.active = False
+        self.connecting = None
+        self.stale |= self.requested
+        self.requested = set()
+        self.chunks = {}
+
+
+class _ChunkConnector(threading.Thread):
+    '''Verifies and saves header chunks (Blockchain.connect_chunk) in the
+    order they are given, away from the network thread.  Results go on
+    the results queue as (interface, base_height, count, connect_state).
+    connect_chunk verifies a chunk without blockchain.chains_lock, and only
+    holds it to save the chunk, as the network thread does its own writes.'''
+
+    def __init__(self, results):
+        super().__init__(name='ChunkConnector', daemon=True)
+        self.jobs = queue.Queue()
+        self.results = results
+
+    def connect(self, interface, chain, base_height, chunk_data):
+        self.jobs.put((interface, chain, base_height, chunk_data))
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            interface, chain, base_height, chunk_data = job
+            try:
+                connect_state = chain.connect_chunk(base_height, chunk_data)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                connect_state = blockchain.CHUNK_BAD
+            count = len(chunk_data) // blockchain.HEADER_SIZE
+            self.results.put((interface, base_height, count, connect_state))
+
+
 class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote electrum
     servers, each connected socket is handled by an Interface() object.
@@ -209,6 +340,10 @@ class Network(util.DaemonThread):
         self.blacklisted_servers = set(self.config.get('server_blacklist', []))
         self.whitelisted_servers, self.whitelisted_servers_hostmap = self._compute_whitelist()
         self.print_error("server blacklist: {} server whitelist: {}".format(self.blacklisted_servers, self.whitelisted_servers))
+        # server -> {'rtt': seconds, 'failures': count, 'version': [software, protocol]}
+        self.server_stats = self.read_server_stats()
+        # Changes are saved by maintain_sockets() now and then, and on stop.
+        self.server_stats_dirty = False
         self.default_server = self.get_config_server()
 
         self.lock = threading.Lock()
@@ -235,6 +370,10 @@ class Network(util.DaemonThread):
         self.relay_fee = None
         # callbacks passed with subscriptions
         self.subscriptions = defaultdict(list)
+        # Scripthash subscriptions, of all wallets and the websocket server:
+        # scripthash (hex, as servers send it) -> _ScripthashRoute.
+        # Guarded by self.lock.
+        self.scripthash_routes = {}
         self.sub_cache = {}                     # note: needs self.interface_lock
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)
@@ -251,6 +390,7 @@ class Network(util.DaemonThread):
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
+        self.server_stats_save_time = time.time()
         # kick off the network.  interface is the main server we are currently
         # communicating with.  interfaces is the set of servers we are connecting
         # to or have an ongoing connection with
@@ -259,7 +399,17 @@ class Network(util.DaemonThread):
         self.auto_connect = self.config.get('auto_connect', DEFAULT_AUTO_CONNECT)
         self.connecting = set()
         self.requested_chunks = set()
-        self.socket_queue = queue.Queue()
+        # With parallel_tx_fetch, transactions and merkle proofs are fetched
+        # from all connected servers (see queue_sharded_fetch())
+        self.parallel_fetch = self.config.get('parallel_tx_fetch', False)
+        self.sharded_fetches = {}               # (method, params) -> _ShardedFetch
+        # Writing to _wakeup_w interrupts wait_on_sockets(), see wakeup().
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.socket_queue = _WakeupQueue(self.wakeup)
+        self.connected_chunks = _WakeupQueue(self.wakeup)
+        self.chunk_connector = _ChunkConnector(self.connected_chunks)
         if Network.INSTANCE:
             # This happens on iOS which kills and restarts the daemon on app sleep/wake
             self.print_error("A new instance has started and is replacing the old one.")
@@ -283,6 +433,25 @@ class Network(util.DaemonThread):
         ''' Returns the extant Network singleton, if any, or None if in offline mode '''
         return Network.INSTANCE
 
+    def wakeup(self):
+        '''Make the network loop run its next iteration now rather than
+        when wait_on_sockets() times out.  Can be called from any thread.'''
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:
+            pass  # Buffer full (a wakeup is already pending) or closed
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def stop(self):
+        super().stop()
+        self.wakeup()
+
     def register_callback(self, callback, events):
         with self.lock:
             for event in events:
@@ -322,6 +491,35 @@ class Network(util.DaemonThread):
         except:
             pass
 
+    def server_stats_file(self):
+        return os.path.join(self.config.path, "server-stats")
+
+    def read_server_stats(self):
+        if not self.config.path:
+            return {}
+        try:
+            with open(self.server_stats_file(), "r", encoding='utf-8') as f:
+                stats = json.loads(f.read())
+            return {server: s for server, s in stats.items() if isinstance(s, dict)}
+        except:
+            return {}
+
+    def save_server_stats(self):
+        self.server_stats_dirty = False
+        self.server_stats_save_time = time.time()
+        if not self.config.path:
+            return
+        s = json.dumps(self.server_stats, indent=4, sort_keys=True)
+        try:
+            with open(self.server_stats_file(), "w", encoding='utf-8') as f:
+                f.write(s)
+        except:
+            pass
+
+    def update_server_stats(self, server, **kwargs):
+        self.server_stats.setdefault(server, {}).update(kwargs)
+        self.server_stats_dirty = True
+
     def get_server_height(self):
         return self.interface.tip if self.interface else 0
 
@@ -349,12 +547,13 @@ class Network(util.DaemonThread):
     def is_up_to_date(self):
         return self.unanswered_requests == {}
 
-    def queue_request(self, method, params, interface=None, *, callback=None, max_qlen=None):
+    def queue_request(self, method, params, interface=None, *, callback=None, max_qlen=None, batch=False, owner=None):
         ''' If you want to queue a request on any interface it must go through
         this function so message ids are properly tracked.
         Returns the monotonically increasing message id for this request.
         May return None if queue is too full (max_qlen).
-        (max_qlen is only considered if callback is not None.)'''
+        (max_qlen is only considered if callback is not None.)
+        batch lets the interface send it in a JSON-RPC batch.'''
         if interface is None:
             interface = self.interface
         assert interface, "queue_request: No interface! (request={} params={})".format(method, params)
@@ -367,7 +566,11 @@ class Network(util.DaemonThread):
             self.unanswered_requests[message_id] = [method, params, callback]
         if self.debug:
             self.print_error(interface.host, "-->", method, params, message_id)
-        interface.queue_request(method, params, message_id)
+        # Requests are shared fairly between the objects (e.g. each wallet's
+        # Synchronizer) whose methods are the callbacks.
+        if owner is None:
+            owner = getattr(callback, '__self__', None)
+        interface.queue_request(method, params, message_id, owner=owner, batch=batch)
         if self is not Network.INSTANCE:
             self.print_error("*** WARNING: queueing request on a stale instance!")
         return message_id
@@ -379,6 +582,13 @@ class Network(util.DaemonThread):
         old_reqs = self.unanswered_requests
         self.unanswered_requests = {}
         for m_id, request in old_reqs.items():
+            fetch = request[2]
+            if isinstance(fetch, _ShardedFetch):
+                if fetch.server in self.interfaces:
+                    self.unanswered_requests[m_id] = request
+                else:
+                    self._send_sharded_fetch(fetch)
+                continue
             message_id = self.queue_request(request[0], request[1], callback = request[2])
             assert message_id is not None
         self.queue_request('server.banner', [])
@@ -387,7 +597,7 @@ class Network(util.DaemonThread):
         self.request_fee_estimates()
         self.queue_request('blockchain.relayfee', [])
         for h in self.subscribed_addresses:
-            self.queue_request('blockchain.scripthash.subscribe', [h])
+            self.queue_request('blockchain.scripthash.subscribe', [h], batch=True)
 
     def request_fee_estimates(self):
         self.config.requested_fee_estimates()
@@ -467,7 +677,7 @@ class Network(util.DaemonThread):
     def start_random_interface(self):
         exclude_set = self.get_unavailable_servers()
         hostmap = self.get_servers() if not self.is_whitelist_only() else self.whitelisted_servers_hostmap
-        server_key = pick_random_server(hostmap, self.protocol, exclude_set)
+        server_key = pick_random_server(hostmap, self.protocol, exclude_set, self.server_stats)
         if server_key:
             self.start_interface(server_key)
 
@@ -517,9 +727,11 @@ class Network(util.DaemonThread):
                 self.close_interface(self.interface)
             assert self.interface is None
             assert not self.interfaces
+            if self.server_stats_dirty:
+                self.save_server_stats()
             self.connecting = set()
             # Get a new queue - no old pending connections thanks!
-            self.socket_queue = queue.Queue()
+            self.socket_queue = _WakeupQueue(self.wakeup)
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
         with self.interface_lock:
@@ -574,7 +786,8 @@ class Network(util.DaemonThread):
         wl_only = self.is_whitelist_only()
         if (not server) or (server in self.blacklisted_servers) or (wl_only and server not in self.whitelisted_servers):
             hostmap = None if not wl_only else self.whitelisted_servers_hostmap
-            server = pick_random_server(hostmap, exclude_set=self.blacklisted_servers)
+            server = pick_random_server(hostmap, exclude_set=self.blacklisted_servers,
+                                        server_stats=self.server_stats)
         return server
 
     def switch_to_random_interface(self):
@@ -631,6 +844,8 @@ class Network(util.DaemonThread):
                 if interface.server == self.default_server:
                     self.interface = None
                 interface.close()
+                if interface.min_rtt is not None:
+                    self.update_server_stats(interface.server, rtt=interface.min_rtt)
 
     def add_recent_server(self, server):
         # list is ordered
@@ -684,29 +899,50 @@ class Network(util.DaemonThread):
         for callback in callbacks:
             callback(response)
 
+    def get_scripthash_address(self, scripthash):
+        '''The address subscribed to as scripthash, if any.'''
+        return self._scripthash_route(scripthash)[1]
+
     def get_index(self, method, params):
         """ hashable index for subscriptions and cache"""
         return str(method) + (':' + str(params[0]) if params else '')
 
+    def _scripthash_route(self, scripthash):
+        '''The callbacks and address of a scripthash's route, as of now.'''
+        with self.lock:
+            route = self.scripthash_routes.get(scripthash)
+            if route is None:
+                return [], None
+            return route.callbacks[:], route.address
+
     def process_responses(self, interface):
         responses = interface.get_responses()
         for request, response in responses:
+            address = None
             if request:
                 method, params, message_id = request
-                k = self.get_index(method, params)
+                if method == 'blockchain.scripthash.subscribe':
+                    k = params[0]
+                    route_callbacks, address = self._scripthash_route(k)
+                else:
+                    k = self.get_index(method, params)
                 # client requests go through self.send() with a
                 # callback, are only sent to the current interface,
                 # and are placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
                 if client_req:
-                    if interface != self.interface:
+                    if isinstance(client_req[2], _ShardedFetch):
+                        if not self.check_sharded_response(interface, client_req[2], response):
+                            continue  # Sent again, elsewhere
+                    elif interface != self.interface:
                         self.print_error(("WARNING: got a 'client' response from an interface '{}' that is not self.interface '{}'"
                                           + " (Probably the default server has been switched). Proceeding gingerly...")
                                          .format(interface, self.interface))
                     callbacks = [client_req[2]]
+                elif method == 'blockchain.scripthash.subscribe':
+                    callbacks = route_callbacks
                 else:
                     # fixme: will only work for subscriptions
-                    k = self.get_index(method, params)
                     callbacks = self.subscriptions.get(k, [])
 
                 # Copy the request method and params to the response
@@ -723,15 +959,20 @@ class Network(util.DaemonThread):
                 # Rewrite response shape to match subscription request response
                 method = response.get('method')
                 params = response.get('params')
-                k = self.get_index(method, params)
-                if method == 'blockchain.headers.subscribe':
-                    response['result'] = params[0]
-                    response['params'] = []
-                elif method == 'blockchain.scripthash.subscribe':
-                    response['params'] = [params[0]]  # addr
+                if method == 'blockchain.scripthash.subscribe':
+                    k = params[0]
+                    callbacks, address = self._scripthash_route(k)
+                    response['params'] = [k]  # addr
                     response['result'] = params[1]
-                callbacks = self.subscriptions.get(k, [])
+                else:
+                    k = self.get_index(method, params)
+                    if method == 'blockchain.headers.subscribe':
+                        response['result'] = params[0]
+                        response['params'] = []
+                    callbacks = self.subscriptions.get(k, [])
 
+            if address is not None:
+                response['address'] = address
             # update cache if it's a subscription
             if method.endswith('.subscribe'):
                 with self.interface_lock:
@@ -739,20 +980,29 @@ class Network(util.DaemonThread):
             # Response is now in canonical form
             self.process_response(interface, request, response, callbacks)
 
-    def subscribe_to_scripthashes(self, scripthashes, callback):
+    def subscribe_to_scripthashes(self, scripthashes, callback, *, addresses=None):
+        '''addresses, if given, are those of the scripthashes.  The address
+        is then added to the responses, as 'address'.'''
+        if addresses is not None:
+            with self.lock:
+                for sh, address in zip(scripthashes, addresses):
+                    self.scripthash_routes.setdefault(sh, _ScripthashRoute()).address = address
         msgs = [('blockchain.scripthash.subscribe', [sh])
                 for sh in scripthashes]
-        self.send(msgs, callback)
+        self.send(msgs, callback, batch=True)
 
     def request_scripthash_history(self, sh, callback):
         self.send([('blockchain.scripthash.get_history', [sh])], callback)
 
-    def send(self, messages, callback):
-        '''Messages is a list of (method, params) tuples'''
+    def send(self, messages, callback, *, batch=False):
+        '''Messages is a list of (method, params) tuples.  With batch, they
+        may be sent in JSON-RPC batches; callback still gets each response
+        on its own.'''
         messages = list(messages)
         if messages: # Guard against empty message-list which is a no-op and just wastes CPU to enque/dequeue (not even callback is called). I've seen the code send empty message lists before in synchronizer.py
             with self.pending_sends_lock:
-                self.pending_sends.append((messages, callback))
+                self.pending_sends.append((messages, callback, batch))
+            self.wakeup()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -764,10 +1014,17 @@ class Network(util.DaemonThread):
             sends = self.pending_sends
             self.pending_sends = []
 
-        for messages, callback in sends:
+        for messages, callback, batch in sends:
             for method, params in messages:
                 r = None
-                if method.endswith('.subscribe'):
+                if method == 'blockchain.scripthash.subscribe':
+                    k = params[0]
+                    with self.lock:
+                        route = self.scripthash_routes.setdefault(k, _ScripthashRoute())
+                        if callback not in route.callbacks:
+                            route.callbacks.append(callback)
+                    r = self.sub_cache.get(k)
+                elif method.endswith('.subscribe'):
                     k = self.get_index(method, params)
                     # add callback to list
                     l = self.subscriptions.get(k, [])
@@ -779,8 +1036,10 @@ class Network(util.DaemonThread):
                 if r is not None:
                     util.print_error("cache hit", k)
                     callback(r)
+                elif self.parallel_fetch and method in self.SHARDED_METHODS:
+                    self.queue_sharded_fetch(method, params, callback, batch)
                 else:
-                    self.queue_request(method, params, callback = callback)
+                    self.queue_request(method, params, callback = callback, batch = batch)
 
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
@@ -791,6 +1050,18 @@ class Network(util.DaemonThread):
             for v in self.subscriptions.values():
                 if callback in v:
                     v.remove(callback)
+            for sh, route in list(self.scripthash_routes.items()):
+                if callback in route.callbacks:
+                    route.callbacks.remove(callback)
+                    if not route.callbacks:
+                        del self.scripthash_routes[sh]
+            # Fetches in flight for it still get their reply, but pass it on
+            # to the others waiting for it only.
+            for fetch in list(self.sharded_fetches.values()):
+                if callback in fetch.callbacks:
+                    fetch.callbacks = [c for c in fetch.callbacks if c != callback]
+                    if not fetch.callbacks:
+                        fetch.owner = None
 
     def connection_down(self, server, blacklist=False):
         '''A connection to server either went down, or was never made.
@@ -807,6 +1078,15 @@ class Network(util.DaemonThread):
         for b in self.blockchains.values():
             if b.catch_up == server:
                 b.catch_up = None
+        # Fetches in flight on another server than the main one go elsewhere.
+        # Those on the main one are sent again by send_subscriptions().
+        if self.interface:
+            for message_id, request in list(self.unanswered_requests.items()):
+                fetch = request[2]
+                if isinstance(fetch, _ShardedFetch) and fetch.server == server:
+                    del self.unanswered_requests[message_id]
+                    fetch.tried.add(server)
+                    self._send_sharded_fetch(fetch)
 
     def new_interface(self, server_key, socket):
         self.add_recent_server(server_key)
@@ -815,6 +1095,7 @@ class Network(util.DaemonThread):
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
+        interface.header_pipeline = _HeaderPipeline()
         interface.set_mode(Interface.MODE_VERIFICATION)
 
         with self.interface_lock:
@@ -839,6 +1120,8 @@ class Network(util.DaemonThread):
             if socket:
                 self.new_interface(server, socket)
             else:
+                failures = self.server_stats.get(server, {}).get('failures', 0)
+                self.update_server_stats(server, failures=failures + 1)
                 self.connection_down(server)
 
         # Send pings and shut down stale interfaces
@@ -852,6 +1135,8 @@ class Network(util.DaemonThread):
                 self.queue_request('server.ping', [], interface)
 
         now = time.time()
+        if self.server_stats_dirty and now - self.server_stats_save_time > SERVER_STATS_SAVE_INTERVAL:
+            self.save_server_stats()
         # nodes
         with self.interface_lock:
             server_count = len(self.interfaces) + len(self.connecting)
@@ -924,6 +1209,8 @@ class Network(util.DaemonThread):
             # Ensure the chunk can be rerequested, but only if the request originated from us.
             if request and request[1][0] // 2016 in self.requested_chunks:
                 self.requested_chunks.remove(request[1][0] // 2016)
+            if request:
+                interface.header_pipeline.requested.discard(request[1][0])
             return
 
         # Ignore unsolicited chunks
@@ -936,6 +1223,11 @@ class Network(util.DaemonThread):
             return
         if index in self.requested_chunks:
             self.requested_chunks.remove(index)
+        pipeline = interface.header_pipeline
+        if request_base_height in pipeline.stale and request_base_height not in pipeline.requested:
+            # requested by a catch-up that has since ended
+            pipeline.stale.remove(request_base_height)
+            return
 
         header_hexsize = 80 * 2
         hexdata = result['hex']
@@ -970,6 +1262,14 @@ class Network(util.DaemonThread):
             self.connection_down(interface.server)
             return
 
+        if not proof_was_provided and request_base_height in pipeline.requested:
+            # Catching up: keep the chunk until those before it are connected
+            pipeline.requested.remove(request_base_height)
+            if actual_header_count:
+                pipeline.chunks[request_base_height] = bfh(hexdata)
+            self.connect_catch_up_chunks(interface)
+            return
+
         verification_top_height = self.checkpoint_servers_verified.get(interface.server, {}).get('height', None)
         was_verification_request = verification_top_height and request_base_height == verification_top_height - 147 + 1 and actual_header_count == 147
 
@@ -1029,13 +1329,71 @@ class Network(util.DaemonThread):
             pass
         else:
             if interface.blockchain.height() < interface.tip:
-                self.request_headers(interface, request_base_height + actual_header_count, 2016)
+                self.start_catch_up_chunks(interface, request_base_height + actual_header_count)
             else:
                 interface.set_mode(Interface.MODE_DEFAULT)
                 interface.print_error('catch up done', interface.blockchain.height())
                 interface.blockchain.catch_up = None
         self.notify('updated')
 
+    def start_catch_up_chunks(self, interface, height):
+        '''Fetch the headers from height up to the interface's tip a chunk
+        at a time, several chunks in flight.'''
+        interface.header_pipeline.start(height)
+        self.request_catch_up_chunks(interface)
+
+    def request_catch_up_chunks(self, interface):
+        pipeline = interface.header_pipeline
+        while (pipeline.active and pipeline.next_request <= interface.tip
+               and len(pipeline.requested) + len(pipeline.chunks) < CATCH_UP_CHUNKS):
+            if not self.request_headers(interface, pipeline.next_request, 2016, silent=True):
+                break
+            pipeline.requested.add(pipeline.next_request)
+            pipeline.next_request += 2016
+
+    def connect_catch_up_chunks(self, interface):
+        '''Hand the next chunk, if it has arrived, to the chunk connector.'''
+        pipeline = interface.header_pipeline
+        if pipeline.connecting is not None or pipeline.next_connect not in pipeline.chunks:
+            return
+        pipeline.connecting = pipeline.next_connect
+        chunk_data = pipeline.chunks.pop(pipeline.connecting)
+        self.chunk_connector.connect(interface, interface.blockchain, pipeline.connecting, chunk_data)
+
+    def process_connected_chunks(self):
+        '''Carry on with the catch-ups whose chunks the connector is done with.'''
+        while not self.connected_chunks.empty():
+            interface, base_height, count, connect_state = self.connected_chunks.get()
+            pipeline = interface.header_pipeline
+            if (self.interfaces.get(interface.server) is not interface
+                    or pipeline.connecting != base_height):
+                continue  # disconnected or no longer catching up
+            pipeline.connecting = None
+            if connect_state == blockchain.CHUNK_ACCEPTED:
+                interface.print_error("connected chunk, height={} count={}".format(base_height, count))
+                pipeline.next_connect = base_height + count
+                if interface.blockchain.height() >= interface.tip:
+                    pipeline.stop()
+                    interface.set_mode(Interface.MODE_DEFAULT)
+                    interface.print_error('catch up done', interface.blockchain.height())
+                    interface.blockchain.catch_up = None
+                else:
+                    if count < 2016:
+                        # Fewer headers than asked for, the tip must have
+                        # moved: carry on from here.
+                        pipeline.start(pipeline.next_connect)
+                    self.request_catch_up_chunks(interface)
+                    self.connect_catch_up_chunks(interface)
+                self.notify('updated')
+            elif connect_state == blockchain.CHUNK_FORKS:
+                # See on_block_headers(): discarded, as is the catch-up.
+                interface.print_error("identified forking chunk, height={} count={}".format(base_height, count))
+                pipeline.stop()
+            else:
+                interface.print_error("discarded bad chunk, height={} count={} reason={}".format(base_height, count, connect_state))
+                pipeline.stop()
+                self.connection_down(interface.server)
+
     def request_header(self, interface, height):
         '''
         This works for all modes except for 'default'.
@@ -1132,49 +1490,53 @@ class Network(util.DaemonThread):
                 self.connection_down(interface.server)
                 next_height = None
             else:
-                branch = self.blockchains.get(interface.bad)
-                if branch is not None:
-                    if branch.check_header(interface.bad_header):
-                        interface.print_error('joining chain', interface.bad)
-                        next_height = None
-                    elif branch.parent().check_header(header):
-                        interface.print_error('reorg', interface.bad, interface.tip)
-                        interface.blockchain = branch.parent()
-                        next_height = None
-                    else:
-                        interface.print_error('checkpoint conflicts with existing fork', branch.path())
-                        branch.write(b'', 0)
-                        branch.save_header(interface.bad_header)
-                        interface.set_mode(Interface.MODE_CATCH_UP)
-                        interface.blockchain = branch
-                        next_height = interface.bad + 1
-                        interface.blockchain.catch_up = interface.server
-                else:
-                    bh = interface.blockchain.height()
-                    next_height = None
-                    if bh > interface.good:
-                        if not interface.blockchain.check_header(interface.bad_header):
-                            b = interface.blockchain.fork(interface.bad_header)
-                            self.blockchains[interface.bad] = b
-                            interface.blockchain = b
-                            interface.print_error("new chain", b.base_height)
+                # The chunk connector thread saves to these chains too.
+                with blockchain.chains_lock:
+                    branch = self.blockchains.get(interface.bad)
+                    if branch is not None:
+                        if branch.check_header(interface.bad_header):
+                            interface.print_error('joining chain', interface.bad)
+                            next_height = None
+                        elif branch.parent().check_header(header):
+                            interface.print_error('reorg', interface.bad, interface.tip)
+                            interface.blockchain = branch.parent()
+                            next_height = None
+                        else:
+                            interface.print_error('checkpoint conflicts with existing fork', branch.path())
+                            branch.write(b'', 0)
+                            branch.save_header(interface.bad_header)
                             interface.set_mode(Interface.MODE_CATCH_UP)
+                            interface.blockchain = branch
                             next_height = interface.bad + 1
                             interface.blockchain.catch_up = interface.server
                     else:
-                        assert bh == interface.good
-                        if interface.blockchain.catch_up is None and bh < interface.tip:
-                            interface.print_error("catching up from %d"% (bh + 1))
-                            interface.set_mode(Interface.MODE_CATCH_UP)
-                            next_height = bh + 1
-                            interface.blockchain.catch_up = interface.server
+                        bh = interface.blockchain.height()
+                        next_height = None
+                        if bh > interface.good:
+                            if not interface.blockchain.check_header(interface.bad_header):
+                                b = interface.blockchain.fork(interface.bad_header)
+                                self.blockchains[interface.bad] = b
+                                interface.blockchain = b
+                                interface.print_error("new chain", b.base_height)
+                                interface.set_mode(Interface.MODE_CATCH_UP)
+                                next_height = interface.bad + 1
+                                interface.blockchain.catch_up = interface.server
+                        else:
+                            assert bh == interface.good
+                            if interface.blockchain.catch_up is None and bh < interface.tip:
+                                interface.print_error("catching up from %d"% (bh + 1))
+                                interface.set_mode(Interface.MODE_CATCH_UP)
+                                next_height = bh + 1
+                                interface.blockchain.catch_up = interface.server
 
                 self.notify('updated')
 
         elif interface.mode == Interface.MODE_CATCH_UP:
-            can_connect = interface.blockchain.can_connect(header)
+            with blockchain.chains_lock:
+                can_connect = interface.blockchain.can_connect(header)
+                if can_connect:
+                    interface.blockchain.save_header(header)
             if can_connect:
-                interface.blockchain.save_header(header)
                 next_height = height + 1 if height < interface.tip else None
             else:
                 # go back
@@ -1197,7 +1559,7 @@ class Network(util.DaemonThread):
         # If not finished, get the next header
         if next_height:
             if interface.mode == Interface.MODE_CATCH_UP and interface.tip > next_height:
-                self.request_headers(interface, next_height, 2016)
+                self.start_catch_up_chunks(interface, next_height)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -1235,17 +1597,15 @@ class Network(util.DaemonThread):
             self.print_error("wait_on_sockets: {} raised by select() call.. trying to recover...".format(err))
             self.find_bad_fds_and_kill()
 
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
-            return
         with self.interface_lock:
             interfaces = list(self.interfaces.values())
             rin = [i for i in interfaces if i.fileno() > -1]
             win = [i for i in interfaces if i.num_requests() and i.fileno() > -1]
+        # The wakeup socket also keeps the select non-empty, which Windows
+        # requires.
+        rin.append(self._wakeup_r)
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
+            rout, wout, xout = select.select(rin, win, [], LOOP_IDLE_TIMEOUT)
         except socket.error as e:
             code = None
             if isinstance(e, OSError): # Should always be the case unless ancient python3
@@ -1266,6 +1626,9 @@ class Network(util.DaemonThread):
             return # calling loop will try again later
 
         assert not xout
+        if self._wakeup_r in rout:
+            rout.remove(self._wakeup_r)
+            self._drain_wakeups()
         for interface in wout:
             interface.send_requests()
         for interface in rout:
@@ -1276,10 +1639,12 @@ class Network(util.DaemonThread):
         filename = b.path()
         length = 80 * (networks.net.VERIFICATION_BLOCK_HEIGHT + 1)
         if not os.path.exists(filename) or os.path.getsize(filename) < length:
-            with open(filename, 'wb') as f:
-                if length>0:
-                    f.seek(length-1)
-                    f.write(b'\x00')
+            with b.lock:
+                b.close_headers_map()
+                with open(filename, 'wb') as f:
+                    if length>0:
+                        f.seek(length-1)
+                        f.write(b'\x00')
         util.ensure_sparse_file(filename)
         with b.lock:
             b.update_size()
@@ -1293,18 +1658,26 @@ class Network(util.DaemonThread):
         if header is not None:
             self.verified_checkpoint = True
 
+        self.chunk_connector.start()
         while self.is_running():
             self.maintain_sockets()
             self.wait_on_sockets()
+            self.process_connected_chunks()
             self.maintain_requests()
             if self.verified_checkpoint:
                 self.run_jobs()    # Synchronizer and Verifier and Fx
             self.process_pending_sends()
         self.stop_network()
+        self.chunk_connector.stop()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
         self.on_stop()
 
     def on_server_version(self, interface, version_data):
         interface.server_version = version_data
+        # The first round trip, so the time to connect to the server
+        self.update_server_stats(interface.server, rtt=interface.min_rtt,
+                                 failures=0, version=version_data)
 
     def on_notify_header(self, interface, header_dict):
         '''
@@ -1345,17 +1718,15 @@ class Network(util.DaemonThread):
         header = interface.tip_header
         height = interface.tip
 
-        b = blockchain.check_header(header) # Does it match the hash of a known header.
-        if b:
-            interface.blockchain = b
-            self.switch_lagging_interface()
-            self.notify('updated')
-            self.notify('interfaces')
-            return
-        b = blockchain.can_connect(header) # Is it the next header on a given blockchain.
+        # The chunk connector thread may be saving to the same chain.
+        with blockchain.chains_lock:
+            b = blockchain.check_header(header) # Does it match the hash of a known header.
+            if not b:
+                b = blockchain.can_connect(header) # Is it the next header on a given blockchain.
+                if b:
+                    b.save_header(header)
         if b:
             interface.blockchain = b
-            b.save_header(header)
             self.switch_lagging_interface()
             self.notify('updated')
             self.notify('interfaces')
@@ -1473,7 +1844,9 @@ class Network(util.DaemonThread):
 
     def get_blockchains(self):
         out = {}
-        for k, b in self.blockchains.items():
+        with blockchain.chains_lock:
+            chains = list(self.blockchains.items())
+        for k, b in chains:
             r = list(filter(lambda i: i.blockchain==b, list(self.interfaces.values())))
             if r:
                 out[k] = r
@@ -1672,12 +2045,91 @@ class Network(util.DaemonThread):
         return _("An error occurred broadcasting the transaction")
 
     # Used by the verifier job.
-    def get_merkle_for_transaction(self, tx_hash, tx_height, callback, max_qlen=10):
+    SHARDED_METHODS = ('blockchain.transaction.get', 'blockchain.transaction.get_merkle')
+
+    def queue_sharded_fetch(self, method, params, callback, batch=False):
+        '''Queue a request for a raw transaction or merkle proof on the least
+        busy connected server able to answer it.  Requests already in flight
+        are not sent twice; callback just waits for the same response.
+        Returns the message id.'''
+        key = (method, tuple(params))
+        fetch = self.sharded_fetches.get(key)
+        if fetch is not None:
+            if callback not in fetch.callbacks:
+                fetch.callbacks.append(callback)
+            return fetch.message_id
+        fetch = self.sharded_fetches[key] = _ShardedFetch(key, callback, getattr(callback, '__self__', None))
+        return self._send_sharded_fetch(fetch, batch)
+
+    def _pick_fetch_interface(self, fetch):
+        '''The least busy interface that can answer fetch and has not failed
+        it, or None.  Merkle proofs only come from servers following our
+        chain, at least up to the transaction's height.'''
+        method, params = fetch.key
+        main = self.interface
+        with self.interface_lock:
+            interfaces = list(self.interfaces.values())
+        candidates = [i for i in interfaces
+                      if i.server not in fetch.tried
+                      and (method == 'blockchain.transaction.get'
+                           or i is main
+                           or (main and i.blockchain is main.blockchain and i.tip >= params[1]))]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda i: len(i.unanswered_requests) + i.num_unsent)
+
+    def _send_sharded_fetch(self, fetch, batch=False):
+        interface = self._pick_fetch_interface(fetch) or self.interface
+        method, params = fetch.key
+        if interface is None:
+            # Nowhere to send it while reconnecting: it waits with the
+            # unanswered requests, which send_subscriptions() sends again.
+            fetch.server = None
+            fetch.message_id = self.message_id
+            self.message_id += 1
+            self.unanswered_requests[fetch.message_id] = [method, list(params), fetch]
+            return fetch.message_id
+        fetch.server = interface.server
+        fetch.message_id = self.queue_request(method, list(params), interface, callback=fetch,
+                                              batch=batch, owner=fetch.owner)
+        return fetch.message_id
+
+    def check_sharded_response(self, interface, fetch, response):
+        '''Returns True if response should be passed on to the callbacks of
+        fetch.  Raw transactions must hash to the requested txid; a server
+        that sends anything else is blacklisted.  Errors are retried on
+        other servers before being passed on.'''
+        method, params = fetch.key
+        error = response.get('error')
+        if error is None and method == 'blockchain.transaction.get':
+            try:
+                ok = hash_encode(Hash(bfh(response.get('result')))) == params[0]
+            except (TypeError, ValueError):
+                ok = False
+            if not ok:
+                interface.print_error("disconnecting server for sending a transaction not matching its txid", params[0])
+                error = response['error'] = 'transaction does not match its txid'
+                response.pop('result', None)
+                self.connection_down(interface.server, blacklist=True)
+        if error is not None:
+            fetch.tried.add(interface.server)
+            if self.interface and self._pick_fetch_interface(fetch):
+                self._send_sharded_fetch(fetch)
+                return False
+        del self.sharded_fetches[fetch.key]
+        return True
+
+    def get_merkle_for_transaction(self, tx_hash, tx_height, callback, max_qlen=None):
         ''' Asynchronously enqueue a request for a merkle proof for a tx.
             Note that the callback param is required.
             May return None if too many requests were enqueued (max_qlen) or
             if there is no interface.
-            Client code should handle the None return case appropriately. '''
+            Client code should handle the None return case appropriately.
+            Merkle proofs are the interface's lowest priority requests, so
+            they need no max_qlen to keep out of the way of other traffic. '''
+        if self.parallel_fetch and not max_qlen:
+            return self.queue_sharded_fetch('blockchain.transaction.get_merkle',
+                                            [tx_hash, tx_height], callback)
         return self.queue_request('blockchain.transaction.get_merkle',
                                   [tx_hash, tx_height],
                                   callback=callback, max_qlen=max_qlen)
@@ -29,8 +29,10 @@ import json
 import copy
 import re
 import stat
+import types
 import hmac, hashlib
 import base64
+import sqlite3
 import zlib
 
 from .address import Address
@@ -49,6 +51,24 @@ FINAL_SEED_VERSION = 17     # electrum >= 2.7 will set this to prevent
 
 TMP_SUFFIX = ".tmp.{}".format(os.getpid())
 
+STO_JSON = 'json'       # whole wallet as one (possibly encrypted) JSON document
+STO_SQLITE = 'sqlite'   # one row per key, and per entry for RECORD_KEYS
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# Large, growing maps that the sqlite format stores one entry per row, so
+# that a save only touches the entries that changed since the last one.
+RECORD_KEYS = ('transactions', 'txi', 'txo', 'tx_fees', 'pruned_txo',
+               'addr_history', 'verified_tx3', 'labels')
+
+
+def is_sqlite_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
 
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
@@ -87,7 +107,27 @@ class WalletStorage(PrintError):
         self._file_exists = self.realpath and os.path.exists(self.realpath)
         self.modified = False
         self.pubkey = None
+        self.raw = None
+        self.storage_format = STO_JSON
+        # sqlite format state: the keys put() since the last write, the
+        # values as they were last written (None if the file on disk is
+        # not an up to date sqlite database), the pubkey the file is
+        # encrypted to, the record encryption/identifier/MAC keys, and in
+        # an encrypted file the MACs of its rows and its write counter.
+        self._dirty_keys = set()
+        self._saved = None
+        self._db_pubkey = None
+        self._db_encrypted_key = None
+        self._db_keys = None
+        self._db_row_macs = {}
+        self._db_counter = 0
         if self.file_exists():
+            if is_sqlite_file(self.realpath):
+                self.storage_format = STO_SQLITE
+                self._db_encrypted_key = self._db_read_meta().get('encrypted_key')
+                if not self.is_encrypted():
+                    self._db_load()
+                return
             try:
                 with open(self.realpath, "r", encoding='utf-8') as f:
                     self.raw = f.read()
@@ -120,7 +160,9 @@ class WalletStorage(PrintError):
                     self.print_error('Failed to convert label to json format', key)
                     continue
                 self.data[key] = value
+        self._data_loaded()
 
+    def _data_loaded(self):
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -133,6 +175,8 @@ class WalletStorage(PrintError):
                 self.upgrade()
 
     def is_encrypted(self):
+        if self.storage_format == STO_SQLITE:
+            return bool(self._db_encrypted_key)
         try:
             return base64.b64decode(self.raw)[0:4] == b'BIE1'
         except:
@@ -148,6 +192,11 @@ class WalletStorage(PrintError):
 
     def decrypt(self, password):
         ec_key = self.get_key(password)
+        if self.storage_format == STO_SQLITE:
+            self._set_db_key(ec_key.decrypt_message(self._db_encrypted_key))
+            self.pubkey = self._db_pubkey = ec_key.get_public_key()
+            self._db_load()
+            return
         s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
         self.pubkey = ec_key.get_public_key()
         s = s.decode('utf8')
@@ -161,6 +210,17 @@ class WalletStorage(PrintError):
         else:
             self.pubkey = None
 
+    def set_storage_format(self, storage_format):
+        '''Select the format used by the next write().  Switching format
+        rewrites the whole file; the encryption setting is kept.'''
+        if storage_format not in (STO_JSON, STO_SQLITE):
+            raise ValueError('unknown storage format: {}'.format(storage_format))
+        with self.lock:
+            if storage_format != self.storage_format:
+                self.storage_format = storage_format
+                self._saved = None
+                self.modified = True
+
     def get(self, key, default=None):
         with self.lock:
             v = self.data.get(key)
@@ -170,10 +230,21 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def peek(self, key, default=None):
+        '''Like get(), but return the stored value itself instead of a deep
+        copy.  The caller must not modify it or anything it contains; top
+        level dicts are returned as read-only views.'''
+        with self.lock:
+            v = self.data.get(key)
+        if v is None:
+            return default
+        if isinstance(v, dict):
+            return types.MappingProxyType(v)
+        return v
+
     def put(self, key, value):
         try:
-            json.dumps(key)
-            json.dumps(value)
+            json.dumps([key, value])
         except:
             self.print_error("json error: cannot save", key)
             return
@@ -181,11 +252,30 @@ class WalletStorage(PrintError):
             if value is not None:
                 if self.data.get(key) != value:
                     self.modified = True
+                    self._dirty_keys.add(key)
                     self.data[key] = copy.deepcopy(value)
             elif key in self.data:
                 self.modified = True
+                self._dirty_keys.add(key)
                 self.data.pop(key)
 
+    def put_owned(self, key, value):
+        '''Like put(), but take ownership of value instead of validating and
+        copying it.  value must be JSON serializable and must never be
+        modified afterwards, by the caller or anyone else.  It may share
+        unchanged (and equally never modified) members with the value
+        previously put, which makes the comparison with it cheap and lets
+        the sqlite format skip rewriting them.'''
+        if value is None:
+            self.put(key, None)
+            return
+        with self.lock:
+            old = self.data.get(key)
+            if old is not value and old != value:
+                self.modified = True
+                self._dirty_keys.add(key)
+                self.data[key] = value
+
     @profiler
     def write(self):
         with self.lock:
@@ -197,6 +287,16 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
+        if self.storage_format == STO_SQLITE:
+            self._write_sqlite()
+        else:
+            self._write_json()
+        self._file_exists = True
+        self._dirty_keys.clear()
+        self.print_error("saved", self.path)
+        self.modified = False
+
+    def _write_json(self):
         s = json.dumps(self.data, indent=4, sort_keys=True)
         if self.pubkey:
             s = bytes(s, 'utf8')
@@ -209,7 +309,12 @@ class WalletStorage(PrintError):
             f.write(s)
             f.flush()
             os.fsync(f.fileno())
+        self._replace_file(temp_path)
+        self.raw = s
+        self._saved = None
+        self._db_encrypted_key = None
 
+    def _replace_file(self, temp_path):
         mode = os.stat(self.realpath).st_mode if self.file_exists() else stat.S_IREAD | stat.S_IWRITE
         if not self.file_exists():
             # See: https://github.com/spesmilo/electrum/issues/5082
@@ -221,10 +326,208 @@ class WalletStorage(PrintError):
             os.remove(self.realpath)
             os.rename(temp_path, self.realpath)
         os.chmod(self.realpath, mode)
-        self.raw = s
-        self._file_exists = True
-        self.print_error("saved", self.path)
-        self.modified = False
+
+    # --- sqlite format ---
+    #
+    # Table kv holds one row per top level key.  RECORD_KEYS whose value is
+    # a dict get a marker row (is_table = 1) in kv and one row per entry in
+    # table records.  Row data is the JSON of a [name, value] pair.  In an
+    # encrypted file the row ids are HMACs of the names and the data is
+    # zlib compressed and AES encrypted, then followed by an HMAC of the row
+    # id and the ciphertext, which is checked before decrypting.  So that
+    # rows cannot be dropped or rolled back one by one either, meta holds a
+    # write counter and an HMAC of it and of the sorted (row id, row MAC)
+    # list, checked on loading.  The keys are derived from a random secret
+    # that is stored ECIES-encrypted to self.pubkey in table meta.
+
+    def _set_db_key(self, secret):
+        if secret is None:
+            self._db_keys = None
+        else:
+            k = hashlib.sha512(secret).digest()
+            self._db_keys = k[:32], k[32:], hmac.new(secret, b'record mac', hashlib.sha256).digest()
+
+    def _db_ident(self, name):
+        if self._db_keys is None:
+            return name
+        return hmac.new(self._db_keys[1], name.encode('utf8'), hashlib.sha256).hexdigest()
+
+    def _db_mac(self, row_id, data):
+        return hmac.new(self._db_keys[2], row_id.encode('utf8') + data, hashlib.sha256).digest()
+
+    def _db_rows_mac(self, counter):
+        h = hmac.new(self._db_keys[2], b'rows %d' % counter, hashlib.sha256)
+        for row_id in sorted(self._db_row_macs):
+            h.update(row_id.encode('utf8') + self._db_row_macs[row_id])
+        return h.hexdigest()
+
+    def _db_write_rows_mac(self, conn):
+        if self._db_keys is None:
+            return
+        self._db_counter += 1
+        conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         (('counter', str(self._db_counter)),
+                          ('mac', self._db_rows_mac(self._db_counter))))
+
+    def _db_auth_error(self):
+        return IOError("Cannot read wallet file '{}': it failed authentication".format(self.path))
+
+    def _db_forget_records(self, table_id):
+        for row_id in [r for r in self._db_row_macs
+                       if len(r) > len(table_id) and r.startswith(table_id)]:
+            del self._db_row_macs[row_id]
+
+    def _db_encode(self, row_id, name, value):
+        s = json.dumps([name, value])
+        if self._db_keys is None:
+            return s
+        data = bitcoin.EncodeAES_bytes(self._db_keys[0], zlib.compress(s.encode('utf8')))
+        mac = self._db_row_macs[row_id] = self._db_mac(row_id, data)
+        return data + mac
+
+    def _db_decode(self, row_id, data):
+        if self._db_keys is not None:
+            data, mac = data[:-32], data[-32:]
+            if not hmac.compare_digest(mac, self._db_mac(row_id, data)):
+                raise self._db_auth_error()
+            self._db_row_macs[row_id] = mac
+            data = bitcoin.aes_decrypt_with_iv(self._db_keys[0], data[:16], data[16:])
+            data = zlib.decompress(data).decode('utf8')
+        return json.loads(data)
+
+    def _db_read_meta(self):
+        conn = sqlite3.connect(self.realpath)
+        try:
+            return dict(conn.execute('SELECT name, value FROM meta'))
+        except sqlite3.DatabaseError as e:
+            raise IOError("Cannot read wallet file '{}': {}".format(self.path, e))
+        finally:
+            conn.close()
+
+    def _db_load(self):
+        data = {}
+        tables = {}
+        self._db_row_macs = {}
+        conn = sqlite3.connect(self.realpath)
+        try:
+            meta = dict(conn.execute('SELECT name, value FROM meta'))
+            for ident, is_table, row in conn.execute('SELECT id, is_table, data FROM kv'):
+                name, value = self._db_decode(ident, row)
+                if is_table:
+                    value = tables[ident] = {}
+                data[name] = value
+            for table_id, ident, row in conn.execute('SELECT table_id, id, data FROM records'):
+                table = tables.get(table_id)
+                if table is not None:
+                    k, v = self._db_decode(table_id + ident, row)
+                    table[k] = v
+        except sqlite3.DatabaseError as e:
+            raise IOError("Cannot read wallet file '{}': {}".format(self.path, e))
+        finally:
+            conn.close()
+        if self._db_keys is not None:
+            try:
+                counter = int(meta['counter'])
+            except (KeyError, ValueError):
+                raise self._db_auth_error()
+            if not hmac.compare_digest(meta.get('mac', ''), self._db_rows_mac(counter)):
+                raise self._db_auth_error()
+            self._db_counter = counter
+        self.data = data
+        self._saved = dict(data)
+        self._data_loaded()
+
+    def _write_sqlite(self):
+        if self._saved is None or self.pubkey != self._db_pubkey:
+            self._db_rewrite()
+            return
+        conn = sqlite3.connect(self.realpath)
+        try:
+            with conn:
+                for key in self._dirty_keys:
+                    self._db_update_key(conn, key, self._saved.get(key), self.data.get(key))
+                self._db_write_rows_mac(conn)
+        finally:
+            conn.close()
+        for key in self._dirty_keys:
+            if key in self.data:
+                self._saved[key] = self.data[key]
+            else:
+                self._saved.pop(key, None)
+
+    def _db_rewrite(self):
+        '''Write a complete new database next to the wallet file, then
+        atomically move it into place.'''
+        temp_path = self.realpath + TMP_SUFFIX
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        encrypted_key = None
+        if self.pubkey:
+            secret = os.urandom(32)
+            encrypted_key = bitcoin.encrypt_message(secret, self.pubkey).decode('ascii')
+            self._set_db_key(secret)
+        else:
+            self._set_db_key(None)
+        self._db_row_macs = {}
+        conn = sqlite3.connect(temp_path)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+                conn.execute('CREATE TABLE kv (id TEXT PRIMARY KEY, '
+                             'is_table INTEGER NOT NULL, data BLOB)')
+                conn.execute('CREATE TABLE records (table_id TEXT, id TEXT, data BLOB, '
+                             'PRIMARY KEY (table_id, id)) WITHOUT ROWID')
+                conn.execute('INSERT INTO meta VALUES (?, ?)', ('version', '1'))
+                if encrypted_key:
+                    conn.execute('INSERT INTO meta VALUES (?, ?)', ('encrypted_key', encrypted_key))
+                for key, value in self.data.items():
+                    self._db_update_key(conn, key, None, value)
+                self._db_write_rows_mac(conn)
+        finally:
+            conn.close()
+        self._replace_file(temp_path)
+        self.raw = None
+        self._saved = dict(self.data)
+        self._db_pubkey = self.pubkey
+        self._db_encrypted_key = encrypted_key
+
+    def _db_update_key(self, conn, key, old, new):
+        '''Bring the rows of key from value old (as last written) to new.
+        put() and put_owned() replace values rather than mutating them, so
+        entries of a record table that compare equal need not be
+        rewritten.'''
+        ident = self._db_ident(key)
+        was_table = key in RECORD_KEYS and isinstance(old, dict)
+        is_table = key in RECORD_KEYS and isinstance(new, dict)
+        if was_table and not is_table:
+            conn.execute('DELETE FROM records WHERE table_id = ?', (ident,))
+            self._db_forget_records(ident)
+        if new is None:
+            conn.execute('DELETE FROM kv WHERE id = ?', (ident,))
+            self._db_row_macs.pop(ident, None)
+            return
+        if not is_table:
+            conn.execute('INSERT OR REPLACE INTO kv VALUES (?, 0, ?)',
+                         (ident, self._db_encode(ident, key, new)))
+            return
+        if not was_table:
+            old = {}
+            conn.execute('INSERT OR REPLACE INTO kv VALUES (?, 1, ?)',
+                         (ident, self._db_encode(ident, key, None)))
+        missing = object()
+        def changed(k, v):
+            o = old.get(k, missing)
+            return o is not v and o != v
+        def record(k, v):
+            record_id = self._db_ident(str(k))
+            return ident, record_id, self._db_encode(ident + record_id, k, v)
+        conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?)',
+                         (record(k, v) for k, v in new.items() if changed(k, v)))
+        removed = [self._db_ident(str(k)) for k in old.keys() - new.keys()]
+        conn.executemany('DELETE FROM records WHERE table_id = ? AND id = ?',
+                         ((ident, record_id) for record_id in removed))
+        for record_id in removed:
+            self._db_row_macs.pop(ident + record_id, None)
 
     def requires_split(self):
         d = self.get('accounts', {})
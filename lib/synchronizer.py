@@ -53,7 +53,6 @@ class Synchronizer(ThreadJob):
         self.requested_tx = {}
         self.requested_histories = {}
         self.requested_hashes = set()
-        self.h2addr = {}
         self.lock = Lock()
         self.initialize()
 
@@ -78,15 +77,19 @@ class Synchronizer(ThreadJob):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.network.wakeup()
 
     def subscribe_to_addresses(self, addresses):
         hashes = [addr.to_scripthash_hex() for addr in addresses]
-        # Keep a hash -> address mapping
-        self.h2addr.update({h:addr for h, addr in zip(hashes, addresses)})
-        self.network.subscribe_to_scripthashes(hashes, self.on_address_status)
+        # The network keeps the hash -> address mapping
+        self.network.subscribe_to_scripthashes(hashes, self.on_address_status,
+                                               addresses=addresses)
         self.requested_hashes |= set(hashes)
 
-    def get_status(self, h):
+    @staticmethod
+    def get_status(h):
+        '''The Electrum protocol status of an address history: None if
+        it is empty.'''
         if not h:
             return None
         status = ''
@@ -99,11 +102,10 @@ class Synchronizer(ThreadJob):
         if error:
             return
         scripthash = params[0]
-        addr = self.h2addr.get(scripthash, None)
+        addr = response.get('address')
         if not addr:
             return  # Bad server response?
-        history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        if self.wallet.get_address_status(addr) != result:
             if self.requested_histories.get(scripthash) is None:
                 self.requested_histories[scripthash] = result
                 self.network.request_scripthash_history(scripthash,
@@ -116,7 +118,7 @@ class Synchronizer(ThreadJob):
         if error:
             return
         scripthash = params[0]
-        addr = self.h2addr.get(scripthash, None)
+        addr = self.network.get_scripthash_address(scripthash)
         if not addr or not scripthash in self.requested_histories:
             return  # Bad server response?
         self.print_error("receiving history {} {}".format(addr, len(result)))
@@ -139,7 +141,8 @@ class Synchronizer(ThreadJob):
             self.print_error("error: status mismatch: {}".format(addr))
         else:
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees,
+                                                 status=server_status)
             # Request transactions we don't have
             self.request_missing_txs(hist)
 
@@ -187,7 +190,7 @@ class Synchronizer(ThreadJob):
                 continue
             requests.append(('blockchain.transaction.get', [tx_hash]))
             self.requested_tx[tx_hash] = tx_height
-        self.network.send(requests, self.tx_response)
+        self.network.send(requests, self.tx_response, batch=True)
 
 
     def initialize(self):
@@ -3,16 +3,18 @@ import unittest
 import sys
 from ecdsa.util import number_to_string
 
+from .. import ecc_fast
 from ..address import Address
 from ..bitcoin import (
     generator_secp256k1, point_to_ser, public_key_to_p2pkh, EC_KEY,
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
     is_private_key, xpub_from_xprv, is_new_seed, is_old_seed,
-    var_int, op_push, regenerate_key,
+    var_int, var_int_bytes, int_to_hex, op_push, regenerate_key,
     verify_message, deserialize_privkey, serialize_privkey,
     is_minikey, is_compressed, is_xpub,
-    xpub_type, is_xprv, is_bip32_derivation, seed_type)
+    xpub_type, is_xprv, is_bip32_derivation, seed_type,
+    deserialize_xpub, CKD_pub, CKD_pubs)
 from ..networks import set_mainnet, set_testnet
 from ..util import bfh
 
@@ -134,6 +136,15 @@ class Test_bitcoin(unittest.TestCase):
         self.assertEqual(var_int(0x100000000), "ff0000000001000000")
         self.assertEqual(var_int(0x0123456789abcdef), "ffefcdab8967452301")
 
+    def test_var_int_bytes(self):
+        for i in (0, 0xfc, 0xfd, 0xffff, 0x10000, 0xffffffff, 0x100000000, 0x0123456789abcdef):
+            self.assertEqual(var_int(i), var_int_bytes(i).hex())
+
+    def test_int_to_hex(self):
+        self.assertEqual(int_to_hex(1, 4), "01000000")
+        self.assertEqual(int_to_hex(0xfeffffff, 4), "fffffffe")
+        self.assertEqual(int_to_hex(0x1234), "3412")  # too long, as before
+
     def test_op_push(self):
         self.assertEqual(op_push(0x00), '00')
         self.assertEqual(op_push(0x12), '12')
@@ -197,6 +208,21 @@ class Test_xprv_xpub(unittest.TestCase):
         self.assertEqual("xpub6FnCn6nSzZAw5Tw7cgR9bi15UV96gLZhjDstkXXxvCLsUXBGXPdSnLFbdpq8p9HmGsApME5hQTZ3emM2rnY5agb9rXpVGyy3bdW6EEgAtqt", xpub)
         self.assertEqual("xprvA2nrNbFZABcdryreWet9Ea4LvTJcGsqrMzxHx98MMrotbir7yrKCEXw7nadnHM8Dq38EGfSh6dqA9QWTyefMLEcBYJUuekgW4BYPJcr9E7j", xprv)
 
+    def test_CKD_pubs(self):
+        _, _, _, _, c, cK = deserialize_xpub(self.xprv_xpub[0]['xpub'])
+        indices = [0, 1, 7, 2**31 - 1]
+        expected = [CKD_pub(cK, c, n)[0] for n in indices]
+        self.assertEqual(CKD_pubs(cK, c, indices), expected)
+        self.assertEqual(CKD_pubs(cK, c, []), [])
+        # the same without libsecp256k1, if it was in use
+        fast = ecc_fast.is_using_fast_ecc()
+        ecc_fast.undo_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+        try:
+            self.assertEqual(CKD_pubs(cK, c, indices), expected)
+        finally:
+            if fast:
+                ecc_fast.do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
         for xprv_details in self.xprv_xpub:
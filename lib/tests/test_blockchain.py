@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 from .. import blockchain as bc
 
@@ -74,3 +77,111 @@ class TestBlockchain(unittest.TestCase):
         # MTP(1010) is TimeStamp(1005), MTP(1004) is TimeStamp(999)
         hdr = {'block_height': block['block_height'] + 1}
         self.assertEqual(chain.get_bits(hdr, chunk), 0x1801b553)
+
+    def test_daa_window(self):
+        # Compare get_bits() through a carried HeaderWindow with the DAA
+        # computed header by header from read_header().
+        def reference_bits(chain, height, chunk):
+            prevheight = height - 1
+            start = chain.get_suitable_block_height(prevheight - 144, chunk)
+            end = chain.get_suitable_block_height(prevheight, chunk)
+            work = sum(bc.bits_to_work(chain.read_header(h, chunk)['bits'])
+                       for h in range(start + 1, end + 1))
+            elapsed = (chain.read_header(end, chunk)['timestamp']
+                       - chain.read_header(start, chunk)['timestamp'])
+            elapsed = min(max(elapsed, 43200), 172800)
+            return bc.target_to_bits((1 << 256) // (work * 600 // elapsed) - 1)
+
+        z = '00' * 32
+        blocks = [{'version': 4, 'prev_block_hash': z, 'merkle_root': z,
+                   'timestamp': 1520000000, 'bits': 0x18015ddc, 'nonce': 0,
+                   'block_height': 0}]
+        for n in range(1, 800):
+            # irregular intervals, some going back in time
+            interval = (n * 7919) % 1500 - 200
+            blocks.append(get_block(blocks[-1], interval, 0x18015ddc))
+        chunk_bytes = b''.join(bytes.fromhex(bc.serialize_header(b)) for b in blocks)
+        chunk = bc.HeaderChunk(0, chunk_bytes)
+        chain = MyBlockchain()
+
+        window = chain.read_window(150 - bc.DAA_WINDOW, 149, chunk)
+        for block in blocks[150:]:
+            expected = reference_bits(chain, block['block_height'], chunk)
+            self.assertEqual(expected, chain.get_bits(block, chunk, window))
+            self.assertEqual(expected, chain.get_bits(block, chunk))
+            window.append(block)
+        self.assertLess(window.top_height() - window.base_height, 4 * bc.DAA_WINDOW)
+
+
+class FakeConfig:
+
+    def __init__(self, path):
+        self.path = path
+
+
+class TestHeaderFile(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.user_dir, 'forks'))
+        self.saved_blockchains = dict(bc.blockchains)
+        bc.blockchains.clear()
+
+    def tearDown(self):
+        bc.blockchains.clear()
+        bc.blockchains.update(self.saved_blockchains)
+        shutil.rmtree(self.user_dir)
+
+    def make_headers(self, prior, count, nonce=0):
+        headers = [prior]
+        for n in range(count):
+            header = get_block(headers[-1], 600, prior['bits'])
+            header['nonce'] = nonce
+            headers.append(header)
+        return headers[1:]
+
+    def test_read_after_write_and_swap(self):
+        z = '00' * 32
+        genesis = {'version': 1, 'prev_block_hash': z, 'merkle_root': z,
+                   'timestamp': 1231006505, 'bits': bc.MAX_BITS, 'nonce': 0,
+                   'block_height': 0}
+        config = FakeConfig(self.user_dir)
+        open(os.path.join(self.user_dir, 'blockchain_headers'), 'w').close()
+        main = bc.blockchains[0] = bc.Blockchain(config, 0, None)
+        headers = [genesis] + self.make_headers(genesis, 9)
+        for header in headers[:5]:
+            main.save_header(header)
+        self.assertEqual(headers[4], main.read_header(4))
+        self.assertIsNone(main.read_header(5))
+        # headers written after the file was mapped are seen
+        for header in headers[5:]:
+            main.save_header(header)
+        self.assertEqual(headers[9], main.read_header(9))
+        self.assertEqual(bc.hash_header(headers[7]), main.get_hash(7))
+
+        # a fork at height 6 that overtakes the main chain gets swapped in
+        fork_headers = self.make_headers(headers[5], 6, nonce=1)
+        fork = main.fork(fork_headers[0])
+        bc.blockchains[fork.base_height] = fork
+        self.assertEqual(bc.hash_header(headers[6]), main.get_hash(6))
+        self.assertEqual(bc.hash_header(fork_headers[0]), fork.get_hash(6))
+        for header in fork_headers[1:]:
+            fork.save_header(header)
+        self.assertEqual(0, fork.base_height)
+        self.assertEqual(11, fork.height())
+        self.assertEqual(fork_headers[-1], fork.read_header(11))
+        self.assertEqual(bc.hash_header(fork_headers[1]), fork.get_hash(7))
+        self.assertEqual(bc.hash_header(headers[7]), main.get_hash(7))
+        self.assertEqual(headers[2], main.read_header(2))
+
+        # truncating write
+        fork.write(bc.bfh(bc.serialize_header(headers[6])), 6 * bc.HEADER_SIZE)
+        self.assertEqual(6, fork.height())
+        self.assertEqual(headers[6], fork.read_header(6))
+        self.assertIsNone(fork.read_header(7))
+
+        # headers handed out are copies of the cached ones
+        header = fork.read_header(6)
+        header['nonce'] = 12345
+        self.assertEqual(headers[6], fork.read_header(6))
+        self.assertEqual(bc.hash_header(headers[6]), fork.get_hash(6))
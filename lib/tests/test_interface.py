@@ -1,3 +1,5 @@
+import json
+import socket
 import unittest
 
 from .. import interface
@@ -24,3 +26,108 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+
+class TestRequestScheduling(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.interface = interface.Interface('localhost:1:t', self.ours)
+        self.theirs.settimeout(1)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def sent(self):
+        data = b''
+        while not data.endswith(b'\n'):
+            data += self.theirs.recv(65536)
+        return [json.loads(line) for line in data.splitlines()]
+
+    def test_priorities_and_fair_sharing(self):
+        i = self.interface
+        i.queue_request('blockchain.transaction.get_merkle', ['a', 1], 0, owner='w1')
+        for n in range(1, 4):
+            i.queue_request('blockchain.transaction.get', ['t%d' % n], n, owner='w1')
+        i.queue_request('blockchain.transaction.get', ['u1'], 4, owner='w2')
+        i.queue_request('blockchain.scripthash.subscribe', ['s'], 5, owner='w2')
+        i.queue_request('blockchain.block.headers', [0, 2016, 0], 6)
+        self.assertEqual(7, i.num_requests())
+        self.assertTrue(i.send_requests())
+        self.assertEqual([6, 5, 1, 4, 2, 3, 0], [r['id'] for r in self.sent()])
+        self.assertEqual(0, i.num_requests())
+
+    def test_window_limits_requests_in_flight(self):
+        i = self.interface
+        i.window = 3
+        for n in range(5):
+            i.queue_request('server.ping', [], n)
+        self.assertEqual(3, i.num_requests())
+        i.send_requests()
+        self.assertEqual([0, 1, 2], [r['id'] for r in self.sent()])
+        self.assertEqual(0, i.num_requests())
+        self.theirs.sendall(b'{"id": 0, "result": null}\n')
+        self.assertEqual(0, i.get_responses()[0][0][2])
+        self.assertEqual(i.window - 2, i.num_requests())
+
+    def test_window_adapts_to_round_trip_time(self):
+        i = self.interface
+        i.unanswered_requests = dict.fromkeys(range(i.MAX_WINDOW))
+        window = i.window
+        for n in range(20):
+            i.update_window(0.01)
+        self.assertEqual(window + 20, i.window)
+        i.update_window(5.0)
+        self.assertEqual((window + 20) * 3 // 4, i.window)
+        i.update_window(5.0)  # at most once per round trip
+        self.assertEqual((window + 20) * 3 // 4, i.window)
+
+    def test_batches(self):
+        i = self.interface
+        i.queue_request('server.ping', [], 0)
+        for n in range(1, 4):
+            i.queue_request('blockchain.transaction.get', ['t%d' % n], n, batch=True)
+        i.send_requests()
+        single, batch = self.sent()
+        self.assertEqual(0, single['id'])
+        self.assertEqual([1, 2, 3], [r['id'] for r in batch])
+        self.assertEqual('2.0', batch[0]['jsonrpc'])
+        self.theirs.sendall(b'{"id": 0, "result": null}\n'
+                            b'[{"id": 2, "result": "b"}, {"id": 1, "result": "a"}, {"id": 3, "result": "c"}]\n')
+        responses = i.get_responses()
+        self.assertEqual([0, 2, 1, 3], [request[2] for request, response in responses])
+        self.assertEqual(['b', 'a', 'c'], [response['result'] for request, response in responses[1:]])
+        self.assertFalse(i.unanswered_requests)
+
+    def test_batch_rejected(self):
+        i = self.interface
+        for n in range(3):
+            i.queue_request('blockchain.scripthash.subscribe', ['s%d' % n], n, batch=True)
+        i.send_requests()
+        self.assertEqual(1, len(self.sent()))
+        self.theirs.sendall(b'{"id": null, "error": {"code": -32600, "message": "invalid request"}}\n')
+        self.assertEqual([], i.get_responses())
+        self.assertFalse(i.batching)
+        self.assertEqual(3, i.num_requests())
+        i.send_requests()
+        self.assertEqual([0, 1, 2], [r['id'] for r in self.sent()])
+
+    def test_batches_rejected(self):
+        i = self.interface
+        i.MAX_BATCH = 2
+        for n in range(4):
+            i.queue_request('blockchain.scripthash.subscribe', ['s%d' % n], n, batch=True)
+        i.send_requests()
+        self.assertEqual(2, len(self.sent()))
+        error = b'{"id": null, "error": {"code": -32600, "message": "invalid request"}}\n'
+        self.theirs.sendall(error)
+        self.assertEqual([], i.get_responses())
+        self.assertEqual(4, i.num_requests())
+        i.send_requests()
+        self.assertEqual([0, 1, 2, 3], [r['id'] for r in self.sent()])
+        # the refusal of the second batch is no notification
+        self.theirs.sendall(error + b'{"id": 2, "result": "a"}\n')
+        self.assertEqual([(2, 'a')], [(request[2], response['result'])
+                                      for request, response in i.get_responses()])
+        self.assertFalse(i.batches)
@@ -0,0 +1,448 @@
+import json
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from .. import blockchain, interface, network
+from ..bitcoin import Hash, hash_encode
+from ..simple_config import SimpleConfig
+
+
+class FakeServer(threading.Thread):
+    '''Answers server.version, server.ping and blockchain.transaction.get
+    for the txs it has, errors for anything else.'''
+
+    def __init__(self, host='127.0.0.1', txs={}):
+        super().__init__(daemon=True)
+        self.host = host
+        self.txs = txs
+        self.served = 0
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+
+    def server_key(self):
+        return '{}:{}:t'.format(self.host, self.listener.getsockname()[1])
+
+    def run(self):
+        conn, _ = self.listener.accept()
+        with conn, conn.makefile('rb') as f:
+            for line in f:
+                request = json.loads(line.decode('utf8'))
+                response = {'id': request['id']}
+                if request['method'] == 'server.version':
+                    response['result'] = ['fake', '1.4']
+                elif request['method'] == 'server.ping':
+                    response['result'] = None
+                elif request['method'] == 'blockchain.transaction.get' and request['params'][0] in self.txs:
+                    response['result'] = self.txs[request['params'][0]]
+                    self.served += 1
+                else:
+                    response['error'] = {'code': -32601, 'message': 'unknown method'}
+                conn.sendall((json.dumps(response) + '\n').encode('utf8'))
+
+
+class TestNetworkLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.server = FakeServer()
+        self.server.start()
+        self.saved_instance = network.Network.INSTANCE
+
+    def tearDown(self):
+        network.Network.INSTANCE = self.saved_instance
+        self.server.listener.close()
+        shutil.rmtree(self.user_dir)
+
+    @mock.patch.object(network, 'LOOP_IDLE_TIMEOUT', 600)
+    def test_requests_from_other_threads_wake_the_loop(self):
+        # The loop would otherwise sleep for ten minutes at a time, so
+        # connecting and both round trips only finish if they wake it up.
+        config = SimpleConfig({'electron_cash_path': self.user_dir,
+                               'server': self.server.server_key(),
+                               'oneserver': True, 'auto_connect': False})
+        n = network.Network(config)
+        n.start()
+        try:
+            self.assertIsNone(n.synchronous_get(('server.ping', []), timeout=10))
+            self.assertIsNone(n.synchronous_get(('server.ping', []), timeout=10))
+        finally:
+            n.stop()
+            n.join(10)
+        self.assertFalse(n.is_alive())
+
+
+class TestParallelFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.saved_instance = network.Network.INSTANCE
+        raw_txs = [bytes([n]) * 100 for n in range(40)]
+        self.txs = {hash_encode(Hash(raw)): raw.hex() for raw in raw_txs}
+        self.honest = FakeServer(txs=self.txs)
+        # Knows every transaction, but gets them all wrong
+        self.liar = FakeServer('localhost', dict.fromkeys(self.txs, '00' * 100))
+        self.honest.start()
+        self.liar.start()
+
+    def tearDown(self):
+        network.Network.INSTANCE = self.saved_instance
+        self.honest.listener.close()
+        self.liar.listener.close()
+        shutil.rmtree(self.user_dir)
+
+    def test_transactions_are_checked_and_refetched(self):
+        servers = [self.honest.server_key(), self.liar.server_key()]
+        config = SimpleConfig({'electron_cash_path': self.user_dir,
+                               'server': servers[0], 'auto_connect': False,
+                               'whitelist_servers_only': True,
+                               'server_whitelist_added': servers,
+                               'server_whitelist_removed': list(network.hostmap_to_servers(
+                                   network.networks.net.DEFAULT_SERVERS)),
+                               'parallel_tx_fetch': True})
+        n = network.Network(config)
+        n.start()
+        try:
+            for i in range(100):
+                if len(n.get_interfaces()) == 2:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(sorted(servers), sorted(n.get_interfaces()))
+            q = queue.Queue()
+            n.send([('blockchain.transaction.get', [txid]) for txid in self.txs], q.put)
+            results = {}
+            for txid in self.txs:
+                response = q.get(timeout=10)
+                self.assertIsNone(response.get('error'))
+                results[response['params'][0]] = response['result']
+        finally:
+            n.stop()
+            n.join(10)
+        self.assertEqual(self.txs, results)
+        self.assertGreater(self.liar.served, 0)
+        self.assertTrue(n.server_is_blacklisted(servers[1]))
+        self.assertFalse(n.sharded_fetches)
+
+
+class TestShardedFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.saved_instance = network.Network.INSTANCE
+        self.network = network.Network(SimpleConfig({'electron_cash_path': self.user_dir,
+                                                     'server': 'localhost:1:t',
+                                                     'oneserver': True, 'auto_connect': False,
+                                                     'parallel_tx_fetch': True}))
+
+    def tearDown(self):
+        network.Network.INSTANCE = self.saved_instance
+        shutil.rmtree(self.user_dir)
+
+    def test_fetch_waits_for_a_server(self):
+        n = self.network
+        one, two = Responses(), Responses()
+        self.assertIsNone(n.interface)
+        n.queue_sharded_fetch('blockchain.transaction.get', ['aa'], one.callback)
+        n.queue_sharded_fetch('blockchain.transaction.get', ['aa'], two.callback)
+        fetch = n.sharded_fetches[('blockchain.transaction.get', ('aa',))]
+        self.assertEqual([['blockchain.transaction.get', ['aa'], fetch]],
+                         list(n.unanswered_requests.values()))
+
+        n.unsubscribe(one.callback)
+        self.assertEqual([two.callback], fetch.callbacks)
+        fetch({'result': 'raw'})
+        self.assertEqual([], one)
+        self.assertEqual([{'result': 'raw'}], two)
+
+        # the main server connects
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        n.interface = interface.Interface('localhost:1:t', ours)
+        with mock.patch.object(n, 'request_fee_estimates'):
+            n.send_subscriptions()
+        self.assertEqual('localhost:1:t', fetch.server)
+        self.assertIn(fetch.message_id, n.unanswered_requests)
+
+
+class FakeChain:
+    '''Connects chunks as long as they come in order.'''
+
+    def __init__(self, height):
+        self._height = height
+        self.connected = []
+        self.catch_up = None
+
+    def height(self):
+        return self._height
+
+    def connect_chunk(self, base_height, chunk_data):
+        self.connected.append(base_height)
+        if base_height != self._height + 1:
+            return blockchain.CHUNK_BAD
+        self._height += len(chunk_data) // blockchain.HEADER_SIZE
+        return blockchain.CHUNK_ACCEPTED
+
+
+class TestHeaderPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.saved_instance = network.Network.INSTANCE
+        self.network = network.Network(SimpleConfig({'electron_cash_path': self.user_dir,
+                                                     'server': 'localhost:1:t',
+                                                     'oneserver': True, 'auto_connect': False}))
+        self.network.chunk_connector.start()
+        self.ours, self.theirs = socket.socketpair()
+        self.interface = interface.Interface('localhost:1:t', self.ours)
+        self.interface.header_pipeline = network._HeaderPipeline()
+        self.interface.set_mode(interface.Interface.MODE_CATCH_UP)
+        self.interface.blockchain = FakeChain(999)
+        self.interface.tip = 999 + 5 * 2016
+        self.network.interfaces[self.interface.server] = self.interface
+
+    def tearDown(self):
+        self.network.chunk_connector.stop()
+        self.ours.close()
+        self.theirs.close()
+        network.Network.INSTANCE = self.saved_instance
+        shutil.rmtree(self.user_dir)
+
+    def requested(self):
+        '''Base heights of the chunks requested since the last call.'''
+        requests = self.interface._pop_requests(1000)
+        return [request[1][0] for owner, request in requests]
+
+    def answer(self, base_height):
+        request = ('blockchain.block.headers', [base_height, 2016, 0])
+        chunk = bytes(blockchain.HEADER_SIZE) * min(2016, self.interface.tip - base_height + 1)
+        self.network.on_block_headers(self.interface, request,
+                                      {'params': request[1], 'result': {'hex': chunk.hex()}})
+
+    def wait_connected(self, count):
+        for i in range(100):
+            self.network.process_connected_chunks()
+            if len(self.interface.blockchain.connected) == count:
+                break
+            time.sleep(0.01)
+        self.network.process_connected_chunks()
+
+    @mock.patch.object(network, 'CATCH_UP_CHUNKS', 3)
+    def test_chunks_are_pipelined_and_connected_in_order(self):
+        bases = [1000 + n * 2016 for n in range(5)]
+        self.network.start_catch_up_chunks(self.interface, 1000)
+        self.assertEqual(bases[:3], self.requested())
+        # The third and second chunks wait for the first
+        self.answer(bases[2])
+        self.answer(bases[1])
+        self.assertEqual([], self.requested())
+        self.wait_connected(0)
+        self.assertEqual([], self.interface.blockchain.connected)
+        self.answer(bases[0])
+        self.wait_connected(3)
+        self.assertEqual(bases[:3], self.interface.blockchain.connected)
+        self.assertEqual(bases[3:], self.requested())
+        self.answer(bases[3])
+        self.answer(bases[4])
+        self.wait_connected(5)
+        self.assertEqual(bases, self.interface.blockchain.connected)
+        self.assertEqual(self.interface.tip, self.interface.blockchain.height())
+        self.assertEqual(interface.Interface.MODE_DEFAULT, self.interface.mode)
+        self.assertFalse(self.interface.header_pipeline.active)
+
+    @mock.patch.object(network, 'CATCH_UP_CHUNKS', 3)
+    def test_answers_after_a_restart(self):
+        self.network.start_catch_up_chunks(self.interface, 1000)
+        self.assertEqual([1000, 3016, 5032], self.requested())
+        self.network.start_catch_up_chunks(self.interface, 2000)
+        self.assertEqual([2000, 4016, 6032], self.requested())
+        # answers for the first catch-up are dropped, and the chain only
+        # sees the chunks asked for since
+        self.answer(1000)
+        self.interface.blockchain._height = 1999
+        self.answer(3016)
+        self.answer(2000)
+        self.wait_connected(1)
+        self.assertEqual([2000], self.interface.blockchain.connected)
+        self.assertEqual({5032}, self.interface.header_pipeline.stale)
+
+
+class TestChainWrites(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.saved_instance = network.Network.INSTANCE
+        self.network = network.Network(SimpleConfig({'electron_cash_path': self.user_dir,
+                                                     'server': 'localhost:1:t',
+                                                     'oneserver': True, 'auto_connect': False}))
+        self.network.chunk_connector.start()
+        self.ours, self.theirs = socket.socketpair()
+        self.interface = interface.Interface('localhost:1:t', self.ours)
+        self.interface.set_mode(interface.Interface.MODE_DEFAULT)
+        self.network.interfaces[self.interface.server] = self.interface
+        self.chain = self.network.blockchains[0]
+        with open(self.chain.path(), 'wb') as f:
+            f.write(self.header(0))
+        with self.chain.lock:
+            self.chain.update_size()
+
+    def tearDown(self):
+        self.network.chunk_connector.stop()
+        self.ours.close()
+        self.theirs.close()
+        network.Network.INSTANCE = self.saved_instance
+        shutil.rmtree(self.user_dir)
+
+    def header(self, height):
+        prev_block_hash = blockchain.networks.net.GENESIS if height == 1 else '11' * 32
+        return bytes.fromhex(blockchain.serialize_header({
+            'version': 1, 'prev_block_hash': prev_block_hash, 'merkle_root': '%064x' % height,
+            'timestamp': height, 'bits': 0, 'nonce': 0}))
+
+    def test_headers_are_saved_while_a_chunk_is_verified(self):
+        connecting, release = threading.Event(), threading.Event()
+        def verify_chunk(chain, base_height, chunk_data):
+            connecting.set()
+            release.wait(5)
+        def can_connect(chain, header, check_height=True):
+            return chain.height() == header['block_height'] - 1
+        with mock.patch.object(blockchain.networks.net, 'VERIFICATION_BLOCK_HEIGHT', 0), \
+             mock.patch.object(blockchain.Blockchain, 'verify_chunk', verify_chunk), \
+             mock.patch.object(blockchain.Blockchain, 'can_connect', can_connect):
+            self.network.chunk_connector.connect(self.interface, self.chain, 1,
+                                                 self.header(1) + self.header(2))
+            self.assertTrue(connecting.wait(5))
+            notification = {'hex': self.header(1).hex(), 'height': 1}
+            notifier = threading.Thread(target=self.network.on_notify_header,
+                                        args=(self.interface, notification))
+            notifier.start()
+            notifier.join(5)
+            # The network thread goes on while the chunk is verified
+            self.assertFalse(notifier.is_alive())
+            self.assertFalse(release.is_set())
+            self.assertEqual(1, self.network.get_local_height())
+            release.set()
+            # and the chunk is then placed against the chain as it is now
+            result = self.network.connected_chunks.get(timeout=5)
+        self.assertEqual((self.interface, 1, 2, blockchain.CHUNK_ACCEPTED), result)
+        self.assertEqual(1, self.chain.height())
+        self.assertEqual(self.header(1).hex(), blockchain.serialize_header(self.chain.read_header(1)))
+
+class Responses(list):
+    '''Stands in for a wallet's synchronizer.'''
+
+    __hash__ = object.__hash__
+
+    def callback(self, response):
+        self.append(response)
+
+
+class TestScripthashRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.saved_instance = network.Network.INSTANCE
+        self.network = network.Network(SimpleConfig({'electron_cash_path': self.user_dir,
+                                                     'server': 'localhost:1:t',
+                                                     'oneserver': True, 'auto_connect': False}))
+        self.ours, self.theirs = socket.socketpair()
+        self.interface = interface.Interface('localhost:1:t', self.ours)
+        self.network.interface = self.interface
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+        network.Network.INSTANCE = self.saved_instance
+        shutil.rmtree(self.user_dir)
+
+    def notify(self, sh, status):
+        self.interface.unanswered_requests = {}
+        with mock.patch.object(self.interface, 'get_responses', return_value=[
+                (None, {'method': 'blockchain.scripthash.subscribe', 'params': [sh, status]})]):
+            self.network.process_responses(self.interface)
+
+    def test_notifications_reach_the_subscribers_of_the_scripthash(self):
+        one, two = Responses(), Responses()
+        self.network.subscribe_to_scripthashes(['aa', 'bb'], one.callback, addresses=['A', 'B'])
+        self.network.subscribe_to_scripthashes(['bb'], two.callback)
+        self.network.process_pending_sends()
+        self.assertEqual({'aa', 'bb'}, set(self.network.scripthash_routes))
+        self.assertEqual('B', self.network.get_scripthash_address('bb'))
+        self.assertIsNone(self.network.get_scripthash_address('cc'))
+
+        self.notify('bb', 'status')
+        response = {'method': 'blockchain.scripthash.subscribe', 'params': ['bb'],
+                    'result': 'status', 'address': 'B'}
+        self.assertEqual([response], one)
+        self.assertEqual([response], two)
+        self.notify('cc', 'status')
+        self.network.unsubscribe(one.callback)
+        # routes left without subscribers go
+        self.assertEqual({'bb'}, set(self.network.scripthash_routes))
+        self.assertIsNone(self.network.get_scripthash_address('aa'))
+        self.notify('aa', 'status')
+        self.assertEqual([response], one)
+        self.assertEqual(1, len(two))
+
+    def test_routes_change_under_the_network_lock(self):
+        # The websocket server subscribes from its own thread.
+        one = Responses()
+        subscriber = threading.Thread(target=self.network.subscribe_to_scripthashes,
+                                      args=(['aa'], one.callback), kwargs={'addresses': ['A']})
+        with self.network.lock:
+            subscriber.start()
+            subscriber.join(0.1)
+            self.assertTrue(subscriber.is_alive())
+            self.assertEqual({}, self.network.scripthash_routes)
+        subscriber.join(5)
+        self.assertEqual('A', self.network.get_scripthash_address('aa'))
+
+
+class TestServerStats(unittest.TestCase):
+
+    hostmap = {'fast': {'s': '1'}, 'slow': {'s': '1'}, 'down': {'s': '1'}, 'new': {'s': '1'}}
+    stats = {'fast:1:s': {'rtt': 0.05, 'failures': 0},
+             'slow:1:s': {'rtt': 0.5, 'failures': 1},
+             'down:1:s': {'rtt': 0.01, 'failures': 3}}
+
+    def pick(self, chance, choices=2):
+        picked = set()
+        with mock.patch.object(network, 'FAST_SERVER_CHOICES', choices), \
+             mock.patch.object(network.random, 'random', return_value=chance):
+            for i in range(200):
+                picked.add(network.pick_random_server(self.hostmap, 's', server_stats=self.stats))
+        return picked
+
+    def test_fast_servers_are_preferred(self):
+        self.assertEqual({'fast:1:s', 'slow:1:s'}, self.pick(0.5))
+        self.assertEqual({'fast:1:s'}, self.pick(0.5, choices=1))
+        # The rest of the time, any server that is not failing
+        self.assertEqual({'fast:1:s', 'slow:1:s', 'new:1:s'}, self.pick(0.9))
+
+    def test_failing_servers_as_a_last_resort(self):
+        exclude = {'fast:1:s', 'slow:1:s', 'new:1:s'}
+        self.assertEqual('down:1:s', network.pick_random_server(self.hostmap, 's', exclude, self.stats))
+
+    def test_stats_are_kept(self):
+        user_dir = tempfile.mkdtemp()
+        saved_instance = network.Network.INSTANCE
+        try:
+            config = SimpleConfig({'electron_cash_path': user_dir, 'server': 'localhost:1:t',
+                                   'oneserver': True, 'auto_connect': False})
+            n = network.Network(config)
+            n.update_server_stats('localhost:1:t', failures=2)
+            n.update_server_stats('localhost:1:t', rtt=0.1, version=['fake', '1.4'])
+            # Saved now and then by the network thread, not on every change
+            self.assertEqual({}, network.Network(config).server_stats)
+            n.stop_network()
+            self.assertEqual({'localhost:1:t': {'failures': 2, 'rtt': 0.1, 'version': ['fake', '1.4']}},
+                             network.Network(config).server_stats)
+        finally:
+            network.Network.INSTANCE = saved_instance
+            shutil.rmtree(user_dir)
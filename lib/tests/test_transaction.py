@@ -1,9 +1,9 @@
 import unittest
 from pprint import pprint
 
-from .. import transaction
-from ..address import Address
-from ..bitcoin import TYPE_ADDRESS
+from .. import ecc_fast, transaction
+from ..address import Address, PublicKey
+from ..bitcoin import TYPE_ADDRESS, Hash, public_key_from_private_key
 
 from ..keystore import xpubkey_to_address
 
@@ -126,11 +126,65 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(tx.as_dict(), {'hex': signed_blob, 'complete': True, 'final': True})
 
         self.assertEqual(tx.serialize(), signed_blob)
+        self.assertEqual(tx.serialize_bytes(), bytes.fromhex(signed_blob))
+        self.assertEqual(transaction.deserialize(bytes.fromhex(signed_blob)), expected)
 
         tx.update_signatures(signed_blob)
 
         self.assertEqual(tx.estimated_size(), 191)
 
+    def test_preimage_after_changes(self):
+        tx = transaction.Transaction(unsigned_blob)
+        preimage = tx.serialize_preimage(0)
+        self.assertEqual(bytes.fromhex(preimage), tx.serialize_preimage_bytes(0))
+        tx.add_outputs([(TYPE_ADDRESS, Address.from_string('1CQj15y1N7LDHp7wTt28eoD1QhHgFgxECH'), 1000)])
+        self.assertNotEqual(preimage, tx.serialize_preimage(0))
+        self.assertEqual(transaction.Transaction(tx.serialize()).serialize_preimage(0),
+                         tx.serialize_preimage(0))
+        preimage = tx.serialize_preimage(0)
+        tx.BIP_LI01_sort()
+        self.assertNotEqual(preimage, tx.serialize_preimage(0))
+        self.assertEqual(transaction.Transaction(tx.serialize()).serialize_preimage(0),
+                         tx.serialize_preimage(0))
+
+    def test_outputs_use_pay_script(self):
+        class OpReturnTransaction(transaction.Transaction):
+            def pay_script(self, output):
+                return '6a'
+        tx = OpReturnTransaction(unsigned_blob)
+        output = tx.outputs()[0]
+        self.assertEqual('18e4320100000000016a', tx.serialize_output(output))
+        self.assertEqual(bytes.fromhex(tx.serialize_output(output)), tx.serialize_output_bytes(output))
+        self.assertIn('18e4320100000000016a', tx.serialize())
+
+    def test_estimated_sizes_match_serialization(self):
+        compressed = '03b5bbebceeb33c1b61f649596b9c3611c6b2853a1f6b48bce05dd54f667fa2166'
+        uncompressed = '04' + '11' * 64
+        xpubkey = 'ff0488b21e0000000000000000004f130d773e678a58366711837ec2e33ea601858262f8eaef246a7ebd19909c9a03c3b30e38ca7d797fee1223df1c9827b2a9f3379768f520910260220e0560014600002300'
+        address = Address.from_string('13Vp8Y3hD5Cb6sERfpxePz5vGJizXbWciN')
+        txins = [{'type': 'p2pkh', 'x_pubkeys': [xpubkey], 'pubkeys': [compressed], 'num_sig': 1,
+                  'signatures': [None], 'value': 1000},
+                 {'type': 'p2pkh', 'x_pubkeys': [uncompressed], 'pubkeys': [uncompressed], 'num_sig': 1,
+                  'signatures': ['30' * 71]},
+                 {'type': 'p2pk', 'x_pubkeys': [compressed], 'pubkeys': [compressed], 'num_sig': 1,
+                  'signatures': [None]},
+                 {'type': 'unknown', 'scriptSig': '51' * 300, 'num_sig': 0, 'signatures': []}]
+        for m, n, pubkey in [(1, 1, compressed), (2, 3, compressed), (2, 3, uncompressed),
+                             (5, 15, compressed), (15, 15, uncompressed)]:
+            txins.append({'type': 'p2sh', 'x_pubkeys': [pubkey] * n, 'pubkeys': [pubkey] * n,
+                          'num_sig': m, 'signatures': [None] * n, 'value': 1000})
+        for n, txin in enumerate(txins):
+            txin.update(prevout_hash='%064x' % n, prevout_n=n, address=address)
+            script = transaction.Transaction.input_script(txin, True)
+            self.assertEqual(len(transaction.Transaction.serialize_input_bytes(txin, bytes.fromhex(script), True)),
+                             transaction.Transaction.estimated_input_size(txin))
+
+        outputs = [(TYPE_ADDRESS, address, 1000),
+                   (TYPE_ADDRESS, Address.from_string('3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy'), 1000)]
+        tx = transaction.Transaction.from_io(txins, outputs)
+        self.assertEqual(len(tx.serialize_bytes(True)), tx.estimated_size())
+        self.assertEqual(tx.estimated_size(), 4 + 1 + sum(map(tx.estimated_input_size, txins)) + 1 + 34 + 32 + 4)
+
     def test_errors(self):
         with self.assertRaises(TypeError):
             transaction.Transaction.pay_script(output_type=None, addr='')
@@ -179,6 +233,42 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual('2caab5a11fa1ec0f5bb014b8858d00fecf2c001e15d22ad04379ad7b36fef305', tx.txid())
 
 
+
+class TestSign(unittest.TestCase):
+
+    def make_tx(self):
+        sec = Hash(b'test sign')
+        pubkey = public_key_from_private_key(sec, True)
+        inputs = [{'type': 'p2pkh', 'address': PublicKey.from_string(pubkey).address, 'num_sig': 1,
+                   'prevout_hash': bh2u(Hash(bytes([n]))), 'prevout_n': n, 'value': 10000,
+                   'x_pubkeys': [pubkey], 'pubkeys': [pubkey], 'signatures': [None]}
+                  for n in range(4)]
+        outputs = [(TYPE_ADDRESS, Address.from_string('1MYXdf4moacvaEKZ57ozerpJ3t9xSeN6LK'), 39000)]
+        return transaction.Transaction.from_io(inputs, outputs), {pubkey: (sec, True)}
+
+    def test_sign(self):
+        tx, keypairs = self.make_tx()
+        tx.sign(keypairs)
+        self.assertTrue(tx.is_complete())
+        # The same signatures as python-ecdsa makes, whether or not they
+        # came from libsecp256k1
+        (sec, compressed), = keypairs.values()
+        digests = [Hash(tx.serialize_preimage_bytes(i)) for i in range(4)]
+        fast = ecc_fast.is_using_fast_ecc()
+        ecc_fast.undo_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+        try:
+            sigs = transaction.sign_digests(sec, digests)
+        finally:
+            if fast:
+                ecc_fast.do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+        self.assertEqual([bh2u(sig) + '41' for sig in sigs],
+                         [txin['signatures'][0] for txin in tx.inputs()])
+
+        other, keypairs = self.make_tx()
+        other.sign(keypairs, processes=2)
+        self.assertEqual(tx.raw, other.raw)
+
+
 class NetworkMock(object):
 
     def __init__(self, unspent):
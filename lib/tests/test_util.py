@@ -1,5 +1,6 @@
+import socket
 import unittest
-from ..util import format_satoshis
+from ..util import format_satoshis, SocketPipe, timeout
 from ..web import parse_URI
 
 class TestUtil(unittest.TestCase):
@@ -110,3 +111,45 @@ class TestUtil(unittest.TestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoincash:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
+
+
+class TestSocketPipe(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.pipe = SocketPipe(self.ours)
+        self.pipe.set_timeout(0.0)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def read_all(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.pipe.get())
+            except timeout:
+                return messages
+
+    def test_messages_split_across_reads(self):
+        data = b'{"id": 1}\n{"id": 2, "result": "' + b'x' * 50000 + b'"}\n[1, 2]\n{"id": 3}\n'
+        messages = []
+        for i in range(0, len(data), 7001):
+            self.theirs.sendall(data[i:i + 7001])
+            messages += self.read_all()
+        self.assertEqual([1, 2], [m['id'] for m in messages[:2]])
+        self.assertEqual('x' * 50000, messages[1]['result'])
+        self.assertEqual([1, 2], messages[2])
+        self.assertEqual({'id': 3}, messages[3])
+        self.assertEqual(4, len(messages))
+
+    def test_bad_lines_are_skipped(self):
+        self.theirs.sendall(b'not json\n\n\xff\n{"id": 4}\n')
+        self.assertEqual([{'id': 4}], self.read_all())
+
+    def test_closed_remotely(self):
+        self.theirs.sendall(b'{"id": 5}\n')
+        self.theirs.close()
+        self.assertEqual({'id': 5}, self.pipe.get())
+        self.assertIsNone(self.pipe.get())
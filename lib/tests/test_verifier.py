@@ -0,0 +1,111 @@
+import unittest
+
+from ..bitcoin import Hash, hash_encode, hash_decode
+from ..verifier import SPV, InnerNodeOfSpvProofIsValidTx
+
+
+def merkle_tree(txids):
+    '''Merkle root and the branch of each tx, as a server would send them.'''
+    level = [hash_decode(txid) for txid in txids]
+    branches = [[] for txid in txids]
+    positions = list(range(len(txids)))
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for branch, pos in zip(branches, positions):
+            branch.append(hash_encode(level[pos ^ 1]))
+        level = [Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+        positions = [pos // 2 for pos in positions]
+    return hash_encode(level[0]), branches
+
+
+class FakeBlockchain:
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.reads = []
+
+    def read_header(self, height):
+        self.reads.append(height)
+        return self.headers.get(height)
+
+
+class FakeNetwork:
+
+    def __init__(self, blockchain):
+        self._blockchain = blockchain
+        self.callbacks = []
+
+    def blockchain(self):
+        return self._blockchain
+
+    def trigger_callback(self, *args):
+        self.callbacks.append(args)
+
+
+class FakeWallet:
+
+    def __init__(self):
+        self.verifier = True
+        self.verified = {}
+        self.saves = 0
+
+    def add_verified_tx(self, tx_hash, info):
+        self.verified[tx_hash] = info
+
+    def is_up_to_date(self):
+        return True
+
+    def save_verified_tx(self, write=False):
+        self.saves += 1
+
+
+class TestSPV(unittest.TestCase):
+
+    def setUp(self):
+        self.txids = [hash_encode(Hash(bytes([n]))) for n in range(5)]
+        self.root, self.branches = merkle_tree(self.txids)
+
+    def test_hash_merkle_root(self):
+        for pos, txid in enumerate(self.txids):
+            self.assertEqual(self.root, SPV.hash_merkle_root(self.branches[pos], txid, pos))
+        self.assertNotEqual(self.root, SPV.hash_merkle_root(self.branches[1], self.txids[0], 1))
+
+    def test_inner_node_that_is_a_tx(self):
+        SPV._raise_if_valid_tx(Hash(b'node'))
+        raw_tx = bytes.fromhex('01000000' '01' + '11' * 32 + '00000000' '00' 'ffffffff' '00' '00000000')
+        self.assertEqual(SPV.MIN_TX_SIZE, len(raw_tx))
+        with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
+            SPV._raise_if_valid_tx(raw_tx)
+
+    def test_proof_with_an_inner_node_that_is_a_tx(self):
+        node = bytes.fromhex('01000000' '01' + '11' * 32 + '00000000' '0d' '0c' + '22' * 12 + 'ffffffff'
+                             '00' '00000000')
+        self.assertEqual(64, len(node))
+        with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
+            SPV.hash_merkle_root([hash_encode(node[32:])], hash_encode(node[:32]), 0)
+        with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
+            SPV.hash_merkle_root([hash_encode(node[:32])], hash_encode(node[32:]), 1)
+
+    def test_batch_reads_each_header_once(self):
+        blockchain = FakeBlockchain({100: {'merkle_root': self.root, 'timestamp': 1234}})
+        wallet = FakeWallet()
+        spv = SPV(FakeNetwork(blockchain), wallet)
+        spv.requested_merkle = set(self.txids)
+        for pos, txid in enumerate(self.txids):
+            spv.verify_merkle({'params': [txid, 100],
+                               'result': {'block_height': 100, 'pos': pos, 'merkle': self.branches[pos]}})
+        # one with a bad proof, one for a block we don't have
+        spv.verify_merkle({'params': ['aa' * 32, 100],
+                           'result': {'block_height': 100, 'pos': 0, 'merkle': self.branches[0]}})
+        spv.verify_merkle({'params': ['bb' * 32, 101],
+                           'result': {'block_height': 101, 'pos': 0, 'merkle': []}})
+        self.assertEqual({}, wallet.verified)
+
+        spv.verify_merkle_batch()
+        self.assertEqual([100, 101], sorted(blockchain.reads))
+        self.assertEqual({txid: (100, 1234, pos) for pos, txid in enumerate(self.txids)},
+                         wallet.verified)
+        self.assertEqual(set(self.txids), set(spv.merkle_roots))
+        self.assertTrue(spv.is_up_to_date())
+        self.assertEqual(1, wallet.saves)
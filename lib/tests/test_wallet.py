@@ -1,12 +1,22 @@
+import datetime
 import shutil
+import sqlite3
 import tempfile
+import time
 import sys
 import unittest
 import os
 import json
+from unittest import mock
 
 from io import StringIO
-from ..storage import WalletStorage, FINAL_SEED_VERSION
+from ..address import Address
+from ..bitcoin import TYPE_ADDRESS
+from ..commands import Commands
+from ..synchronizer import Synchronizer
+from ..storage import WalletStorage, FINAL_SEED_VERSION, STO_JSON, STO_SQLITE
+from ..transaction import Transaction
+from ..util import InvalidPassword
 from .. import wallet
 
 
@@ -68,3 +78,348 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_peek_and_put_owned(self):
+        storage = WalletStorage(self.wallet_path)
+        value = {'a': [1, 2]}
+        storage.put_owned('k', value)
+        self.assertIs(value['a'], storage.peek('k')['a'])
+        with self.assertRaises(TypeError):
+            storage.peek('k')['b'] = 1
+        storage.write()
+        storage.put_owned('k', {'a': value['a']})  # equal, so not modified
+        self.assertFalse(storage.modified)
+        storage.put_owned('k', {'a': value['a'], 'b': 3})
+        self.assertTrue(storage.modified)
+        self.assertEqual({'a': [1, 2], 'b': 3}, storage.get('k'))
+        self.assertIsNot(value['a'], storage.get('k')['a'])
+
+    def test_sqlite_format(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 'b')
+        storage.put('txi', {'11' * 32: {}, '22' * 32: {'x': [1]}})
+        storage.write()
+        storage.set_storage_format(STO_SQLITE)
+        storage.write()
+        with open(self.wallet_path, 'rb') as f:
+            self.assertEqual(b'SQLite format 3', f.read(15))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(STO_SQLITE, storage.storage_format)
+        self.assertEqual('b', storage.get('a'))
+        self.assertEqual({'11' * 32: {}, '22' * 32: {'x': [1]}}, storage.get('txi'))
+        # incremental save: one entry changed, one removed, a key dropped
+        storage.put('txi', {'22' * 32: {'x': [2]}, '33' * 32: {}})
+        storage.put('a', None)
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({'22' * 32: {'x': [2]}, '33' * 32: {}}, storage.get('txi'))
+        self.assertIsNone(storage.get('a'))
+        storage.set_storage_format(STO_JSON)
+        storage.write()
+        with open(self.wallet_path, 'r') as f:
+            self.assertEqual({'22' * 32: {'x': [2]}, '33' * 32: {}}, json.load(f)['txi'])
+
+    def test_sqlite_format_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_storage_format(STO_SQLITE)
+        storage.set_password('secret', True)
+        storage.put('transactions', {'11' * 32: '0100'})
+        storage.write()
+        storage.put('transactions', {'11' * 32: '0100', '22' * 32: '0200'})
+        storage.write()
+        with open(self.wallet_path, 'rb') as f:
+            self.assertNotIn(b'11' * 32, f.read())
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted())
+        with self.assertRaises(InvalidPassword):
+            storage.decrypt('wrong')
+        storage.decrypt('secret')
+        self.assertEqual({'11' * 32: '0100', '22' * 32: '0200'}, storage.get('transactions'))
+
+    def test_sqlite_format_tampered(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_storage_format(STO_SQLITE)
+        storage.set_password('secret', True)
+        storage.put('transactions', {'11' * 32: '0100'})
+        storage.write()
+        conn = sqlite3.connect(self.wallet_path)
+        with conn:
+            table_id, ident, data = conn.execute('SELECT table_id, id, data FROM records').fetchone()
+            data = data[:20] + bytes([data[20] ^ 1]) + data[21:]
+            conn.execute('UPDATE records SET data = ? WHERE table_id = ? AND id = ?', (data, table_id, ident))
+        conn.close()
+
+        storage = WalletStorage(self.wallet_path)
+        with self.assertRaises(IOError):
+            storage.decrypt('secret')
+
+    def test_sqlite_format_rows_removed_or_rolled_back(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_storage_format(STO_SQLITE)
+        storage.set_password('secret', True)
+        storage.put('labels', {'a': 'old'})
+        storage.put('transactions', {'11' * 32: '0100', '22' * 32: '0200'})
+        storage.write()
+        conn = sqlite3.connect(self.wallet_path)
+        old_rows = conn.execute('SELECT table_id, id, data FROM records').fetchall()
+        conn.close()
+        storage.put('labels', {'a': 'new'})
+        storage.write()
+        saved = self.wallet_path + '.saved'
+        shutil.copyfile(self.wallet_path, saved)
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt('secret')
+        self.assertEqual({'a': 'new'}, storage.get('labels'))
+
+        conn = sqlite3.connect(self.wallet_path)
+        with conn:
+            conn.execute('DELETE FROM records WHERE id = (SELECT MIN(id) FROM records)')
+        conn.close()
+        with self.assertRaises(IOError):
+            WalletStorage(self.wallet_path).decrypt('secret')
+
+        shutil.copyfile(saved, self.wallet_path)
+        conn = sqlite3.connect(self.wallet_path)
+        with conn:
+            conn.executemany('UPDATE records SET data = ? WHERE table_id = ? AND id = ?',
+                             ((data, table_id, ident) for table_id, ident, data in old_rows))
+        conn.close()
+        with self.assertRaises(IOError):
+            WalletStorage(self.wallet_path).decrypt('secret')
+
+
+class TestTransactionStore(unittest.TestCase):
+
+    def test_lru(self):
+        store = wallet.TransactionStore(max_cached=2)
+        raws = {h * 32: '01000000000000000000' + h * 2 for h in ('aa', 'bb', 'cc')}
+        for tx_hash, raw in raws.items():
+            store.set_raw(tx_hash, raw)
+        self.assertEqual(3, len(store))
+        tx = store['aa' * 32]
+        self.assertIs(tx, store.get('aa' * 32))
+        self.assertEqual(raws['aa' * 32], str(tx))
+        store.get('bb' * 32)
+        store.get('cc' * 32)
+        self.assertIsNot(tx, store['aa' * 32])  # evicted and rebuilt
+        self.assertEqual(raws['bb' * 32], store.get_raw('bb' * 32))
+        self.assertIsNone(store.get('dd' * 32))
+        self.assertEqual(raws['cc' * 32], str(store.pop('cc' * 32)))
+        self.assertNotIn('cc' * 32, store)
+        self.assertEqual(sorted(raws)[:2], sorted(store))
+
+    def test_set(self):
+        store = wallet.TransactionStore()
+        pubkey = '02' + '01' * 32
+        tx = Transaction.from_io([{'type': 'p2pkh', 'address': Address.from_pubkey(pubkey),
+                                   'prevout_hash': 'cc' * 32, 'prevout_n': 0,
+                                   'x_pubkeys': [pubkey], 'pubkeys': [pubkey],
+                                   'signatures': [None], 'num_sig': 1}], [])
+        store['aa' * 32] = tx
+        self.assertEqual({'aa' * 32}, store.pop_unsaved())
+        store['aa' * 32] = tx
+        self.assertEqual(set(), store.pop_unsaved())
+        # the same object, changed since it was stored
+        tx.locktime = 1
+        tx.raw = None
+        store['aa' * 32] = tx
+        self.assertEqual({'aa' * 32}, store.pop_unsaved())
+        self.assertEqual(str(tx), store.get_raw('aa' * 32))
+
+        # a tx that cannot be serialized yet is kept as it is
+        partial = Transaction.from_io([{'type': 'p2pkh', 'address': None,
+                                        'prevout_hash': 'bb' * 32, 'prevout_n': 0}], [])
+        store['bb' * 32] = partial
+        self.assertIn('bb' * 32, store)
+        self.assertEqual(2, len(store))
+        self.assertIs(partial, store['bb' * 32])
+        self.assertIs(partial, store.pop('bb' * 32))
+        self.assertEqual(['aa' * 32], store.keys())
+
+
+class TestWalletUtxoIndex(WalletTestCase):
+
+    def setUp(self):
+        super(TestWalletUtxoIndex, self).setUp()
+        self.addr = Address.from_string('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D')
+        other = Address.from_string('1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf')
+        self.tx1_hash = '11' * 32
+        self.tx1 = Transaction.from_io(
+            [{'type': 'p2pkh', 'address': other,
+              'prevout_hash': 'aa' * 32, 'prevout_n': 0}],
+            [(TYPE_ADDRESS, self.addr, 1000), (TYPE_ADDRESS, other, 500)])
+        self.tx2_hash = '22' * 32
+        self.tx2 = Transaction.from_io(
+            [{'type': 'p2pkh', 'address': self.addr,
+              'prevout_hash': self.tx1_hash, 'prevout_n': 0}],
+            [(TYPE_ADDRESS, other, 900)])
+        self.wallet = wallet.ImportedAddressWallet(WalletStorage(self.wallet_path))
+        self.wallet.import_address(self.addr)
+
+    def test_utxos_follow_history(self):
+        w = self.wallet
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100)], {})
+        w.add_transaction(self.tx1_hash, self.tx1)
+        coins = w.get_utxos()
+        self.assertEqual(1, len(coins))
+        self.assertEqual((self.tx1_hash, 0, 1000, 100),
+                         (coins[0]['prevout_hash'], coins[0]['prevout_n'],
+                          coins[0]['value'], coins[0]['height']))
+        self.assertEqual((1000, 0, 0), w.get_balance())
+
+        # spend it in the mempool
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100), (self.tx2_hash, 0)], {})
+        w.add_transaction(self.tx2_hash, self.tx2)
+        self.assertEqual([], w.get_utxos())
+        self.assertEqual({}, w.get_addr_utxo(self.addr))
+        self.assertEqual((1000, -1000, 0), w.get_balance())
+
+        # the spend drops out of the history again
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 101)], {})
+        coins = w.get_addr_utxo(self.addr)
+        self.assertEqual([self.tx1_hash + ':0'], list(coins))
+        self.assertEqual(101, coins[self.tx1_hash + ':0']['height'])
+
+    def test_spend_seen_before_funding_tx(self):
+        w = self.wallet
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100), (self.tx2_hash, 100)], {})
+        w.add_transaction(self.tx2_hash, self.tx2)
+        w.add_transaction(self.tx1_hash, self.tx1)
+        self.assertEqual([], w.get_utxos())
+        self.assertEqual((0, 0, 0), w.get_balance())
+
+    def test_balance_cache(self):
+        w = self.wallet
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100)], {})
+        w.add_transaction(self.tx1_hash, self.tx1)
+        self.assertEqual((1000, 0, 0), w.get_balance())
+        self.assertEqual((0, 0, 0), w.get_frozen_balance())
+
+        w.set_frozen_coin_state([self.tx1_hash + ':0'], True)
+        self.assertEqual((1000, 0, 0), w.get_balance())
+        self.assertEqual((0, 0, 0), w.get_balance(exclude_frozen_coins=True))
+        self.assertEqual((0, 0, 0), w.get_addr_balance(self.addr, exclude_frozen_coins=True))
+        self.assertEqual((1000, 0, 0), w.get_frozen_balance())
+
+        w.set_frozen_coin_state([self.tx1_hash + ':0'], False)
+        w.set_frozen_state([self.addr], True)
+        self.assertEqual((0, 0, 0), w.get_balance(exclude_frozen_addresses=True))
+        self.assertEqual((1000, 0, 0), w.get_frozen_balance())
+
+    def test_coinbase_maturity_follows_height(self):
+        w = self.wallet
+        coinbase = Transaction.from_io(
+            [{'type': 'coinbase', 'address': None, 'scriptSig': '00'}],
+            [(TYPE_ADDRESS, self.addr, 5000)])
+        w.storage.put('stored_height', 150)
+        w.receive_history_callback(self.addr, [('33' * 32, 100)], {})
+        w.add_transaction('33' * 32, coinbase)
+        self.assertEqual((0, 0, 5000), w.get_balance())
+        self.assertEqual([], w.get_utxos(mature=True))
+        w.storage.put('stored_height', 200)
+        self.assertEqual((5000, 0, 0), w.get_balance())
+        self.assertEqual(1, len(w.get_utxos(mature=True)))
+
+    def test_history_ledger(self):
+        w = self.wallet
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100), (self.tx2_hash, 0)], {})
+        w.add_transaction(self.tx1_hash, self.tx1)
+        w.add_transaction(self.tx2_hash, self.tx2)
+        expected = [(self.tx1_hash, 100, 0, 0, 1000, 1000),
+                    (self.tx2_hash, 0, 0, 0, -1000, 0)]
+        self.assertEqual(expected, w.get_history())
+        self.assertEqual(expected, w.get_history([self.addr]))
+        self.assertEqual(expected[1:], w.get_history(limit=1))
+        self.assertEqual(expected[:1], w.get_history(offset=1))
+        self.assertEqual(expected[1:], w.get_history(since=101))
+
+        # tx2 gets mined and verified; the ledger is patched, not rebuilt
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100), (self.tx2_hash, 105)], {})
+        self.assertEqual([(self.tx1_hash, 100), (self.tx2_hash, 105)],
+                         [(h[0], h[1]) for h in w.get_history()])
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100)], {})
+        self.assertEqual([(self.tx1_hash, 100, 0, 0, 1000, 1000)], w.get_history())
+
+    def test_history_year_page(self):
+        w = self.wallet
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100), (self.tx2_hash, 105)], {})
+        w.add_transaction(self.tx1_hash, self.tx1)
+        w.add_transaction(self.tx2_hash, self.tx2)
+        start = time.mktime(datetime.datetime(2017, 1, 1).timetuple())
+        w.verified_tx[self.tx1_hash] = (100, start + 1000, 1)
+        w.verified_tx[self.tx2_hash] = (105, start + 400 * 86400, 1)
+        w._invalidate_ledger([self.tx1_hash, self.tx2_hash])
+        commands = Commands(None, w, None)
+        # the newest tx is in 2018, so a year's page must not start from it
+        self.assertEqual([self.tx1_hash], [x['txid'] for x in commands.history(year=2017, limit=1)])
+        self.assertEqual([], commands.history(year=2017, limit=1, offset=1))
+        self.assertEqual([self.tx2_hash], [x['txid'] for x in commands.history(year=2018)])
+
+    def test_save_transactions_incremental(self):
+        w = self.wallet
+        # storage needs the txs serialized, which needs their input keys
+        pubkey = '02' + '01' * 32
+        for tx in (self.tx1, self.tx2):
+            for txin in tx.inputs():
+                txin.update(x_pubkeys=[pubkey], pubkeys=[pubkey], signatures=[None], num_sig=1)
+        w.receive_history_callback(self.addr, [(self.tx2_hash, 0)], {})
+        w.add_transaction(self.tx2_hash, self.tx2)
+        w.save_transactions()
+        # the funding tx arrives later and resolves tx2's pruned input
+        w.receive_history_callback(self.addr, [(self.tx1_hash, 100), (self.tx2_hash, 0)], {})
+        w.add_transaction(self.tx1_hash, self.tx1)
+        w.save_transactions(write=True)
+        addr = self.addr.to_storage_string()
+        self.assertEqual({self.tx1_hash: str(self.tx1), self.tx2_hash: str(self.tx2)},
+                         w.storage.get('transactions'))
+        self.assertEqual({addr: [[self.tx1_hash + ':0', 1000]]},
+                         w.storage.get('txi')[self.tx2_hash])
+        self.assertEqual({addr: [[0, 1000, False]]}, w.storage.get('txo')[self.tx1_hash])
+
+        reopened = wallet.ImportedAddressWallet(WalletStorage(self.wallet_path))
+        self.assertEqual(w.txi, reopened.txi)
+        self.assertEqual(w.txo, reopened.txo)
+        self.assertEqual(w.get_balance(), reopened.get_balance())
+
+        # undoing tx1 puts tx2's input back into pruned_txo
+        w.receive_history_callback(self.addr, [(self.tx2_hash, 0)], {})
+        w.save_transactions()
+        self.assertNotIn(self.tx1_hash, w.storage.get('txo'))
+        self.assertEqual({}, w.storage.get('txi')[self.tx2_hash])
+        self.assertEqual({self.tx1_hash + ':0': self.tx2_hash}, w.storage.get('pruned_txo'))
+
+    def test_address_status(self):
+        w = self.wallet
+        self.assertIsNone(w.get_address_status(self.addr))
+        hist = [(self.tx1_hash, 100), (self.tx2_hash, 0)]
+        status = Synchronizer.get_status(hist)
+        w.receive_history_callback(self.addr, hist, {})
+        self.assertEqual(status, w.get_address_status(self.addr))
+        # a status the synchronizer already checked is taken as is
+        w.receive_history_callback(self.addr, hist[:1], {}, status='ab' * 32)
+        self.assertEqual('ab' * 32, w.get_address_status(self.addr))
+        w.receive_history_callback(self.addr, hist, {}, status=status)
+        w.save_transactions(write=True)
+
+        with mock.patch.object(Synchronizer, 'get_status') as get_status:
+            reopened = wallet.ImportedAddressWallet(WalletStorage(self.wallet_path))
+            self.assertEqual(status, reopened.get_address_status(self.addr))
+        get_status.assert_not_called()
+
+        # a history saved without its status is not trusted with the old one
+        w.storage.put('addr_history', {self.addr.to_storage_string(): [list(hist[0])]})
+        w.storage.write()
+        reopened = wallet.ImportedAddressWallet(WalletStorage(self.wallet_path))
+        self.assertEqual(Synchronizer.get_status(hist[:1]), reopened.get_address_status(self.addr))
+
+        # nor is one rewritten to the same length, as by a reorg
+        w.receive_history_callback(self.addr, hist, {}, status=status)
+        w.save_transactions(write=True)
+        moved = [(self.tx1_hash, 101), (self.tx2_hash, 0)]
+        w.storage.put('addr_history', {self.addr.to_storage_string(): [list(h) for h in moved]})
+        w.storage.write()
+        reopened = wallet.ImportedAddressWallet(WalletStorage(self.wallet_path))
+        self.assertEqual(Synchronizer.get_status(moved), reopened.get_address_status(self.addr))
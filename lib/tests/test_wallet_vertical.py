@@ -137,3 +137,45 @@ class TestWalletKeystoreAddressIntegrity(unittest.TestCase):
                          Address.from_string('3H3iyACDTLJGD2RMjwKZcCwpdYZLwEZzKb'))
         self.assertEqual(w.get_change_addresses()[0],
                          Address.from_string('31hyfHrkhNjiPZp1t7oky5CGNYqSqDAVM9'))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_synchronize_gap(self, mock_write):
+        ks = keystore.from_xpub('xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U')
+        self.assertEqual(ks.derive_pubkeys(False, range(3)), [ks.derive_pubkey(False, n) for n in range(3)])
+        self.assertEqual(ks.derive_pubkeys(True, [5]), [ks.derive_pubkey(True, 5)])
+        w = self._create_standard_wallet(ks)
+        w.gap_limit = 5
+        w.synchronize()
+        self.assertEqual(len(w.get_receiving_addresses()), 5)
+        self.assertEqual(len(w.get_change_addresses()), w.gap_limit_for_change)
+
+        # the gap starts after the last used address
+        used = {w.get_receiving_addresses()[3]}
+        with mock.patch.object(w, 'address_is_old', lambda a: a in used):
+            w.synchronize()
+        self.assertEqual(len(w.get_receiving_addresses()), 9)
+        for i, addr in enumerate(w.get_receiving_addresses()):
+            self.assertEqual(addr, Address.from_pubkey(ks.derive_pubkey(False, i)))
+            self.assertEqual(w.get_address_index(addr), (False, i))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_address_index(self, mock_write):
+        ks = keystore.from_xpub('xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U')
+        w = self._create_standard_wallet(ks)
+        new_addr = w.create_new_address(False)
+
+        for i, addr in enumerate(w.get_receiving_addresses()):
+            self.assertTrue(w.is_mine(addr))
+            self.assertFalse(w.is_change(addr))
+            self.assertEqual(w.get_address_index(addr), (False, i))
+        for i, addr in enumerate(w.get_change_addresses()):
+            self.assertTrue(w.is_mine(addr))
+            self.assertTrue(w.is_change(addr))
+            self.assertEqual(w.get_address_index(addr), (True, i))
+        self.assertEqual(w.get_address_index(new_addr), (False, len(w.get_receiving_addresses()) - 1))
+
+        foreign = Address.from_string('1KRW8pH6HFHZh889VDq6fEKvmrsmApwNfe')
+        self.assertFalse(w.is_mine(foreign))
+        self.assertFalse(w.is_change(foreign))
+        with self.assertRaises(Exception):
+            w.get_address_index(foreign)
@@ -27,11 +27,14 @@
 
 # Note: The deserialization code originally comes from ABE.
 
-from .util import print_error, profiler
+from .util import print_error
 
 from .bitcoin import *
 from .address import (PublicKey, Address, Script, ScriptOutput, hash160,
                       UnknownAddress, OpCodes as opcodes)
+from . import ecc_fast
+from collections import defaultdict
+import concurrent.futures
 import struct
 
 #
@@ -42,6 +45,21 @@ from .keystore import xpubkey_to_address, xpubkey_to_pubkey
 NO_SIGNATURE = 'ff'
 
 
+def sign_digests(sec, digests):
+    '''DER signatures of digests with the private key sec, each checked.'''
+    sigs = ecc_fast.sign_digests(sec, digests)
+    if sigs is not None:
+        return sigs
+    private_key = MySigningKey.from_secret_exponent(regenerate_key(sec).secret, curve = SECP256k1)
+    public_key = private_key.get_verifying_key()
+    sigs = []
+    for pre_hash in digests:
+        sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
+        assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
+        sigs.append(sig)
+    return sigs
+
+
 class SerializationError(Exception):
     """ Thrown when there's a problem deserializing or serializing """
 
@@ -299,6 +317,12 @@ def parse_redeemScript(s):
     return m, n, x_pubkeys, pubkeys, redeemScript
 
 def get_address_from_output_script(_bytes):
+    # The common cases first, without decoding the script
+    if len(_bytes) == 25 and _bytes[:3] == b'\x76\xa9\x14' and _bytes[23:] == b'\x88\xac':
+        return TYPE_ADDRESS, Address.from_P2PKH_hash(bytes(_bytes[3:23]))
+    if len(_bytes) == 23 and _bytes[:2] == b'\xa9\x14' and _bytes[22] == opcodes.OP_EQUAL:
+        return TYPE_ADDRESS, Address.from_P2SH_hash(bytes(_bytes[2:22]))
+
     decoded = [x for x in script_GetOp(_bytes)]
 
     # The Genesis Block, self-payments, and pay-by-IP-address payments look like:
@@ -360,8 +384,9 @@ def parse_output(vds, i):
 
 
 def deserialize(raw):
+    '''Parses raw, a transaction in hex or as bytes.'''
     vds = BCDataStream()
-    vds.write(bfh(raw))
+    vds.write(bfh(raw) if isinstance(raw, str) else raw)
     d = {}
     start = vds.read_cursor
     d['version'] = vds.read_int32()
@@ -411,6 +436,7 @@ class Transaction:
             raise BaseException("cannot initialize transaction", raw)
         self._inputs = None
         self._outputs = None
+        self._sighash_cache = None
         self.locktime = 0
         self.version = 1
         
@@ -423,6 +449,7 @@ class Transaction:
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self._sighash_cache = None
         self.deserialize()
 
     def inputs(self):
@@ -457,7 +484,7 @@ class Transaction:
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                pre_hash = Hash(bfh(self.serialize_preimage(i)))
+                pre_hash = Hash(self.serialize_preimage_bytes(i))
                 # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(bfh(sig[:-2]), order)
@@ -482,6 +509,7 @@ class Transaction:
             return
         d = deserialize(self.raw)
         self._inputs = d['inputs']
+        self._sighash_cache = None
         self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
         assert all(isinstance(output[1], (PublicKey, Address, ScriptOutput))
                    for output in self._outputs)
@@ -496,6 +524,7 @@ class Transaction:
         self = klass(None)
         self._inputs = inputs
         self._outputs = outputs.copy()
+        self._sighash_cache = None
         self.locktime = locktime
         return self
 
@@ -596,72 +625,94 @@ class Transaction:
         else:
             raise RuntimeError('Unknown txin type', _type)
 
+    @classmethod
+    def serialize_outpoint_bytes(self, txin):
+        return bfh(txin['prevout_hash'])[::-1] + struct.pack('<I', txin['prevout_n'])
+
     @classmethod
     def serialize_outpoint(self, txin):
-        return bh2u(bfh(txin['prevout_hash'])[::-1]) + int_to_hex(txin['prevout_n'], 4)
+        return bh2u(self.serialize_outpoint_bytes(txin))
 
     @classmethod
-    def serialize_input(self, txin, script, estimate_size=False):
-        # Prev hash and index
-        s = self.serialize_outpoint(txin)
-        # Script length, script, sequence
-        s += var_int(len(script)//2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
+    def serialize_input_bytes(self, txin, script, estimate_size=False):
+        '''serialize_input() as bytes, from script as bytes.'''
+        # Prev hash and index, script length, script, sequence
+        s = (self.serialize_outpoint_bytes(txin) + var_int_bytes(len(script)) + script
+             + struct.pack('<I', txin.get('sequence', 0xffffffff - 1)))
         # offline signing needs to know the input value
         if ('value' in txin   # Legacy txs
             and not (estimate_size or self.is_txin_complete(txin))):
-            s += int_to_hex(txin['value'], 8)
+            s += struct.pack('<Q', txin['value'])
         return s
 
+    @classmethod
+    def serialize_input(self, txin, script, estimate_size=False):
+        return bh2u(self.serialize_input_bytes(txin, bfh(script), estimate_size))
+
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[1])))
+        self._sighash_cache = None
 
-    def serialize_output(self, output):
+    def serialize_output_bytes(self, output):
         output_type, addr, amount = output
-        s = int_to_hex(amount, 8)
-        script = self.pay_script(addr)
-        s += var_int(len(script)//2)
-        s += script
-        return s
+        script = bfh(self.pay_script(addr))
+        return struct.pack('<Q', amount) + var_int_bytes(len(script)) + script
+
+    def serialize_output(self, output):
+        return bh2u(self.serialize_output_bytes(output))
 
     @classmethod
     def nHashType(cls):
         '''Hash type in hex.'''
         return 0x01 | (cls.SIGHASH_FORKID + (cls.FORKID << 8))
 
-    def serialize_preimage(self, i):
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(self.nHashType(), 4)
-        nLocktime = int_to_hex(self.locktime, 4)
-        inputs = self.inputs()
-        outputs = self.outputs()
-        txin = inputs[i]
-
-        hashPrevouts = bh2u(Hash(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
-        hashSequence = bh2u(Hash(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
-        hashOutputs = bh2u(Hash(bfh(''.join(self.serialize_output(o) for o in outputs))))
-        outpoint = self.serialize_outpoint(txin)
-        preimage_script = self.get_preimage_script(txin)
-        scriptCode = var_int(len(preimage_script) // 2) + preimage_script
+    def calc_common_sighash(self):
+        '''hashPrevouts, hashSequence and hashOutputs, the parts of the
+        preimage which are the same for every input.  Cached until the
+        inputs or outputs change, so signing all inputs hashes the
+        transaction once rather than once per input.'''
+        if self._sighash_cache is None:
+            inputs = self.inputs()
+            prevouts = b''.join(self.serialize_outpoint_bytes(txin) for txin in inputs)
+            sequences = b''.join(struct.pack('<I', txin.get('sequence', 0xffffffff - 1))
+                                 for txin in inputs)
+            outputs = b''.join(self.serialize_output_bytes(o) for o in self.outputs())
+            self._sighash_cache = (Hash(prevouts), Hash(sequences), Hash(outputs))
+        return self._sighash_cache
+
+    def serialize_preimage_bytes(self, i):
+        txin = self.inputs()[i]
+        hashPrevouts, hashSequence, hashOutputs = self.calc_common_sighash()
+        outpoint = self.serialize_outpoint_bytes(txin)
+        preimage_script = bfh(self.get_preimage_script(txin))
+        scriptCode = var_int_bytes(len(preimage_script)) + preimage_script
         try:
-            amount = int_to_hex(txin['value'], 8)
+            amount = struct.pack('<Q', txin['value'])
         except KeyError:
             raise InputValueMissing
-        nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
-        return preimage
+        nSequence = struct.pack('<I', txin.get('sequence', 0xffffffff - 1))
+        return (struct.pack('<i', self.version) + hashPrevouts + hashSequence + outpoint
+                + scriptCode + amount + nSequence + hashOutputs
+                + struct.pack('<I', self.locktime) + struct.pack('<I', self.nHashType()))
 
-    def serialize(self, estimate_size=False):
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+    def serialize_preimage(self, i):
+        return bh2u(self.serialize_preimage_bytes(i))
+
+    def serialize_bytes(self, estimate_size=False):
         inputs = self.inputs()
         outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size), estimate_size) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-        return nVersion + txins + txouts + nLocktime
+        parts = [struct.pack('<i', self.version), var_int_bytes(len(inputs))]
+        parts.extend(self.serialize_input_bytes(txin, bfh(self.input_script(txin, estimate_size)), estimate_size)
+                     for txin in inputs)
+        parts.append(var_int_bytes(len(outputs)))
+        parts.extend(self.serialize_output_bytes(o) for o in outputs)
+        parts.append(struct.pack('<I', self.locktime))
+        return b''.join(parts)
+
+    def serialize(self, estimate_size=False):
+        return bh2u(self.serialize_bytes(estimate_size))
 
     def hash(self):
         print("warning: deprecated tx.hash()")
@@ -670,17 +721,18 @@ class Transaction:
     def txid(self):
         if not self.is_complete():
             return None
-        ser = self.serialize()
-        return bh2u(Hash(bfh(ser))[::-1])
+        return bh2u(Hash(self.serialize_bytes())[::-1])
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
+        self._sighash_cache = None
         self.raw = None
 
     def add_outputs(self, outputs):
         assert all(isinstance(output[1], (PublicKey, Address, ScriptOutput))
                    for output in outputs)
         self._outputs.extend(outputs)
+        self._sighash_cache = None
         self.raw = None
 
     def input_value(self):
@@ -692,17 +744,52 @@ class Transaction:
     def get_fee(self):
         return self.input_value() - self.output_value()
 
-    @profiler
     def estimated_size(self):
         '''Return an estimated tx size in bytes.'''
-        return (len(self.serialize(True)) // 2 if not self.is_complete() or self.raw is None
-                else len(self.raw) // 2)  # ASCII hex string
+        if self.is_complete() and self.raw is not None:
+            return len(self.raw) // 2  # ASCII hex string
+        inputs = self.inputs()
+        outputs = self.outputs()
+        return (4 + len(var_int_bytes(len(inputs)))
+                + sum(self.estimated_input_size(txin) for txin in inputs)
+                + len(var_int_bytes(len(outputs)))
+                + sum(self.estimated_output_size(o) for o in outputs) + 4)
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
-        script = self.input_script(txin, True)
-        return len(self.serialize_input(txin, script, True)) // 2  # ASCII hex string
+        script_size = self.estimated_input_script_size(txin)
+        if script_size is None:
+            script = self.input_script(txin, True)
+            return len(self.serialize_input_bytes(txin, bfh(script), True))
+        # Outpoint, script length, script, sequence
+        return 36 + len(var_int_bytes(script_size)) + script_size + 4
+
+    @classmethod
+    def estimated_input_script_size(cls, txin):
+        '''The size of input_script(txin, True), worked out from the type of
+        txin, its number of signatures and public keys and the size of the
+        keys.  None for types whose script is not made up here.'''
+        _type = txin['type']
+        if _type not in ('p2pkh', 'p2pk', 'p2sh'):
+            return None
+        pubkey_size = cls.estimate_pubkey_size_for_txin(txin)
+        # Pushes of 0x48 byte signatures, as in get_siglist()
+        size = txin.get('num_sig', 1) * (1 + 0x48)
+        if _type == 'p2pkh':
+            size += 1 + pubkey_size
+        elif _type == 'p2sh':
+            # OP_0, then the redeem script: m, the keys, n, OP_CHECKMULTISIG
+            num_pubkeys = len(txin.get('x_pubkeys', [None]))
+            redeem_script_size = 3 + num_pubkeys * (1 + pubkey_size)
+            size += 1 + len(op_push(redeem_script_size)) // 2 + redeem_script_size
+        return size
+
+    @classmethod
+    def estimated_output_size(cls, output):
+        '''Return the serialized size of output in bytes.'''
+        script_size = len(output[1].to_script())
+        return 8 + len(var_int_bytes(script_size)) + script_size
 
     def signature_count(self):
         r = 0
@@ -719,30 +806,48 @@ class Transaction:
         s, r = self.signature_count()
         return r == s
 
-    def sign(self, keypairs):
+    def sign(self, keypairs, *, processes=1):
+        '''Signs the inputs with the keys in keypairs.  processes > 1 spreads
+        the signatures over that many processes, which only pays off for
+        many inputs signed without libsecp256k1.'''
+        # What each key signs: (sec, compressed) -> [(i, j, pre_hash)]
+        jobs = defaultdict(list)
         for i, txin in enumerate(self.inputs()):
             num = txin['num_sig']
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            count = len(list(filter(None, txin['signatures'])))
+            pre_hash = None
             for j, x_pubkey in enumerate(x_pubkeys):
-                signatures = list(filter(None, txin['signatures']))
-                if len(signatures) == num:
+                if count == num:
                     # txin is complete
                     break
                 if x_pubkey in keypairs.keys():
                     print_error("adding signature for", x_pubkey)
-                    sec, compressed = keypairs.get(x_pubkey)
-                    pubkey = public_key_from_private_key(sec, compressed)
-                    # add signature
-                    pre_hash = Hash(bfh(self.serialize_preimage(i)))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = MySigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
-                    assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
-                    txin['signatures'][j] = bh2u(sig) + int_to_hex(self.nHashType() & 255, 1)
-                    txin['pubkeys'][j] = pubkey # needed for fd keys
-                    self._inputs[i] = txin
+                    if pre_hash is None:
+                        pre_hash = Hash(self.serialize_preimage_bytes(i))
+                    jobs[keypairs[x_pubkey]].append((i, j, pre_hash))
+                    count += 1
+
+        # Each key signs all it has to in one go, in as many parts as processes
+        parts = []
+        for key, todo in jobs.items():
+            size = -(-len(todo) // processes)
+            parts.extend((key, todo[n:n + size]) for n in range(0, len(todo), size))
+        args = ([key[0] for key, todo in parts],
+                [[pre_hash for i, j, pre_hash in todo] for key, todo in parts])
+        if processes > 1 and len(parts) > 1:
+            with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+                results = list(executor.map(sign_digests, *args))
+        else:
+            results = map(sign_digests, *args)
+
+        sighash = int_to_hex(self.nHashType() & 255, 1)
+        pubkeys = {key: public_key_from_private_key(*key) for key in jobs}
+        for (key, todo), sigs in zip(parts, results):
+            for (i, j, pre_hash), sig in zip(todo, sigs):
+                txin = self._inputs[i]
+                txin['signatures'][j] = bh2u(sig) + sighash
+                txin['pubkeys'][j] = pubkeys[key] # needed for fd keys
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
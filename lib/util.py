@@ -23,7 +23,7 @@
 
 import binascii
 import os, sys, re, json, time
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
 from decimal import Decimal as PyDecimal  # Qt 5.12 also exports Decimal
 import traceback
@@ -604,9 +604,19 @@ import socket
 import ssl
 
 class SocketPipe(PrintError):
+    # Bytes asked of the socket per read.  Server replies such as
+    # blockchain.block.headers chunks or long histories run to megabytes.
+    RECV_SIZE = 256 * 1024
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        # Received bytes not yet split into messages.  Everything before
+        # self.scanned is known to contain no newline.
+        self.buffer = bytearray()
+        self.scanned = 0
+        # Messages parsed from the buffer but not yet returned by get()
+        self.messages = deque()
+        self.recv_view = memoryview(bytearray(self.RECV_SIZE))
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -616,13 +626,32 @@ class SocketPipe(PrintError):
     def idle_time(self):
         return time.time() - self.recv_time
 
+    def parse_messages(self):
+        '''Move every complete newline terminated message in the buffer
+        to self.messages.  Lines that are not valid JSON are dropped.'''
+        buf = self.buffer
+        start = 0
+        n = buf.find(b'\n', self.scanned)
+        if n == -1:
+            self.scanned = len(buf)
+            return
+        with memoryview(buf) as view:
+            while n != -1:
+                try:
+                    self.messages.append(json.loads(str(view[start:n], 'utf8')))
+                except ValueError:
+                    pass
+                start = n + 1
+                n = buf.find(b'\n', start)
+        del buf[:start]
+        self.scanned = len(buf)
+
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
-                return response
+            if self.messages:
+                return self.messages.popleft()
             try:
-                data = self.socket.recv(1024)
+                size = self.socket.recv_into(self.recv_view)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -631,20 +660,21 @@ class SocketPipe(PrintError):
                 if err.errno == 60:
                     raise timeout
                 elif err.errno in [11, 35, 10035]:
-                    self.print_error("socket errno %d (resource temporarily unavailable)"% err.errno)
-                    time.sleep(0.2)
+                    # EAGAIN/EWOULDBLOCK: a non-blocking socket has nothing
+                    # more to read for now.
                     raise timeout
                 else:
                     self.print_error("socket error:", err)
-                    data = b''
+                    size = 0
             except:
                 traceback.print_exc(file=sys.stderr)
-                data = b''
+                size = 0
 
-            if not data:  # Connection closed remotely
+            if not size:  # Connection closed remotely
                 return None
-            self.message += data
+            self.buffer += self.recv_view[:size]
             self.recv_time = time.time()
+            self.parse_messages()
 
     def send(self, request):
         out = json.dumps(request) + '\n'
@@ -20,8 +20,11 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+from collections import defaultdict
+from hashlib import sha256
+
 from .util import ThreadJob, bh2u
-from .bitcoin import Hash, hash_decode, hash_encode
+from .bitcoin import hash_decode, hash_encode
 from . import networks
 from .transaction import Transaction
 
@@ -36,9 +39,16 @@ class SPV(ThreadJob):
         self.blockchain = network.blockchain()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self.merkle_responses = []  # proofs received, checked by run()
+        # (wallet.unverified_tx_changes, local height, blockchain) as of the
+        # last scan of the unverified txs that left none to request
+        self.last_scan = None
         self.qbusy = False
 
     def run(self):
+        if self.merkle_responses:
+            self.verify_merkle_batch()
+
         interface = self.network.interface
         if not interface:
             self.print_error("v.no interface")
@@ -50,6 +60,18 @@ class SPV(ThreadJob):
             return
 
         local_height = self.network.get_local_height()
+        scan = (self.wallet.unverified_tx_changes, local_height, blockchain)
+        if scan != self.last_scan:
+            self.last_scan = scan if self.request_merkles(interface, blockchain, local_height) else None
+
+        if self.network.blockchain() != self.blockchain:
+            self.blockchain = self.network.blockchain()
+            self.undo_verifications()
+
+    def request_merkles(self, interface, blockchain, local_height):
+        '''Request the proofs of the unverified txs that can be checked.
+        Returns False if some are left for later.'''
+        complete = True
         unverified = self.wallet.get_unverified_txs().copy()
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
@@ -62,6 +84,7 @@ class SPV(ThreadJob):
             # if it's in the checkpoint region, we still might not have the header
             header = blockchain.read_header(tx_height)
             if header is None:
+                complete = False
                 if tx_height <= networks.net.VERIFICATION_BLOCK_HEIGHT:
                     # Per-header requests might be a lot heavier.
                     # Also, they're not supported as header requests are
@@ -76,36 +99,59 @@ class SPV(ThreadJob):
             self.qbusy = msg_id is None
             if self.qbusy:
                 # interface queue busy, will try again later
-                break
+                return False
             self.print_error('requested merkle', tx_hash)
             self.requested_merkle.add(tx_hash)
-
-        if self.network.blockchain() != self.blockchain:
-            self.blockchain = self.network.blockchain()
-            self.undo_verifications()
+        return complete
 
     def verify_merkle(self, response):
+        '''Merkle proof callback.  The proofs are checked together, a
+        header per block, on the next run().'''
         if self.wallet.verifier is None:
             return  # we have been killed, this was just an orphan callback
         if response.get('error'):
             # FIXME: tx will never verify now until server reconnect.
             self.print_error('received an error:', response)
             return
-        params = response['params']
-        merkle = response['result']
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        tx_hash = params[0]
-        tx_height = merkle.get('block_height')
+        self.merkle_responses.append(response)
+
+    def verify_merkle_batch(self):
+        responses, self.merkle_responses = self.merkle_responses, []
+        if self.wallet.verifier is None:
+            return
+        by_height = defaultdict(list)
+        for response in responses:
+            tx_hash = response['params'][0]
+            merkle = response['result']
+            tx_height = merkle.get('block_height')
+            if not isinstance(tx_height, int):
+                self.print_error("merkle verification failed for {} (bad height {!r})"
+                                 .format(tx_hash, tx_height))
+                continue
+            by_height[tx_height].append((tx_hash, merkle))
+
+        blockchain = self.network.blockchain()
+        verified = False
+        for tx_height, proofs in by_height.items():
+            header = blockchain.read_header(tx_height)
+            for tx_hash, merkle in proofs:
+                verified |= self.verify_proof(tx_hash, tx_height, merkle, header)
+        if verified and self.is_up_to_date() and self.wallet.is_up_to_date() and not self.qbusy:
+            self.wallet.save_verified_tx(write=True)
+            self.network.trigger_callback('updated', self.wallet)  # This callback will happen very rarely.. mostly right as the last tx is verified. It's to ensure GUI is updated fully.
+
+    def verify_proof(self, tx_hash, tx_height, merkle, header):
+        '''Verify the hash of the server-provided merkle branch to a
+        transaction matches the merkle root of its block.  Returns True
+        if the tx was verified.'''
         pos = merkle.get('pos')
         try:
             merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
         except InnerNodeOfSpvProofIsValidTx:
             self.print_error("merkle verification failed for {} (inner node looks like tx)"
                              .format(tx_hash))
-            return
+            return False
 
-        header = self.network.blockchain().read_header(tx_height)
         # FIXME: if verification fails below,
         # we should make a fresh connection to a server to
         # recover from this, as this TX will now never verify
@@ -113,12 +159,12 @@ class SPV(ThreadJob):
             self.print_error(
                 "merkle verification failed for {} (missing header {})"
                 .format(tx_hash, tx_height))
-            return
+            return False
         if header.get('merkle_root') != merkle_root:
             self.print_error(
                 "merkle verification failed for {} (merkle root mismatch {} != {})"
                 .format(tx_hash, header.get('merkle_root'), merkle_root))
-            return
+            return False
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
         try:
@@ -129,25 +175,39 @@ class SPV(ThreadJob):
             pass
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
-        if self.is_up_to_date() and self.wallet.is_up_to_date() and not self.qbusy:
-            self.wallet.save_verified_tx(write=True)
-            self.network.trigger_callback('updated', self.wallet)  # This callback will happen very rarely.. mostly right as the last tx is verified. It's to ensure GUI is updated fully.
+        return True
 
     @classmethod
     def hash_merkle_root(cls, merkle_s, target_hash, pos):
         h = hash_decode(target_hash)
         for i, item in enumerate(merkle_s):
-            h = Hash(hash_decode(item) + h) if ((pos >> i) & 1) else Hash(h + hash_decode(item))
-            cls._raise_if_valid_tx(bh2u(h))
+            item = bytes.fromhex(item)[::-1]
+            node = item + h if (pos >> i) & 1 else h + item
+            cls._raise_if_valid_tx(node)
+            h = sha256(sha256(node).digest()).digest()
         return hash_encode(h)
 
+    # The shortest serialization deserialize() accepts: version, one input
+    # with an empty scriptSig, no outputs and the locktime.
+    MIN_TX_SIZE = 4 + 1 + (32 + 4 + 1 + 4) + 1 + 4
+    MIN_TXIN_SIZE = 32 + 4 + 1 + 4
+
     @classmethod
-    def _raise_if_valid_tx(cls, raw_tx: str):
+    def _raise_if_valid_tx(cls, raw_tx: bytes):
         # If an inner node of the merkle proof is also a valid tx, chances are, this is an attack.
         # https://lists.linuxfoundation.org/pipermail/bitcoin-dev/2018-June/016105.html
         # https://lists.linuxfoundation.org/pipermail/bitcoin-dev/attachments/20180609/9f4f5b1f/attachment-0001.pdf
         # https://bitcoin.stackexchange.com/questions/76121/how-is-the-leaf-node-weakness-in-merkle-trees-exploitable/76122#76122
-        tx = Transaction(raw_tx)
+        # Inner nodes are 64 bytes.  Almost none get past a look at the input
+        # count and the length of the first scriptSig, so few are deserialized.
+        if len(raw_tx) < cls.MIN_TX_SIZE:
+            return
+        n_vin = raw_tx[4]
+        if n_vin == 0 or n_vin >= 0xfd or 4 + 1 + n_vin * cls.MIN_TXIN_SIZE + 1 + 4 > len(raw_tx):
+            return
+        if cls.MIN_TX_SIZE + raw_tx[41] > len(raw_tx):
+            return
+        tx = Transaction(bh2u(raw_tx))
         try:
             tx.deserialize()
         except:
@@ -161,6 +221,7 @@ class SPV(ThreadJob):
         for tx_hash in tx_hashes:
             self.print_error("redoing", tx_hash)
             self.remove_spv_proof_for_tx(tx_hash)
+        self.last_scan = None
         self.qbusy = False
             
     def remove_spv_proof_for_tx(self, tx_hash):
@@ -29,13 +29,15 @@
 
 
 import os
+import bisect
 import threading
 import random
 import time
 import json
 import copy
 import errno
-from collections import defaultdict
+import itertools
+from collections import defaultdict, OrderedDict
 from decimal import Decimal as PyDecimal  # Qt 5.12 also exports Decimal
 from functools import partial
 
@@ -151,6 +153,151 @@ def sweep(privkeys, network, config, recipient, fee=None, imax=100):
     return tx
 
 
+def history_fingerprint(hist):
+    '''A cheap summary of an address history, saved with its status: the
+    number of txs, the sum of their heights and the last tx.  A history
+    written without its status, even to the same length (a reorg moving
+    txs to other heights, or an older client), then no longer matches.'''
+    if not hist:
+        return '0'
+    tx_hash, height = hist[-1]
+    return '{}:{}:{}:{}'.format(len(hist), sum(h for _, h in hist), tx_hash, height)
+
+
+class TransactionStore:
+    '''Map of tx_hash -> Transaction for the wallet's transactions.
+
+    Only the raw bytes of each transaction are kept.  Transaction objects
+    are built on first access and the most recently used max_cached of
+    them are kept, so repeated lookups of the same tx are cheap and return
+    the same (possibly already deserialized) object, while the bulk of a
+    large wallet's transactions never get materialized.
+
+    A transaction that cannot be serialized yet (its inputs lack what
+    serialize() needs) is kept as the object itself until its raw form is
+    asked for.
+
+    The hashes of transactions added, changed or removed since the last
+    call to pop_unsaved() are remembered, so the wallet can update what it
+    hands to storage instead of rebuilding it.'''
+
+    def __init__(self, max_cached=1000):
+        self.max_cached = max_cached
+        self._raw = {}
+        self._partial = {}
+        self._cache = OrderedDict()
+        self._unsaved = set()
+        self._lock = threading.Lock()
+
+    def _cache_put(self, tx_hash, tx):
+        # caller holds self._lock
+        self._cache[tx_hash] = tx
+        self._cache.move_to_end(tx_hash)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def set_raw(self, tx_hash, raw):
+        '''Add a transaction from its raw hex without building it.'''
+        raw = bytes.fromhex(raw)
+        with self._lock:
+            self._raw[tx_hash] = raw
+            self._partial.pop(tx_hash, None)
+            self._cache.pop(tx_hash, None)
+            self._unsaved.add(tx_hash)
+
+    def get_raw(self, tx_hash):
+        '''The raw hex of tx_hash, or None.'''
+        with self._lock:
+            tx = self._partial.get(tx_hash)
+            if tx is not None:
+                self._raw[tx_hash] = bytes.fromhex(str(tx))
+                del self._partial[tx_hash]
+            raw = self._raw.get(tx_hash)
+        return None if raw is None else raw.hex()
+
+    def __setitem__(self, tx_hash, tx):
+        try:
+            raw = bytes.fromhex(str(tx))
+        except Exception:
+            raw = None
+        with self._lock:
+            if raw is None:
+                self._raw.pop(tx_hash, None)
+                self._partial[tx_hash] = tx
+                self._unsaved.add(tx_hash)
+            elif tx_hash in self._partial or self._raw.get(tx_hash) != raw:
+                self._partial.pop(tx_hash, None)
+                self._raw[tx_hash] = raw
+                self._unsaved.add(tx_hash)
+            self._cache_put(tx_hash, tx)
+
+    def __getitem__(self, tx_hash):
+        with self._lock:
+            tx = self._cache.get(tx_hash) or self._partial.get(tx_hash)
+            if tx is None:
+                tx = Transaction(self._raw[tx_hash].hex())
+            self._cache_put(tx_hash, tx)
+            return tx
+
+    def get(self, tx_hash, default=None):
+        try:
+            return self[tx_hash]
+        except KeyError:
+            return default
+
+    def pop(self, tx_hash, *default):
+        with self._lock:
+            tx = self._cache.pop(tx_hash, None)
+            partial = self._partial.pop(tx_hash, None)
+            raw = self._raw.pop(tx_hash, None)
+            self._unsaved.add(tx_hash)
+        if tx is None:
+            tx = partial
+        if raw is None and tx is None:
+            if default:
+                return default[0]
+            raise KeyError(tx_hash)
+        return tx if tx is not None else Transaction(raw.hex())
+
+    def clear(self):
+        with self._lock:
+            self._unsaved.update(self._raw)
+            self._unsaved.update(self._partial)
+            self._raw.clear()
+            self._partial.clear()
+            self._cache.clear()
+
+    def pop_unsaved(self):
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, set()
+        return unsaved
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._raw or tx_hash in self._partial
+
+    def __len__(self):
+        return len(self._raw) + len(self._partial)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self._lock:
+            return list(self._raw) + list(self._partial)
+
+    def items(self):
+        '''Materializes every transaction (through the cache); prefer
+        iterating the keys.'''
+        for tx_hash in self.keys():
+            tx = self.get(tx_hash)
+            if tx is not None:
+                yield tx_hash, tx
+
+    def values(self):
+        for tx_hash, tx in self.items():
+            yield tx
+
+
 class Abstract_Wallet(PrintError):
     """
     Wallet classes are created to handle various address generation methods.
@@ -181,13 +328,26 @@ class Abstract_Wallet(PrintError):
         # BOTH levels of freezing.
         self.frozen_coins = set(storage.get('frozen_coins', []))
         # address -> list(txid, height)
-        history = storage.get('addr_history',{})
-        self._history = self.to_Address_dict(history)
+        history = storage.peek('addr_history',{})
+        # Address objects by storage string while loading, so that each
+        # address is parsed once and shared by _history, txi and txo.
+        addr_cache = {}
+        self._history = self.to_Address_dict(history, addr_cache)
+        # address -> protocol status of its history, computed on demand.
+        # Saved with the history as [status, history_fingerprint()], which
+        # guards against a history written without its status.
+        self._addr_status = {}
+        statuses = self.to_Address_dict(storage.peek('addr_status', {}), addr_cache)
+        for addr, (status, fingerprint) in statuses.items():
+            if history_fingerprint(self._history.get(addr, ())) == fingerprint:
+                self._addr_status[addr] = status
 
         self.load_keystore()
         self.load_addresses()
-        self.load_transactions()
+        self.load_transactions(addr_cache)
         self.build_reverse_history()
+        self.build_utxo_index()
+        self.build_history_ledger()
 
         # load requests
         requests = self.storage.get('payment_requests', {})
@@ -199,9 +359,12 @@ class Abstract_Wallet(PrintError):
         # Transactions pending verification.  A map from tx hash to transaction
         # height.  Access is not contended so no lock is needed.
         self.unverified_tx = defaultdict(int)
+        # Bumped on additions to unverified_tx, so the verifier can tell
+        # whether there may be new txs to request proofs for.
+        self.unverified_tx_changes = 0
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        self.verified_tx = dict(storage.peek('verified_tx3', {}))
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
@@ -222,9 +385,19 @@ class Abstract_Wallet(PrintError):
         self.contacts = Contacts(self.storage)
 
     @classmethod
-    def to_Address_dict(cls, d):
-        '''Convert a dict of strings to a dict of Adddress objects.'''
-        return {Address.from_string(text): value for text, value in d.items()}
+    def to_Address_dict(cls, d, cache=None):
+        '''Convert a dict of strings to a dict of Adddress objects.  If
+        given, cache maps strings to already built Address objects and is
+        updated with the new ones.'''
+        if cache is None:
+            return {Address.from_string(text): value for text, value in d.items()}
+        result = {}
+        for text, value in d.items():
+            addr = cache.get(text)
+            if addr is None:
+                addr = cache[text] = Address.from_string(text)
+            result[addr] = value
+        return result
 
     @classmethod
     def from_Address_dict(cls, d):
@@ -242,47 +415,89 @@ class Abstract_Wallet(PrintError):
         return None
 
     @profiler
-    def load_transactions(self):
-        txi = self.storage.get('txi', {})
-        self.txi = {tx_hash: self.to_Address_dict(value)
-                    for tx_hash, value in txi.items()}
-        txo = self.storage.get('txo', {})
-        self.txo = {tx_hash: self.to_Address_dict(value)
-                    for tx_hash, value in txo.items()}
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
+    def load_transactions(self, addr_cache=None):
+        # The stored values are not copied (see WalletStorage.peek), so the
+        # txi/txo item lists, which are modified in place, are rebuilt.
+        def load_txio(key):
+            return {tx_hash: self.to_Address_dict({text: [tuple(item) for item in l]
+                                                   for text, l in value.items()},
+                                                  addr_cache)
+                    for tx_hash, value in self.storage.peek(key, {}).items()}
+        self.txi = load_txio('txi')
+        self.txo = load_txio('txo')
+        self.tx_fees = dict(self.storage.peek('tx_fees', {}))
+        self.pruned_txo = dict(self.storage.peek('pruned_txo', {}))
+        pruned_spenders = set(self.pruned_txo.values())
+        tx_list = self.storage.peek('transactions', {})
+        self.transactions = TransactionStore()
+        # txs whose txi/txo changed since save_transactions(), and the
+        # (transactions, txi, txo) dicts it last handed to storage
+        self._txio_unsaved = set()
+        self._saved_txio = None
         for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in pruned_spenders):
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                continue
+            self.transactions.set_raw(tx_hash, raw)
 
     @profiler
     def save_transactions(self, write=False):
+        # Hands storage fresh dicts it can own (put_owned), patched from the
+        # previous ones for the txs that changed since, so neither side has
+        # to deep copy the unchanged bulk of a large wallet.
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            txi = {tx_hash: self.from_Address_dict(value)
-                   for tx_hash, value in self.txi.items()}
-            txo = {tx_hash: self.from_Address_dict(value)
-                   for tx_hash, value in self.txo.items()}
-            self.storage.put('txi', txi)
-            self.storage.put('txo', txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('pruned_txo', self.pruned_txo)
+            tx_changed = self.transactions.pop_unsaved()
+            txio_changed, self._txio_unsaved = self._txio_unsaved, set()
+            if self._saved_txio is None:
+                tx = {k: self.transactions.get_raw(k) for k in self.transactions.keys()}
+                txi = {tx_hash: self._txio_to_storage(value)
+                       for tx_hash, value in self.txi.items()}
+                txo = {tx_hash: self._txio_to_storage(value)
+                       for tx_hash, value in self.txo.items()}
+            else:
+                tx, txi, txo = self._saved_txio
+                if tx_changed:
+                    tx = dict(tx)
+                    for tx_hash in tx_changed:
+                        raw = self.transactions.get_raw(tx_hash)
+                        if raw is None:
+                            tx.pop(tx_hash, None)
+                        else:
+                            tx[tx_hash] = raw
+                if txio_changed:
+                    txi, txo = dict(txi), dict(txo)
+                    for saved, live in ((txi, self.txi), (txo, self.txo)):
+                        for tx_hash in txio_changed:
+                            value = live.get(tx_hash)
+                            if value is None:
+                                saved.pop(tx_hash, None)
+                            else:
+                                saved[tx_hash] = self._txio_to_storage(value)
+            self._saved_txio = tx, txi, txo
+            self.storage.put_owned('transactions', tx)
+            self.storage.put_owned('txi', txi)
+            self.storage.put_owned('txo', txo)
+            self.storage.put_owned('tx_fees', dict(self.tx_fees))
+            self.storage.put_owned('pruned_txo', dict(self.pruned_txo))
+            # history lists are replaced, never modified, so can be shared
             history = self.from_Address_dict(self._history)
-            self.storage.put('addr_history', history)
+            self.storage.put_owned('addr_history', history)
+            statuses = self.from_Address_dict(
+                {addr: [status, history_fingerprint(self._history.get(addr, ()))]
+                 for addr, status in self._addr_status.items() if status is not None})
+            self.storage.put_owned('addr_status', statuses)
             if write:
                 self.storage.write()
 
+    @staticmethod
+    def _txio_to_storage(d):
+        '''A txi/txo entry as stored: address strings and item lists.'''
+        return {addr.to_storage_string(): [list(item) for item in l]
+                for addr, l in d.items()}
+
     def save_verified_tx(self, write=False):
         with self.lock:
-            self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put_owned('verified_tx3', dict(self.verified_tx))
             if write:
                 self.storage.write()
                 
@@ -292,9 +507,13 @@ class Abstract_Wallet(PrintError):
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
+            self._saved_txio = None
+            self.build_utxo_index()
+            self.build_history_ledger()
         self.save_transactions()
         with self.lock:
             self._history = {}
+            self._addr_status = {}
             self.tx_addr_hist = {}
 
     @profiler
@@ -306,13 +525,172 @@ class Abstract_Wallet(PrintError):
                 s.add(addr)
                 self.tx_addr_hist[tx_hash] = s
 
+    def build_utxo_index(self):
+        ''' Reset the per-address io and utxo caches.  Every address with a
+        history is marked dirty so the caches are filled lazily on first
+        use. '''
+        # address -> (received, sent) as returned by get_addr_io()
+        self._addr_io = {}
+        # "prevout_hash:n" -> (address, height, value, is_coinbase), unspent only
+        self._utxos = {}
+        # address -> set of "prevout_hash:n" keys into self._utxos
+        self._addr_utxos = {}
+        # addresses whose entries above must be recomputed before use
+        self._utxo_dirty = set(self._history)
+        # address -> (c, u, x, frozen_c, frozen_u, frozen_x): the balance of
+        # the coins not frozen at coin level, followed by that of the frozen ones
+        self._addr_balance = {}
+        # element-wise sum of all the tuples in self._addr_balance
+        self._balance_totals = (0,) * 6
+        # addresses whose balance must be recomputed from self._addr_io
+        self._balance_dirty = set()
+        # addresses that ever received a coinbase output; their balance
+        # depends on the local height through COINBASE_MATURITY
+        self._cb_addrs = set()
+        self._balance_height = None
+
+    def _invalidate_addr_utxos(self, addrs):
+        ''' Mark addresses whose history, txi or txo changed. The caller
+        must hold self.transaction_lock. '''
+        self._utxo_dirty.update(addr for addr in addrs if isinstance(addr, Address))
+
+    def _flush_utxo_index(self):
+        ''' Recompute the cached io/utxo entries of every dirty address. '''
+        with self.transaction_lock:
+            while self._utxo_dirty:
+                address = self._utxo_dirty.pop()
+                self._balance_dirty.add(address)
+                for ser in self._addr_utxos.pop(address, ()):
+                    self._utxos.pop(ser, None)
+                h = self.get_address_history(address)
+                if not h:
+                    self._addr_io.pop(address, None)
+                    continue
+                received = {}
+                sent = {}
+                for tx_hash, height in h:
+                    for n, v, is_cb in self.txo.get(tx_hash, {}).get(address, []):
+                        received[tx_hash + ':%d'%n] = (height, v, is_cb)
+                    for txi, v in self.txi.get(tx_hash, {}).get(address, []):
+                        sent[txi] = height
+                self._addr_io[address] = received, sent
+                unspent = set()
+                for ser, (height, v, is_cb) in received.items():
+                    if ser in sent:
+                        # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
+                        self.frozen_coins.discard(ser)
+                        continue
+                    self._utxos[ser] = (address, height, v, is_cb)
+                    unspent.add(ser)
+                if unspent:
+                    self._addr_utxos[address] = unspent
+
+    def _flush_balances(self):
+        ''' Bring the cached balances up to date.  Only addresses whose
+        history changed, whose frozen coins changed or, when the local
+        height moved, that hold coinbase outputs are recomputed. '''
+        self._flush_utxo_index()
+        local_height = self.get_local_height()
+        with self.transaction_lock:
+            if local_height != self._balance_height:
+                self._balance_height = local_height
+                self._balance_dirty |= self._cb_addrs
+            if not self._balance_dirty:
+                return
+            totals = list(self._balance_totals)
+            while self._balance_dirty:
+                address = self._balance_dirty.pop()
+                old = self._addr_balance.pop(address, None)
+                if old:
+                    for i, v in enumerate(old):
+                        totals[i] -= v
+                self._cb_addrs.discard(address)
+                io = self._addr_io.get(address)
+                if not io:
+                    continue
+                received, sent = io
+                b = [0] * 6
+                for txo, (tx_height, v, is_cb) in received.items():
+                    o = 3 if txo in self.frozen_coins else 0
+                    if is_cb:
+                        self._cb_addrs.add(address)
+                    if is_cb and tx_height + COINBASE_MATURITY > local_height:
+                        b[o+2] += v
+                    elif tx_height > 0:
+                        b[o] += v
+                    else:
+                        b[o+1] += v
+                    if txo in sent:
+                        if sent[txo] > 0:
+                            b[o] -= v
+                        else:
+                            b[o+1] -= v
+                self._addr_balance[address] = b = tuple(b)
+                for i, v in enumerate(b):
+                    totals[i] += v
+            self._balance_totals = tuple(totals)
+
+    def build_history_ledger(self):
+        ''' Reset the ordered ledger behind get_history().  Entries are
+        (re)computed lazily for every tx marked by _invalidate_ledger(). '''
+        # tx_hash -> (txpos, delta) where delta is the effect of the tx on the
+        # whole wallet, or None if it cannot be known (pruned inputs)
+        self._ledger = {}
+        # (txpos, tx_hash) for every entry of self._ledger, oldest first
+        self._ledger_order = []
+        self._ledger_dirty = set(self.tx_addr_hist)
+
+    def _invalidate_ledger(self, tx_hashes):
+        ''' Mark txs whose position or wallet delta may have changed. '''
+        self._ledger_dirty.update(tx_hashes)
+
+    def _flush_history_ledger(self):
+        with self.lock, self.transaction_lock:
+            dirty = []
+            while self._ledger_dirty:
+                dirty.append(self._ledger_dirty.pop())
+            if not dirty:
+                return
+            # Patch the sorted list in place for a few txs, re-sort it
+            # when a whole batch arrived (wallet open, initial sync).
+            bulk = len(dirty) > 64 and len(dirty) * 8 > len(self._ledger_order)
+            for tx_hash in dirty:
+                old = self._ledger.pop(tx_hash, None)
+                if old is not None and not bulk:
+                    i = bisect.bisect_left(self._ledger_order, (old[0], tx_hash))
+                    del self._ledger_order[i]
+                delta = 0
+                found = False
+                for addr in self.tx_addr_hist.get(tx_hash, ()):
+                    if addr not in self._history:
+                        continue
+                    found = True
+                    d = self.get_tx_delta(tx_hash, addr)
+                    if d is None or delta is None:
+                        delta = None
+                    else:
+                        delta += d
+                if not found:
+                    continue
+                txpos = self.get_txpos(tx_hash)
+                self._ledger[tx_hash] = txpos, delta
+                if not bulk:
+                    bisect.insort(self._ledger_order, (txpos, tx_hash))
+            if bulk:
+                self._ledger_order = sorted((v[0], tx_hash)
+                                            for tx_hash, v in self._ledger.items())
+
     @profiler
     def check_history(self):
         save = False
         my_addrs = [addr for addr in self._history if self.is_mine(addr)]
 
         for addr in set(self._history) - set(my_addrs):
-            self._history.pop(addr)
+            hist = self._history.pop(addr)
+            self._addr_status.pop(addr, None)
+            with self.transaction_lock:
+                self._invalidate_addr_utxos([addr])
+            self._invalidate_ledger(tx_hash for tx_hash, height in hist)
             save = True
 
         for addr in my_addrs:
@@ -346,6 +724,17 @@ class Abstract_Wallet(PrintError):
             d = {}
         self.receiving_addresses = Address.from_strings(d.get('receiving', []))
         self.change_addresses = Address.from_strings(d.get('change', []))
+        self.build_address_index()
+
+    def build_address_index(self):
+        ''' (Re)build the address -> sequence map used by is_mine(),
+        is_change() and get_address_index().  Call this whenever the
+        address lists are replaced wholesale. '''
+        self._addr_to_addr_index = {}
+        for i, addr in enumerate(self.receiving_addresses):
+            self._addr_to_addr_index[addr] = (False, i)
+        for i, addr in enumerate(self.change_addresses):
+            self._addr_to_addr_index[addr] = (True, i)
 
     def synchronize(self):
         pass
@@ -390,20 +779,17 @@ class Abstract_Wallet(PrintError):
 
     def is_mine(self, address):
         assert not isinstance(address, str)
-        return address in self.get_addresses()
+        return address in self._addr_to_addr_index
 
     def is_change(self, address):
         assert not isinstance(address, str)
-        return address in self.change_addresses
+        ix = self._addr_to_addr_index.get(address)
+        return ix is not None and ix[0]
 
     def get_address_index(self, address):
         try:
-            return False, self.receiving_addresses.index(address)
-        except ValueError:
-            pass
-        try:
-            return True, self.change_addresses.index(address)
-        except ValueError:
+            return self._addr_to_addr_index[address]
+        except KeyError:
             pass
         assert not isinstance(address, str)
         raise Exception("Address {} not found".format(address))
@@ -421,6 +807,7 @@ class Abstract_Wallet(PrintError):
         return self.get_pubkeys(*sequence)
 
     def add_unverified_tx(self, tx_hash, tx_height):
+        self._invalidate_ledger([tx_hash])
         if tx_height == 0 and tx_hash in self.verified_tx:
             self.verified_tx.pop(tx_hash)
             if self.verifier:
@@ -429,12 +816,14 @@ class Abstract_Wallet(PrintError):
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
             self.unverified_tx[tx_hash] = tx_height
+            self.unverified_tx_changes += 1
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+        self._invalidate_ledger([tx_hash])
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
         self.network.trigger_callback('verified2', self, tx_hash, height, conf, timestamp)
@@ -455,6 +844,7 @@ class Abstract_Wallet(PrintError):
                     if not header or header.get('timestamp') != timestamp:
                         self.verified_tx.pop(tx_hash, None)
                         txs.add(tx_hash)
+        self._invalidate_ledger(txs)
         return txs
 
     def get_local_height(self):
@@ -510,7 +900,6 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.get_addresses()
         is_relevant = False
         is_mine = False
         is_pruned = False
@@ -518,7 +907,7 @@ class Abstract_Wallet(PrintError):
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs():
             addr = item['address']
-            if addr in addresses:
+            if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
@@ -538,7 +927,7 @@ class Abstract_Wallet(PrintError):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -606,41 +995,30 @@ class Abstract_Wallet(PrintError):
         return tx_hash, status, label, can_broadcast, amount, fee, height, conf, timestamp, exp_n
 
     def get_addr_io(self, address):
-        h = self.get_address_history(address)
-        received = {}
-        sent = {}
-        for tx_hash, height in h:
-            l = self.txo.get(tx_hash, {}).get(address, [])
-            for n, v, is_cb in l:
-                received[tx_hash + ':%d'%n] = (height, v, is_cb)
-        for tx_hash, height in h:
-            l = self.txi.get(tx_hash, {}).get(address, [])
-            for txi, v in l:
-                sent[txi] = height
-        return received, sent
+        ''' Returns (received, sent) for address: received maps
+        "prevout_hash:n" to (height, value, is_coinbase) and sent maps each
+        spent "prevout_hash:n" to the height of the spending tx.  The dicts
+        are shared with the wallet's cache and must not be modified. '''
+        self._flush_utxo_index()
+        return self._addr_io.get(address) or ({}, {})
+
+    def _make_utxo(self, ser):
+        address, tx_height, value, is_cb = self._utxos[ser]
+        prevout_hash, prevout_n = ser.split(':')
+        return {
+            'address':address,
+            'value':value,
+            'prevout_n':int(prevout_n),
+            'prevout_hash':prevout_hash,
+            'height':tx_height,
+            'coinbase':is_cb,
+            'is_frozen_coin':ser in self.frozen_coins
+        }
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-            if txi in self.frozen_coins:
-                # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
-                self.frozen_coins.remove(txi)
-        out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb,
-                'is_frozen_coin':txo in self.frozen_coins
-            }
-            out[txo] = x
-        return out
+        self._flush_utxo_index()
+        return {ser: self._make_utxo(ser)
+                for ser in self._addr_utxos.get(address, ())}
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
@@ -651,23 +1029,14 @@ class Abstract_Wallet(PrintError):
     # Note that 'exclude_frozen_coins = True' only checks for coin-level freezing, not address-level.
     def get_addr_balance(self, address, exclude_frozen_coins = False):
         assert isinstance(address, Address)
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        for txo, (tx_height, v, is_cb) in received.items():
-            if exclude_frozen_coins and txo in self.frozen_coins:
-                continue
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-        return c, u, x
+        self._flush_balances()
+        return self._cached_addr_balance(address, exclude_frozen_coins)
+
+    def _cached_addr_balance(self, address, exclude_frozen_coins):
+        c, u, x, fc, fu, fx = self._addr_balance.get(address) or (0,) * 6
+        if exclude_frozen_coins:
+            return c, u, x
+        return c + fc, u + fu, x + fx
 
     def get_spendable_coins(self, domain, config, isInvoice = False):
         confirmed_only = config.get('confirmed_only', False)
@@ -678,21 +1047,24 @@ class Abstract_Wallet(PrintError):
     def get_utxos(self, domain = None, exclude_frozen = False, mature = False, confirmed_only = False):
         ''' Note that exclude_frozen = True checks for BOTH address-level and coin-level frozen status. '''
         coins = []
+        self._flush_utxo_index()
         if domain is None:
-            domain = self.get_addresses()
+            # only addresses holding coins need to be visited
+            domain = list(self._addr_utxos)
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
+        if mature:
+            local_height = self.get_local_height()
         for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos.values():
-                if exclude_frozen and x['is_frozen_coin']:
+            for ser in self._addr_utxos.get(addr, ()):
+                if exclude_frozen and ser in self.frozen_coins:
                     continue
-                if confirmed_only and x['height'] <= 0:
+                address, height, value, is_cb = self._utxos[ser]
+                if confirmed_only and height <= 0:
                     continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                if mature and is_cb and height + COINBASE_MATURITY > local_height:
                     continue
-                coins.append(x)
-                continue
+                coins.append(self._make_utxo(ser))
         return coins
 
     def dummy_address(self):
@@ -711,13 +1083,25 @@ class Abstract_Wallet(PrintError):
         return (cc_all-cc_no_f), (uu_all-uu_no_f), (xx_all-xx_no_f)
 
     def get_balance(self, domain=None, exclude_frozen_coins=False, exclude_frozen_addresses=False):
+        self._flush_balances()
         if domain is None:
-            domain = self.get_addresses()
+            # start from the wallet-wide totals and take out the frozen addresses
+            cc, uu, xx, fc, fu, fx = self._balance_totals
+            if not exclude_frozen_coins:
+                cc, uu, xx = cc + fc, uu + fu, xx + fx
+            if not exclude_frozen_addresses:
+                return cc, uu, xx
+            for addr in self.frozen_addresses:
+                c, u, x = self._cached_addr_balance(addr, exclude_frozen_coins)
+                cc -= c
+                uu -= u
+                xx -= x
+            return cc, uu, xx
         if exclude_frozen_addresses:
             domain = set(domain) - self.frozen_addresses
         cc = uu = xx = 0
         for addr in domain:
-            c, u, x = self.get_addr_balance(addr, exclude_frozen_coins)
+            c, u, x = self._cached_addr_balance(addr, exclude_frozen_coins)
             cc += c
             uu += u
             xx += x
@@ -727,6 +1111,17 @@ class Abstract_Wallet(PrintError):
         assert isinstance(address, Address)
         return self._history.get(address, [])
 
+    def get_address_status(self, address):
+        '''The protocol status of the address's history, as the server
+        reports it on subscription.  Memoized until the history changes.'''
+        with self.lock:
+            try:
+                return self._addr_status[address]
+            except KeyError:
+                status = Synchronizer.get_status(self.get_address_history(address))
+                self._addr_status[address] = status
+                return status
+
     def add_transaction(self, tx_hash, tx):
         is_coinbase = tx.inputs()[0]['type'] == 'coinbase'
         with self.transaction_lock:
@@ -749,6 +1144,7 @@ class Abstract_Wallet(PrintError):
                             break
                     else:
                         self.pruned_txo[ser] = tx_hash
+            self._invalidate_addr_utxos(d)
 
             # add outputs
             self.txo[tx_hash] = d = {}
@@ -767,6 +1163,12 @@ class Abstract_Wallet(PrintError):
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self._invalidate_addr_utxos([addr])
+                    self._invalidate_ledger([next_tx])
+                    self._txio_unsaved.add(next_tx)
+            self._invalidate_addr_utxos(d)
+            self._invalidate_ledger([tx_hash])
+            self._txio_unsaved.add(tx_hash)
             # save
             self.transactions[tx_hash] = tx
 
@@ -787,10 +1189,17 @@ class Abstract_Wallet(PrintError):
                         if prev_hash == tx_hash:
                             l.remove(item)
                             self.pruned_txo[ser] = next_tx
+                            self._invalidate_addr_utxos([addr])
+                            self._invalidate_ledger([next_tx])
+                            self._txio_unsaved.add(next_tx)
                     if l == []:
                         dd.pop(addr)
                     else:
                         dd[addr] = l
+            self._invalidate_addr_utxos(self.txi.get(tx_hash, {}))
+            self._invalidate_addr_utxos(self.txo.get(tx_hash, {}))
+            self._invalidate_ledger([tx_hash])
+            self._txio_unsaved.add(tx_hash)
             try:
                 self.txi.pop(tx_hash)
                 self.txo.pop(tx_hash)
@@ -801,9 +1210,12 @@ class Abstract_Wallet(PrintError):
         self.add_transaction(tx_hash, tx)
         self.add_unverified_tx(tx_hash, tx_height)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def receive_history_callback(self, addr, hist, tx_fees, *, status=None):
+        '''status, if given, is the already checked status of hist.'''
         with self.lock:
             old_hist = self.get_address_history(addr)
+            self._invalidate_ledger(tx_hash for tx_hash, height in old_hist)
+            self._invalidate_ledger(tx_hash for tx_hash, height in hist)
             for tx_hash, height in old_hist:
                 if (tx_hash, height) not in hist:
                     # remove tx if it's not referenced in histories
@@ -811,6 +1223,12 @@ class Abstract_Wallet(PrintError):
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
             self._history[addr] = hist
+            if status is None:
+                self._addr_status.pop(addr, None)
+            else:
+                self._addr_status[addr] = status
+            with self.transaction_lock:
+                self._invalidate_addr_utxos([addr])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -830,36 +1248,52 @@ class Abstract_Wallet(PrintError):
         if self.network:
             self.network.trigger_callback('on_history')
 
-    def get_history(self, domain=None):
-        # get domain
+    def get_history(self, domain=None, *, since=None, limit=None, offset=0):
+        ''' Returns a list of (tx_hash, height, conf, timestamp, delta,
+        balance) tuples, oldest first.
+
+        The result can be paged from the newest end: offset skips that many
+        of the most recent txs, limit caps the number of entries returned,
+        and since drops txs mined below that block height (unconfirmed txs
+        are always newer).  Without a domain the wallet's ordered ledger is
+        used, so a page costs time proportional to offset + limit. '''
         if domain is None:
-            domain = self.get_addresses()
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                delta = self.get_tx_delta(tx_hash, addr)
-                if delta is None or tx_deltas[tx_hash] is None:
-                    tx_deltas[tx_hash] = None
-                else:
-                    tx_deltas[tx_hash] += delta
+            self._flush_history_ledger()
+            c, u, x = self.get_balance()
+            stop = offset + limit if limit is not None else None
+            with self.lock:
+                newest_first = [(txpos, tx_hash, self._ledger[tx_hash][1])
+                                for txpos, tx_hash in itertools.islice(reversed(self._ledger_order), stop)]
+        else:
+            # 1. Get the history of each address in the domain, maintain the
+            #    delta of a tx as the sum of its deltas on domain addresses
+            tx_deltas = defaultdict(int)
+            for addr in domain:
+                h = self.get_address_history(addr)
+                for tx_hash, height in h:
+                    delta = self.get_tx_delta(tx_hash, addr)
+                    if delta is None or tx_deltas[tx_hash] is None:
+                        tx_deltas[tx_hash] = None
+                    else:
+                        tx_deltas[tx_hash] += delta
 
-        # 2. create sorted history
-        history = []
-        for tx_hash in tx_deltas:
-            delta = tx_deltas[tx_hash]
-            height, conf, timestamp = self.get_tx_height(tx_hash)
-            history.append((tx_hash, height, conf, timestamp, delta))
-        history.sort(key = lambda x: self.get_txpos(x[0]), reverse=True)
+            # 2. create sorted history
+            newest_first = [(self.get_txpos(tx_hash), tx_hash, delta)
+                            for tx_hash, delta in tx_deltas.items()]
+            newest_first.sort(reverse=True)
+            c, u, x = self.get_balance(domain)
 
         # 3. add balance
-        c, u, x = self.get_balance(domain)
         balance = c + u + x
         h2 = []
-        for tx_hash, height, conf, timestamp, delta in history:
-            h2.append((tx_hash, height, conf, timestamp, delta, balance))
+        for i, (txpos, tx_hash, delta) in enumerate(newest_first):
+            if since is not None and txpos[0] < since:
+                break
+            if i >= offset:
+                if limit is not None and len(h2) >= limit:
+                    break
+                height, conf, timestamp = self.get_tx_height(tx_hash)
+                h2.append((tx_hash, height, conf, timestamp, delta, balance))
             if balance is None or delta is None:
                 balance = None
             else:
@@ -868,15 +1302,19 @@ class Abstract_Wallet(PrintError):
 
         return h2
 
-    def export_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False):
+    def export_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False, limit=None, offset=0):
         from .util import format_time, format_satoshis, timestamp_to_datetime
-        h = self.get_history(domain)
+        if from_timestamp or to_timestamp:
+            # select by time first, so that a page holds all it can of them
+            h = [x for x in self.get_history(domain)
+                 if not (from_timestamp and x[3] < from_timestamp)
+                 and not (to_timestamp and x[3] >= to_timestamp)]
+            stop = max(len(h) - offset, 0)
+            h = h[max(stop - limit, 0) if limit is not None else 0:stop]
+        else:
+            h = self.get_history(domain, limit=limit, offset=offset)
         out = []
         for tx_hash, height, conf, timestamp, value, balance in h:
-            if from_timestamp and timestamp < from_timestamp:
-                continue
-            if to_timestamp and timestamp >= to_timestamp:
-                continue
             item = {
                 'txid':tx_hash,
                 'height':height,
@@ -1086,6 +1524,7 @@ class Abstract_Wallet(PrintError):
             be satisfied for a coin to be defined as spendable. '''
         ok = 0
         for utxo in utxos:
+            self._invalidate_coin_balance(utxo)
             if isinstance(utxo, str):
                 if freeze:
                     self.frozen_coins |= { utxo }
@@ -1104,6 +1543,17 @@ class Abstract_Wallet(PrintError):
             self.storage.put('frozen_coins', list(self.frozen_coins))
         return ok
 
+    def _invalidate_coin_balance(self, utxo):
+        ''' The frozen part of an address balance changes when one of its
+        coins is (un)frozen. '''
+        with self.transaction_lock:
+            if isinstance(utxo, dict):
+                address = utxo.get('address')
+            else:
+                address = self._utxos.get(utxo, (None,))[0]
+            if address is not None:
+                self._balance_dirty.add(address)
+
     def prepare_for_verifier(self):
         # review transactions that are in the history
         for addr, hist in self._history.items():
@@ -1544,6 +1994,7 @@ class Abstract_Wallet(PrintError):
             if isinstance(self, Standard_Wallet):
                 # reset the address list to default too, just in case. New synchronizer will pick up the addresses again.
                 self.receiving_addresses, self.change_addresses = self.receiving_addresses[:self.gap_limit], self.change_addresses[:self.gap_limit_for_change]
+                self.build_address_index()
                 do_addr_save = True
         if do_addr_save:
             self.save_addresses()
@@ -1618,7 +2069,7 @@ class ImportedWalletBase(Simple_Wallet):
 
     def delete_address(self, address):
         assert isinstance(address, Address)
-        if address not in self.get_addresses():
+        if not self.is_mine(address):
             return
 
         transactions_to_remove = set()  # only referred to by this address
@@ -1632,7 +2083,11 @@ class ImportedWalletBase(Simple_Wallet):
                     for tx_hash, height in details:
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
+            self._invalidate_ledger(tx_hash for tx_hash, height in self._history.get(address, []))
             self._history.pop(address, None)
+            self._addr_status.pop(address, None)
+            with self.transaction_lock:
+                self._invalidate_addr_utxos([address])
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
@@ -1642,7 +2097,7 @@ class ImportedWalletBase(Simple_Wallet):
                 self.transactions.pop(tx_hash, None)
                 # FIXME: what about pruned_txo?
 
-            self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put_owned('verified_tx3', dict(self.verified_tx))
             
         self.save_transactions()
 
@@ -1688,6 +2143,11 @@ class ImportedAddressWallet(ImportedWalletBase):
     def load_addresses(self):
         addresses = self.storage.get('addresses', [])
         self.addresses = [Address.from_string(addr) for addr in addresses]
+        self.build_address_index()
+
+    def build_address_index(self):
+        # imported addresses have no derivation; the index is membership only
+        self._addr_to_addr_index = dict.fromkeys(self.addresses)
 
     def save_addresses(self):
         self.storage.put('addresses', [addr.to_storage_string()
@@ -1708,9 +2168,10 @@ class ImportedAddressWallet(ImportedWalletBase):
 
     def import_address(self, address):
         assert isinstance(address, Address)
-        if address in self.addresses:
+        if self.is_mine(address):
             return False
         self.addresses.append(address)
+        self._addr_to_addr_index[address] = None
         self.save_addresses()
         self.storage.write()
         self.add_address(address)
@@ -1720,6 +2181,7 @@ class ImportedAddressWallet(ImportedWalletBase):
     def delete_address_derived(self, address):
         self.addresses.remove(address)
         self._sorted.remove(address)
+        self._addr_to_addr_index.pop(address, None)
 
     def add_input_sig_info(self, txin, address):
         x_pubkey = 'fd' + address.to_script_hex()
@@ -1762,7 +2224,12 @@ class ImportedPrivkeyWallet(ImportedWalletBase):
         self.storage.put('keystore', self.keystore.dump())
 
     def load_addresses(self):
-        pass
+        self.build_address_index()
+
+    def build_address_index(self):
+        # address -> pubkey; the pubkey is the "index" of an imported key
+        self._addr_to_addr_index = {pubkey.address: pubkey
+                                    for pubkey in self.keystore.keypairs}
 
     def save_addresses(self):
         pass
@@ -1778,16 +2245,18 @@ class ImportedPrivkeyWallet(ImportedWalletBase):
 
     def delete_address_derived(self, address):
         self.keystore.remove_address(address)
+        self._addr_to_addr_index.pop(address, None)
         self.save_keystore()
 
     def get_address_index(self, address):
         return self.get_public_key(address)
 
     def get_public_key(self, address):
-        return self.keystore.address_to_pubkey(address)
+        return self._addr_to_addr_index.get(address)
 
     def import_private_key(self, sec, pw):
         pubkey = self.keystore.import_privkey(sec, pw)
+        self._addr_to_addr_index[pubkey.address] = pubkey
         self.save_keystore()
         self.storage.write()
         return pubkey.address.to_ui_string()
@@ -1842,6 +2311,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             k = self.num_unused_trailing_addresses(addresses)
             n = len(addresses) - k + value
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self.build_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_addresses()
@@ -1872,28 +2342,37 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
         assert type(for_change) is bool
         with self.lock:
             addr_list = self.change_addresses if for_change else self.receiving_addresses
             n = len(addr_list)
-            x = self.derive_pubkeys(for_change, n)
-            address = self.pubkeys_to_address(x)
-            addr_list.append(address)
+            indices = range(n, n + count)
+            addresses = [self.pubkeys_to_address(x)
+                         for x in self.derive_pubkeys_batch(for_change, indices)]
+            for i, address in zip(indices, addresses):
+                addr_list.append(address)
+                self._addr_to_addr_index[address] = (for_change, i)
             self.save_addresses()
-            self.add_address(address)
-            return address
+            for address in addresses:
+                self.add_address(address)
+            return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
             if len(addresses) < limit:
-                self.create_new_address(for_change)
+                self.create_new_addresses(for_change, limit - len(addresses))
                 continue
-            if all(map(lambda a: not self.address_is_old(a), addresses[-limit:] )):
+            # enough new addresses to push the last old one out of the gap
+            count = next((limit - k for k, a in enumerate(reversed(addresses[-limit:]))
+                          if self.address_is_old(a)), 0)
+            if not count:
                 break
-            else:
-                self.create_new_address(for_change)
+            self.create_new_addresses(for_change, count)
 
     def synchronize(self):
         with self.lock:
@@ -1964,6 +2443,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_batch(self, c, indices):
+        return self.keystore.derive_pubkeys(c, indices)
+
 
 
 
@@ -1999,6 +2481,9 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_batch(self, c, indices):
+        return [list(x) for x in zip(*[k.derive_pubkeys(c, indices) for k in self.get_keystores()])]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -82,11 +82,13 @@ class WsClientThread(util.DaemonThread):
                 addr, amount = self.make_request(request_id)
             except:
                 continue
-            l = self.subscriptions.get(addr, [])
-            l.append((ws, amount))
-            self.subscriptions[addr] = l
-            h = Address.from_string(addr).to_scripthash_hex()
-            self.network.send([('blockchain.scripthash.subscribe', [h])], self.response_queue.put)
+            try:
+                addr = Address.from_string(addr)
+            except Exception:
+                continue
+            self.subscriptions[addr].append((ws, amount))
+            h = addr.to_scripthash_hex()
+            self.network.subscribe_to_scripthashes([h], self.response_queue.put, addresses=[addr])
 
 
     def run(self):
@@ -106,7 +108,7 @@ class WsClientThread(util.DaemonThread):
                 self.network.send([('blockchain.scripthash.get_balance', params)], self.response_queue.put)
             elif method == 'blockchain.scripthash.get_balance':
                 h = params[0]
-                addr = self.network.h2addr.get(h, None)
+                addr = self.network.get_scripthash_address(h)
                 if addr is None:
                     util.print_error("can't find address for scripthash: %s" % h)
                 l = self.subscriptions.get(addr, [])
@@ -0,0 +1,106 @@
+#
+# A minimal ElectrumX stand-in for benchmarks: a plain TCP (':t') server
+# speaking newline delimited JSON-RPC on localhost.  Methods are answered by
+# the functions in FakeServer.handlers, which take the request params and
+# return the result; anything else gets a JSON-RPC error.  Batches (arrays of
+# requests) get arrays of replies.  The server never sends notifications, and
+# by default blockchain.headers.subscribe gets an error, so a Network
+# connected to it never starts syncing headers.  FakeServer.delay holds each
+# reply back that many seconds, as a distant server would, without holding
+# up the requests after it.  Given a certificate chain file, it speaks SSL
+# (':s') instead.
+
+import json
+import socketserver
+import ssl
+import threading
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.fake.connections += 1
+        self.write_lock = threading.Lock()
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf8'))
+            except ValueError:
+                return
+            if isinstance(request, list):
+                response = [self.server.fake.respond(r) for r in request]
+            else:
+                response = self.server.fake.respond(request)
+            data = (json.dumps(response) + '\n').encode('utf8')
+            if self.server.fake.delay:
+                threading.Timer(self.server.fake.delay, self.write, (data,)).start()
+            else:
+                self.write(data)
+
+    def write(self, data):
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+            except OSError:
+                pass
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    ssl_context = None
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        if self.ssl_context:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        return sock, addr
+
+
+class FakeServer:
+
+    def __init__(self, host='127.0.0.1', port=0, certfile=None):
+        self.handlers = {
+            'server.version': lambda params: ['FakeX 1.0', '1.4'],
+            'server.ping': lambda params: None,
+            'server.banner': lambda params: 'fake',
+            'server.donation_address': lambda params: '',
+            'server.peers.subscribe': lambda params: [],
+            'blockchain.relayfee': lambda params: 0.00001,
+            'blockchain.estimatefee': lambda params: 0.00001,
+        }
+        self.connections = 0
+        self.delay = 0
+        self.requests = 0
+        self.tcp = _TCPServer((host, port), _Handler)
+        self.tcp.fake = self
+        if certfile:
+            self.tcp.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tcp.ssl_context.load_cert_chain(certfile)
+        self.protocol = 's' if certfile else 't'
+        self.host, self.port = self.tcp.server_address[:2]
+        self.thread = threading.Thread(target=self.tcp.serve_forever, daemon=True)
+
+    def server_key(self):
+        return '{}:{}:{}'.format(self.host, self.port, self.protocol)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.tcp.shutdown()
+        self.tcp.server_close()
+
+    def respond(self, request):
+        self.requests += 1
+        method = request.get('method')
+        handler = self.handlers.get(method)
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        if handler is None:
+            response['error'] = {'code': -32601, 'message': 'unknown method "{}"'.format(method)}
+        else:
+            try:
+                response['result'] = handler(request.get('params', []))
+            except Exception as e:
+                response['error'] = {'code': 1, 'message': str(e)}
+        return response
@@ -35,7 +35,7 @@ def wait_on_interfaces(interfaces, timeout=10):
     timeout = time.time() + timeout
     while len(result) < len(interfaces) and time.time() < timeout:
         rin = [i for i in interfaces.values()]
-        win = [i for i in interfaces.values() if i.unsent_requests]
+        win = [i for i in interfaces.values() if i.num_requests()]
         rout, wout, xout = select.select(rin, win, [], 1)
         for interface in wout:
             interface.send_requests()